@@ -0,0 +1,406 @@
+"""
+Замеры производительности бота.
+
+    python bench.py excel [итераций] [позиций]
+    python bench.py updates [обновлений на пользователя]
+    python bench.py routing [итераций]
+    python bench.py drafts [черновиков] [позиций]
+    python bench.py quick [строк]
+    python bench.py names [наименований]
+    python bench.py history [заявок]
+
+Переменные окружения бота должны быть заданы (например, через .env), так как
+скрипт импортирует main.py.
+"""
+import asyncio
+import json
+import random
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+from io import BytesIO
+
+from openpyxl import load_workbook
+from telegram import Update
+from telegram.ext import CallbackQueryHandler, SimpleUpdateProcessor
+
+import main
+
+
+def sample_positions(count):
+    return [
+        main.Position(
+            f"Кабель ВВГ 3x2.5 №{i + 1}",
+            main.units[i % len(main.units)],
+            10.5 + i,
+            main.modules[i % len(main.modules)],
+            "2025-08-25",
+            "https://example.com/item" if i % 2 else None,
+            [main.Attachment(f"file{i}", f"unique{i}", f"Спецификация {i}.pdf", "application/pdf")] if i % 3 == 0 else [],
+        )
+        for i in range(count)
+    ]
+
+
+def legacy_draft(positions):
+    """Черновик в формате словарей, в котором он хранился до появления модели заявки."""
+    return {
+        "user_full_name": "Иван Петров",
+        "telegram_id_or_username": "ivan_petrov",
+        "project": "Мотели",
+        "object": "Каркаролинск",
+        "positions": [
+            {
+                "name": p.name, "unit": p.unit, "quantity": p.quantity, "module": p.module,
+                "delivery_date": p.delivery_date.isoformat(), "link": p.link or "",
+                "file_data": [
+                    {"file_id": f.file_id, "file_unique_id": f.file_unique_id,
+                     "file_name": f.file_name, "mime_type": f.mime_type}
+                    for f in p.files
+                ],
+            }
+            for p in positions
+        ],
+    }
+
+
+def _allocated(build, count):
+    tracemalloc.start()
+    objects = [build() for _ in range(count)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return size / count
+
+
+def sheet_values(data):
+    ws = load_workbook(BytesIO(data)).active
+    return {
+        (cell.row, cell.column): (cell.value, cell.style_id)
+        for row in ws.iter_rows()
+        for cell in row
+        if cell.value is not None
+    }
+
+
+def bench_excel(iterations=200, positions=6):
+    """Сравнивает рендер по скомпилированному шаблону с рендером через openpyxl."""
+    with open(main.TEMPLATE_PATH, "rb") as f:
+        template_bytes = f.read()
+    args = ("Мотели", "Каркаролинск", sample_positions(positions), "Иван Петров", "ivan_petrov")
+
+    results = {}
+    for renderer in ("openpyxl", "xml"):
+        main.EXCEL_RENDERER = renderer
+        main._init_excel_worker(template_bytes)
+        _, data = main.fill_excel(*args)
+        started = time.perf_counter()
+        for _ in range(iterations):
+            main.fill_excel(*args)
+        elapsed = time.perf_counter() - started
+        results[renderer] = (data, elapsed / iterations)
+        print(f"{renderer:>8}: {elapsed / iterations * 1000:.3f} мс на книгу, {iterations / elapsed:.0f} книг/с")
+
+    same = sheet_values(results["openpyxl"][0]) == sheet_values(results["xml"][0])
+    print(f"Содержимое совпадает: {'да' if same else 'НЕТ'}")
+    print(f"Ускорение: {results['openpyxl'][1] / results['xml'][1]:.1f}x")
+
+
+async def _measure_latency(processor, users, updates_per_user, handler_time):
+    """Каждый пользователь шлет обновления по одному, дожидаясь ответа на предыдущее."""
+    latencies = []
+
+    async def handler():
+        await asyncio.sleep(handler_time)
+
+    async def user(chat_id):
+        update = SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id), effective_user=None)
+        for _ in range(updates_per_user):
+            started = time.perf_counter()
+            await processor.process_update(update, handler())
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(user(chat_id) for chat_id in range(users)))
+    return statistics.mean(latencies), statistics.quantiles(latencies, n=20)[-1]
+
+
+async def _measure_burst(processor, burst, handler_time):
+    """Один чат присылает burst обновлений разом, другой - одно; возвращает задержку второго."""
+    async def handler():
+        await asyncio.sleep(handler_time)
+
+    noisy = SimpleNamespace(effective_chat=SimpleNamespace(id=1), effective_user=None)
+    quiet = SimpleNamespace(effective_chat=SimpleNamespace(id=2), effective_user=None)
+    tasks = [asyncio.create_task(processor.process_update(noisy, handler())) for _ in range(burst)]
+    await asyncio.sleep(0)
+    started = time.perf_counter()
+    await processor.process_update(quiet, handler())
+    latency = time.perf_counter() - started
+    await asyncio.gather(*tasks)
+    return latency
+
+
+def bench_updates(updates_per_user=5, handler_time=0.02):
+    """
+    Нагрузочный тест обработки обновлений: задержка ответа пользователю при росте числа
+    одновременно работающих пользователей. Обработчик имитирует ожидание сети (handler_time).
+    """
+    print(f"{'пользователей':>14} | {'по очереди, мс (p95)':>22} | {'по чатам, мс (p95)':>20}")
+    for users in (1, 10, 50, 100):
+        sequential = asyncio.run(_measure_latency(SimpleUpdateProcessor(1), users, updates_per_user, handler_time))
+        per_chat = asyncio.run(_measure_latency(
+            main.PerChatUpdateProcessor(main.MAX_CONCURRENT_UPDATES, main.ChatLocks()),
+            users, updates_per_user, handler_time,
+        ))
+        print(f"{users:>14} | {sequential[0] * 1000:>9.1f} ({sequential[1] * 1000:>8.1f}) | "
+              f"{per_chat[0] * 1000:>8.1f} ({per_chat[1] * 1000:>8.1f})")
+
+    # Очередь одного чата не должна занимать общий лимит и задерживать остальные чаты
+    limit, burst = 4, 6
+    latency = asyncio.run(_measure_burst(main.PerChatUpdateProcessor(limit, main.ChatLocks()), burst, handler_time))
+    print(f"Другой чат при {burst} обновлениях подряд из одного чата (лимит {limit}): {latency * 1000:.1f} мс")
+    assert latency < 2 * handler_time, "обновления одного чата задерживают другие чаты"
+
+
+def bench_drafts(count=1000, positions=10):
+    """
+    Память на черновик в процессе и размер записи в базе: словари против Draft/Position.
+    Строки (наименования, имена файлов) в каждом черновике свои, как у пришедших из Telegram.
+    """
+    def new_model():
+        return main.Draft.from_json(model_json)
+
+    def old_dicts():
+        return json.loads(legacy_json)
+
+    model = main.Draft("Иван Петров", "ivan_petrov", "Мотели", "Каркаролинск", sample_positions(positions))
+    model_json = model.to_json()
+    legacy_json = json.dumps(legacy_draft(model.positions), ensure_ascii=False)
+    assert main.Draft.from_json(legacy_json).to_json() == model_json
+
+    old_memory, new_memory = _allocated(old_dicts, count), _allocated(new_model, count)
+    print(f"Черновик из {positions} позиций")
+    print(f"{'':>10} | {'в памяти, байт':>15} | {'в базе, байт':>13}")
+    print(f"{'словари':>10} | {old_memory:>15.0f} | {len(legacy_json.encode()):>13}")
+    print(f"{'модель':>10} | {new_memory:>15.0f} | {len(model_json.encode()):>13}")
+    print(f"Экономия памяти: {(1 - new_memory / old_memory) * 100:.0f}%")
+
+
+def bench_quick_entry(lines=1000):
+    """Разбор сообщения быстрого ввода: строк в секунду и время на сообщение из 100 строк."""
+    spellings = ["м", "шт.", "кг", "компл", "кв.м", "тонн"]
+    text = "\n".join(
+        f"Кабель ВВГ 3x{i}; {spellings[i % len(spellings)]}; {i + 1},5; {main.modules[i % len(main.modules)]}; 25.08"
+        for i in range(lines)
+    )
+    main.IMPORT_MAX_POSITIONS = lines
+    started = time.perf_counter()
+    positions, errors = main.parse_quick_entry(text)
+    elapsed = time.perf_counter() - started
+    assert len(positions) == lines and not errors, errors[:3]
+    print(f"{lines} строк за {elapsed * 1000:.1f} мс: {lines / elapsed:.0f} строк/с, "
+          f"сообщение из 100 строк - {elapsed / lines * 100 * 1000:.2f} мс")
+
+
+def bench_names(count=100000, queries=2000):
+    """
+    Индекс наименований для inline-подсказок: время построения, память и время поиска
+    по частям наименований разной длины (префиксы и слова из середины).
+    """
+    rng = random.Random(1)
+    materials = ["Кабель ВВГнг", "Труба стальная", "Уголок", "Швеллер", "Саморез", "Профиль ПН", "Лист ГКЛ",
+                 "Арматура А500С", "Болт М", "Краска ПФ-115", "Гофра ПНД", "Автомат ABB", "Дюбель-гвоздь"]
+    names = [f"{rng.choice(materials)} {rng.randint(1, 400)}x{rng.randint(1, 60)} исп.{i}" for i in range(count)]
+    scopes = [(project, obj) for project in main.projects for obj in main.objects]
+
+    rows = []
+    for request_id, start in enumerate(range(0, count, 10), 1):
+        project, obj = scopes[request_id % len(scopes)]
+        payload = {"project": project, "object": obj,
+                   "positions": [[name, rng.choice(main.units), 1, main.modules[0], None, None, []]
+                                 for name in names[start:start + 10]]}
+        rows.append({"id": request_id, "payload": json.dumps(payload, ensure_ascii=False)})
+
+    def build():
+        index = main.NameIndex(count)
+        index.add_requests(rows)
+        index.update()
+        return index
+
+    started = time.perf_counter()
+    index = build()
+    built = time.perf_counter() - started
+    tracemalloc.start()
+    copy = build()
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del copy
+    print(f"{len(index)} наименований: построение {built:.2f} с, память {memory / 2 ** 20:.1f} МБ")
+
+    for label, make in (
+        ("пустой запрос", lambda name: ""),
+        ("префикс 1-2 буквы", lambda name: name[:rng.randint(1, 2)]),
+        ("префикс 3-8 букв", lambda name: name[:rng.randint(3, 8)]),
+        ("слово из середины", lambda name: name.split()[-2]),
+        ("два слова", lambda name: " ".join(name.split()[1:3])),
+    ):
+        samples = [make(rng.choice(names)) for _ in range(queries)]
+        latencies = []
+        for text in samples:
+            scope = rng.choice(scopes)
+            started = time.perf_counter()
+            index.search(text, scope, main.INLINE_RESULTS_LIMIT)
+            latencies.append(time.perf_counter() - started)
+        print(f"{label:>18}: среднее {statistics.mean(latencies) * 1e6:.0f} мкс, "
+              f"p99 {statistics.quantiles(latencies, n=100)[-1] * 1e6:.0f} мкс")
+
+
+def bench_history(count=200000, reads=2000):
+    """
+    Загрузка прошлой заявки для повтора при многолетней истории: время чтения по номеру,
+    последней заявки по проекту и объекту и списка заявок пользователя, план запросов SQLite.
+    """
+    rng = random.Random(1)
+    scopes = [(project, obj) for project in main.projects for obj in main.objects]
+    positions = [p.to_data() for p in sample_positions(15)]
+    with tempfile.TemporaryDirectory() as directory:
+        history = main.RequestHistory(os.path.join(directory, "history.sqlite3"))
+        started = time.perf_counter()
+        with history._lock:
+            history._conn.execute("BEGIN")
+            for entry_id in range(1, count + 1):
+                project, obj = rng.choice(scopes)
+                history._conn.execute(
+                    "INSERT INTO request_history VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (entry_id, rng.randrange(500), project, obj, len(positions), time.time(),
+                     json.dumps(positions, ensure_ascii=False, separators=(",", ":"))),
+                )
+            history._conn.execute("COMMIT")
+        print(f"{count} заявок записано за {time.perf_counter() - started:.1f} с")
+
+        for label, read, query in (
+            ("по номеру", lambda: history.get(rng.randint(1, count)),
+             "SELECT * FROM request_history WHERE id = 1"),
+            ("последняя по объекту", lambda: history.last_for_scope(*rng.choice(scopes)),
+             "SELECT * FROM request_history WHERE project = 'a' AND object = 'b' ORDER BY id DESC LIMIT 1"),
+            ("список пользователя", lambda: history.recent_for_chat(rng.randrange(500), main.HISTORY_RECENT_REQUESTS),
+             "SELECT id, project, object, position_count, created_at FROM request_history"
+             " WHERE chat_id = 1 ORDER BY id DESC LIMIT 10"),
+        ):
+            latencies = []
+            for _ in range(reads):
+                started = time.perf_counter()
+                row = read()
+                if not isinstance(row, list):
+                    [main.Position.from_data(data) for data in json.loads(row["positions"])]
+                latencies.append(time.perf_counter() - started)
+            plan = history._conn.execute("EXPLAIN QUERY PLAN " + query).fetchall()[-1]["detail"]
+            print(f"{label:>21}: среднее {statistics.mean(latencies) * 1e6:.0f} мкс, "
+                  f"p99 {statistics.quantiles(latencies, n=100)[-1] * 1e6:.0f} мкс ({plan})")
+        history.close()
+
+
+def _callback_update(data):
+    return Update.de_json({
+        "update_id": 1,
+        "callback_query": {
+            "id": "1", "chat_instance": "1", "data": data,
+            "from": {"id": 1, "is_bot": False, "first_name": "Иван"},
+            "message": {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}},
+        },
+    }, None)
+
+
+async def _noop(update, context):
+    pass
+
+
+def bench_routing(iterations=20000):
+    """
+    Стоимость выбора обработчика нажатия на кнопку: цепочка CallbackQueryHandler с регулярными
+    выражениями (как было до CallbackRouter, включая разбор строки в обработчике) против
+    поиска в словаре. Для каждого состояния берется нажатие, которое проверяется последним.
+    """
+    legacy = {
+        "календарь": (
+            [CallbackQueryHandler(_noop, pattern="^(CAL_|EDIT_CAL_)\\d+_\\d+"),
+             CallbackQueryHandler(_noop, pattern="^(CAL_|EDIT_CAL_)"),
+             CallbackQueryHandler(_noop, pattern="^cancel_dialog$")],
+            "EDIT_CAL_NAV_2026_11",
+            lambda data: (int(data.split("_")[3]), int(data.split("_")[4])),
+        ),
+        "выбор позиции": (
+            [CallbackQueryHandler(_noop, pattern="^select_pos_\\d+$"),
+             CallbackQueryHandler(_noop, pattern="^back_to_edit_menu$"),
+             CallbackQueryHandler(_noop, pattern="^cancel_dialog$")],
+            "cancel_dialog",
+            lambda data: None,
+        ),
+        "поле": (
+            [CallbackQueryHandler(_noop, pattern="^edit_field_"),
+             CallbackQueryHandler(_noop, pattern="^back_to_edit_menu$"),
+             CallbackQueryHandler(_noop, pattern="^cancel_dialog$")],
+            "edit_field_delivery_date",
+            lambda data: data.replace("edit_field_", ""),
+        ),
+    }
+    routed = {
+        "календарь": (
+            main.CallbackRouter({main.CB_CALENDAR_NAV: _noop, main.CB_CALENDAR_DATE: _noop,
+                                 main.CB_CALENDAR_CANCEL: _noop, main.CB_IGNORE: _noop, main.CB_CANCEL: _noop}),
+            main.pack_callback(main.CB_CALENDAR_NAV, main.CALENDAR_EDIT, 2026, 11),
+        ),
+        "выбор позиции": (
+            main.CallbackRouter({main.CB_SELECT_POSITION: _noop, main.CB_BACK_TO_MENU: _noop, main.CB_CANCEL: _noop}),
+            main.pack_callback(main.CB_CANCEL),
+        ),
+        "поле": (
+            main.CallbackRouter({main.CB_EDIT_FIELD: _noop, main.CB_BACK_TO_MENU: _noop, main.CB_CANCEL: _noop}),
+            main.pack_callback(main.CB_EDIT_FIELD, "delivery_date"),
+        ),
+    }
+
+    print(f"{'состояние':>14} | {'regex, мкс':>10} | {'словарь, мкс':>12} | {'callback_data':>24}")
+    for state, (handlers, data, parse) in legacy.items():
+        update = _callback_update(data)
+        started = time.perf_counter()
+        for _ in range(iterations):
+            for handler in handlers:
+                if handler.check_update(update):
+                    parse(update.callback_query.data)
+                    break
+        legacy_cost = (time.perf_counter() - started) / iterations
+
+        router, packed = routed[state]
+        update = _callback_update(packed)
+        started = time.perf_counter()
+        for _ in range(iterations):
+            router.check_update(update)
+        routed_cost = (time.perf_counter() - started) / iterations
+        print(f"{state:>14} | {legacy_cost * 1e6:>10.2f} | {routed_cost * 1e6:>12.2f} | "
+              f"{data!r} -> {packed!r}")
+
+
+if __name__ == "__main__":
+    main.logger.setLevel("WARNING")
+    command = sys.argv[1] if len(sys.argv) > 1 else "excel"
+    if command == "excel":
+        bench_excel(*(int(arg) for arg in sys.argv[2:4]))
+    elif command == "updates":
+        bench_updates(*(int(arg) for arg in sys.argv[2:3]))
+    elif command == "routing":
+        bench_routing(*(int(arg) for arg in sys.argv[2:3]))
+    elif command == "drafts":
+        bench_drafts(*(int(arg) for arg in sys.argv[2:4]))
+    elif command == "quick":
+        bench_quick_entry(*(int(arg) for arg in sys.argv[2:3]))
+    elif command == "names":
+        bench_names(*(int(arg) for arg in sys.argv[2:3]))
+    elif command == "history":
+        bench_history(*(int(arg) for arg in sys.argv[2:3]))
+    else:
+        sys.exit(f"Неизвестный замер: {command}")
@@ -1,18 +1,56 @@
 import os
+import sys
 import logging
 import asyncio
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from telegram import Bot, InputFile, InputMediaDocument, InlineQueryResultArticle, InputTextMessageContent
+from telegram.constants import MessageLimit, InlineKeyboardButtonLimit
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, CallbackQueryHandler,
-    MessageHandler, ContextTypes, filters, ConversationHandler
+    MessageHandler, ContextTypes, filters, ConversationHandler,
+    BasePersistence, PersistenceInput, TypeHandler, BaseUpdateProcessor, BaseHandler, BaseRateLimiter,
+    InlineQueryHandler,
 )
+from telegram.error import RetryAfter, BadRequest
 from dotenv import load_dotenv
 from openpyxl import load_workbook
+from openpyxl.worksheet.cell_range import MultiCellRange
 import smtplib
-from email.message import EmailMessage
-import shutil
+import base64
+import secrets
+import hmac
+import signal
+import hashlib
+import tempfile
+import email.policy
+import re
+import struct
+import zipfile
+import csv
+import zlib
+import json
+import mimetypes
+import random
+import sqlite3
+import queue
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from email.message import EmailMessage, MIMEPart
+from email.utils import getaddresses
+from io import BytesIO, StringIO
+from copy import copy
+from xml.sax.saxutils import escape as xml_escape, unescape as xml_unescape
 from datetime import datetime, date, timedelta
 import calendar
+import functools
+import itertools
+import operator
+import heapq
+from array import array
 
 # Настройка логирования
 logging.basicConfig(
@@ -32,7 +70,68 @@ EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
 SMTP_SERVER = os.getenv("SMTP_SERVER")
 SMTP_PORT = int(os.getenv("SMTP_PORT"))
 EMAIL_RECEIVER = os.getenv("EMAIL_RECEIVER")
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "2"))
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "30"))
+SMTP_KEEPALIVE = float(os.getenv("SMTP_KEEPALIVE", "60")) # через сколько секунд простоя проверять соединение NOOP
+SMTP_MAX_IDLE = float(os.getenv("SMTP_MAX_IDLE", "240")) # после этого простоя соединение закрывается и открывается заново
+ATTACHMENT_DOWNLOAD_CONCURRENCY = int(os.getenv("ATTACHMENT_DOWNLOAD_CONCURRENCY", "5")) # одновременных скачиваний на одну заявку
+ATTACHMENT_DOWNLOAD_TIMEOUT = float(os.getenv("ATTACHMENT_DOWNLOAD_TIMEOUT", "60")) # секунд на один файл
+ATTACHMENT_CACHE_DIR = os.getenv("ATTACHMENT_CACHE_DIR", "cache/attachments")
+ATTACHMENT_CACHE_MAX_BYTES = int(os.getenv("ATTACHMENT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+DELIVERY_BACKEND = os.getenv("DELIVERY_BACKEND", "email") # "email" или "telegram" для проектов, не перечисленных в PROJECT_DELIVERY
+# Способ доставки по проектам, например "Мотели=telegram;Stadler=email"
+PROJECT_DELIVERY = {
+    project.strip(): backend.strip()
+    for project, _, backend in (item.partition("=") for item in os.getenv("PROJECT_DELIVERY", "").split(";"))
+    if backend.strip()
+}
+PROCUREMENT_CHAT_ID = os.getenv("PROCUREMENT_CHAT_ID") # чат или канал отдела снабжения (id или @username)
+BUNDLE_ATTACHMENTS = os.getenv("BUNDLE_ATTACHMENTS", "0") == "1" # упаковывать вложения в zip-архив
+BUNDLE_MAX_BYTES = int(os.getenv("BUNDLE_MAX_BYTES", str(15 * 1024 * 1024))) # размер одного архива, больше - следующим письмом
+DB_PATH = os.getenv("DB_PATH", "bot.sqlite3")
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_RETRY_BASE = float(os.getenv("OUTBOX_RETRY_BASE", "30")) # задержка перед первым повтором, секунды
+OUTBOX_RETRY_MAX = float(os.getenv("OUTBOX_RETRY_MAX", "3600"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "15"))
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "4"))
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite") # "sqlite" - черновики переживают перезапуск, "memory" - только в памяти
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "5")) # как часто изменения черновиков пишутся на диск, секунды
+DRAFT_TTL = float(os.getenv("DRAFT_TTL", str(3 * 24 * 3600))) # через сколько секунд бездействия черновик удаляется
+DRAFT_MAX_LIVE = int(os.getenv("DRAFT_MAX_LIVE", "500")) # сколько черновиков держать в памяти одновременно
+RUN_MODE = os.getenv("RUN_MODE", "polling") # "webhook" - встроенный HTTP-сервер, при ошибке запуска - опрос; "vacuum" - перевести базу в auto_vacuum=INCREMENTAL и выйти
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "") # внешний адрес сервера; пустое значение - webhook не регистрируется (локальная отладка)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8080")))
+SHARDS = int(os.getenv("SHARDS", str(os.cpu_count() or 2))) # число процессов в режиме RUN_MODE=supervisor
+SHARD_BASE_PORT = int(os.getenv("SHARD_BASE_PORT", "8100")) # шард i слушает 127.0.0.1:SHARD_BASE_PORT+i
+# Номер шарда и их число; задаются супервизором, шард обрабатывает чаты с abs(chat_id) % SHARD_COUNT == SHARD_INDEX
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "0"))
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30")) # запросов в секунду ко всем чатам, на все шарды вместе
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1")) # запросов в секунду в один личный чат
+TELEGRAM_GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_RATE", str(20 / 60))) # запросов в секунду в одну группу или канал
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3")) # сколько запросов в чат можно отправить подряд без ожидания
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3")) # повторов после ответа 429 (RetryAfter)
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", str(5 * 1024 * 1024))) # размер файла для импорта позиций
+IMPORT_MAX_POSITIONS = int(os.getenv("IMPORT_MAX_POSITIONS", "500")) # позиций из одного файла
+NAME_INDEX_MAX_NAMES = int(os.getenv("NAME_INDEX_MAX_NAMES", "200000")) # наименований в индексе подсказок, редкие вытесняются
+NAME_INDEX_REFRESH_INTERVAL = float(os.getenv("NAME_INDEX_REFRESH_INTERVAL", "60")) # как часто подхватывать заявки других шардов, секунды
+INLINE_RESULTS_LIMIT = int(os.getenv("INLINE_RESULTS_LIMIT", "20")) # подсказок в ответе на inline-запрос (не больше 50)
+HISTORY_RECENT_REQUESTS = int(os.getenv("HISTORY_RECENT_REQUESTS", "10")) # сколько своих заявок предлагать для повтора
+SUMMARY_PAGE_POSITIONS = int(os.getenv("SUMMARY_PAGE_POSITIONS", "20")) # позиций на странице сводки и выбора позиции
+CALENDAR_CACHE_SIZE = int(os.getenv("CALENDAR_CACHE_SIZE", "64")) # сколько клавиатур-календарей держать в кэше
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64")) # сколько обновлений обрабатывать одновременно
 TEMPLATE_PATH = "template.xlsx" # Убедитесь, что template.xlsx существует в той же директории
+EXCEL_WORKERS = int(os.getenv("EXCEL_WORKERS", "2")) # 0 - формировать Excel в потоке основного процесса
+EXCEL_RENDERER = os.getenv("EXCEL_RENDERER", "xml") # "xml" - быстрый рендер по скомпилированному шаблону, "openpyxl" - через openpyxl
+EXCEL_FIRST_DATA_ROW = 9 # первая строка таблицы позиций в шаблоне
+EXCEL_LAST_DATA_ROW = 14 # последняя строка таблицы позиций в шаблоне, ниже идет подвал
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "out") # пустое значение отключает сохранение копий заявок
+ARCHIVE_RETENTION_DAYS = float(os.getenv("ARCHIVE_RETENTION_DAYS", "365")) # сколько дней хранить копии заявок, 0 - без ограничения
+ARCHIVE_MAX_BYTES = int(os.getenv("ARCHIVE_MAX_BYTES", str(1024 * 1024 * 1024))) # объем архива, сверх него удаляются самые старые копии; 0 - без ограничения
+ARCHIVE_CLEANUP_INTERVAL = float(os.getenv("ARCHIVE_CLEANUP_INTERVAL", "3600")) # как часто чистить архив, секунды
 
 # Состояния для ConversationHandler
 PROJECT, OBJECT, NAME, UNIT, QUANTITY, MODULE, POSITION_DELIVERY_DATE, \
@@ -40,162 +139,3125 @@ ATTACHMENT_CHOICE, FILE_INPUT, LINK_INPUT, \
 CONFIRM_ADD_MORE, \
 EDIT_MENU, SELECT_POSITION, EDIT_FIELD_SELECTION, EDIT_FIELD_INPUT, \
 FINAL_CONFIRMATION, GLOBAL_DELIVERY_DATE_SELECTION, \
-EDITING_UNIT, EDITING_MODULE = range(19)
+EDITING_UNIT, EDITING_MODULE, \
+IMPORT_FILE = range(20)
 
-# Глобальные переменные для хранения данных пользователя и предварительно определенных списков
-user_state = {}
+# Предварительно определенные списки (черновики заявок хранятся в user_state, см. ХРАНЕНИЕ ЧЕРНОВИКОВ)
 projects = ["Stadler", "Мотели"]
 objects = ["Мерке", "Аральск", "Атырау", "Каркаролинск", "Семипалатинск"]
 modules = [f"{i+1}" for i in range(18)]
 units = ["м", "м2", "м3", "шт", "компл", "л", "кг", "тн"]
 
+# --- МОДЕЛЬ ЗАЯВКИ ---
+# Позиции и черновики - классы со __slots__ (без словаря атрибутов у каждого объекта),
+# значения проверяются при присваивании. Для хранения в базе (черновики, очередь отправки)
+# объекты сериализуются в компактный JSON: списки значений полей без повторяющихся ключей.
+
+NOT_SPECIFIED = "N/A"
+
+def _required_text(value):
+    text = str(value).strip()
+    if not text:
+        raise ValueError("значение не может быть пустым")
+    return text
+
+def _one_of(values, what):
+    def validate(value):
+        if value not in values:
+            raise ValueError(f"неизвестное значение поля {what}: {value!r}")
+        return value
+    return validate
+
+def parse_quantity(value):
+    """Количество позиции: положительное число."""
+    quantity = float(value)
+    if not (0 < quantity < float("inf")):
+        raise ValueError(f"количество должно быть положительным числом: {value!r}")
+    return quantity
+
+def parse_delivery_date(value):
+    """Дата поставки: date или строка ГГГГ-ММ-ДД."""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(value)
+
+def parse_link(value):
+    link = str(value).strip()
+    if not link.startswith(("http://", "https://")):
+        raise ValueError(f"ссылка должна начинаться с http:// или https://: {link!r}")
+    return link
+
+class Attachment:
+    """Файл (документ Telegram), прикрепленный к позиции."""
+
+    __slots__ = ("file_id", "file_unique_id", "file_name", "mime_type")
+
+    def __init__(self, file_id, file_unique_id=None, file_name=None, mime_type=None):
+        self.file_id = _required_text(file_id)
+        self.file_unique_id = file_unique_id
+        self.file_name = file_name
+        self.mime_type = mime_type
+
+    @classmethod
+    def from_document(cls, document):
+        return cls(document.file_id, document.file_unique_id, document.file_name, document.mime_type)
+
+    def to_data(self):
+        return [self.file_id, self.file_unique_id, self.file_name, self.mime_type]
+
+    @classmethod
+    def from_data(cls, data):
+        if isinstance(data, dict):
+            # Формат словарей, в котором данные хранились до появления модели
+            return cls(data["file_id"], data.get("file_unique_id"), data.get("file_name"), data.get("mime_type"))
+        return cls(*data)
+
+    def __repr__(self):
+        return f"Attachment({self.file_name!r}, file_id={self.file_id!r})"
+
+class Position:
+    """
+    Позиция заявки. Незаполненные поля равны None (позиция заполняется по шагам диалога),
+    заданные значения проверяются при присваивании. Строка сводки кэшируется в объекте
+    и сбрасывается при любом изменении позиции; файлы хранятся кортежем и добавляются
+    через add_file, поэтому изменить их в обход сброса нельзя.
+    """
+
+    __slots__ = ("name", "unit", "quantity", "module", "delivery_date", "link", "files", "_line")
+
+    _validators = {
+        "name": _required_text,
+        "unit": _one_of(units, "ед.изм."),
+        "quantity": parse_quantity,
+        "module": _one_of(modules, "модуль"),
+        "delivery_date": parse_delivery_date,
+        "link": parse_link,
+    }
+
+    def __init__(self, name, unit=None, quantity=None, module=None, delivery_date=None, link=None, files=()):
+        self.name = name
+        self.unit = unit
+        self.quantity = quantity
+        self.module = module
+        self.delivery_date = delivery_date
+        self.link = link
+        self.files = tuple(files)
+
+    def __setattr__(self, field, value):
+        validate = self._validators.get(field)
+        if validate is not None and value is not None:
+            value = validate(value)
+        object.__setattr__(self, field, value)
+        if field != "_line":
+            object.__setattr__(self, "_line", None)
+
+    def add_file(self, attachment):
+        self.files = (*self.files, attachment)
+
+    def details(self):
+        """Поля позиции для показа в виде пар (подпись, значение)."""
+        details = [
+            ("Модуль", self.module or NOT_SPECIFIED),
+            ("Наименование", self.name),
+            ("Ед.изм.", self.unit or NOT_SPECIFIED),
+            ("Количество", NOT_SPECIFIED if self.quantity is None else self.quantity),
+            ("Дата поставки", self.delivery_date.isoformat() if self.delivery_date else NOT_SPECIFIED),
+        ]
+        if self.link:
+            details.append(("Ссылка", self.link))
+        if self.files:
+            details.append(("Файлы", ", ".join(f.file_name or NOT_SPECIFIED for f in self.files)))
+        return details
+
+    def summary_line(self):
+        """Строка сводки позиции без номера (кэшируется до изменения позиции)."""
+        if self._line is None:
+            object.__setattr__(self, "_line", " | ".join(f"{label}: {value}" for label, value in self.details()))
+        return self._line
+
+    def excel_row(self):
+        """Значения столбцов B-G строки позиции в Excel."""
+        return (
+            self.name,
+            self.unit,
+            self.quantity,
+            self.delivery_date.isoformat() if self.delivery_date else "Не указано",
+            self.module,
+            self.link or "",
+        )
+
+    def to_data(self):
+        return [
+            self.name, self.unit, self.quantity, self.module,
+            self.delivery_date.isoformat() if self.delivery_date else None,
+            self.link, [f.to_data() for f in self.files],
+        ]
+
+    @classmethod
+    def from_data(cls, data):
+        if isinstance(data, dict):
+            # Формат словарей, в котором данные хранились до появления модели
+            return cls(
+                data["name"], data.get("unit"), data.get("quantity"), data.get("module"),
+                data.get("delivery_date") or None, data.get("link") or None,
+                [Attachment.from_data(f) for f in data.get("file_data") or ()],
+            )
+        name, unit, quantity, module, delivery_date, link, files = data
+        return cls(name, unit, quantity, module, delivery_date, link, [Attachment.from_data(f) for f in files])
+
+    @staticmethod
+    def name_and_unit(data):
+        """Наименование и единица измерения из сохраненных данных позиции без разбора остальных полей."""
+        if isinstance(data, dict):
+            return data.get("name"), data.get("unit")
+        return data[0], data[1]
+
+    def __repr__(self):
+        return f"Position({self.summary_line()!r})"
+
+class Draft:
+    """
+    Черновик заявки: данные пользователя, проект, объект, добавленные позиции,
+    заполняемая позиция (current) и параметры текущего редактирования.
+    """
+
+    __slots__ = (
+        "user_full_name", "telegram_id_or_username", "project", "object_name", "positions", "current",
+        "action_type", "editing_position_index", "editing_field",
+    )
+
+    # Версия формата сериализации: первый элемент списка
+    FORMAT = 1
+
+    def __init__(self, user_full_name, telegram_id_or_username, project=None, object_name=None, positions=(),
+                 current=None, action_type=None, editing_position_index=None, editing_field=None):
+        self.user_full_name = user_full_name
+        self.telegram_id_or_username = telegram_id_or_username
+        self.project = project if project is None else _one_of(projects, "проект")(project)
+        self.object_name = object_name if object_name is None else _one_of(objects, "объект")(object_name)
+        self.positions = list(positions)
+        self.current = current
+        self.action_type = action_type
+        self.editing_position_index = editing_position_index
+        self.editing_field = editing_field
+
+    def to_json(self):
+        return json.dumps([
+            self.FORMAT, self.user_full_name, self.telegram_id_or_username, self.project, self.object_name,
+            [p.to_data() for p in self.positions], self.current.to_data() if self.current else None,
+            self.action_type, self.editing_position_index, self.editing_field,
+        ], ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        if isinstance(data, dict):
+            # Формат словарей, в котором черновики хранились до появления модели
+            current = data.get("current")
+            return cls(
+                data.get("user_full_name", "Неизвестно"), data.get("telegram_id_or_username", "Неизвестно"),
+                data.get("project"), data.get("object"), [Position.from_data(p) for p in data.get("positions", [])],
+                Position.from_data(current) if current else None,
+                data.get("action_type"), data.get("editing_position_index"), data.get("editing_field"),
+            )
+        _, user_full_name, telegram_id_or_username, project, object_name, positions, current, *editing = data
+        return cls(
+            user_full_name, telegram_id_or_username, project, object_name,
+            [Position.from_data(p) for p in positions], Position.from_data(current) if current else None, *editing,
+        )
+
+# --- ИМПОРТ ПОЗИЦИЙ ---
+# Позиции из таблицы .xlsx или .csv: столбцы находятся по строке заголовков (подходит и наш
+# бланк заявки), строки читаются потоком и проверяются все сразу; ошибки собираются по строкам.
+
+IMPORT_COLUMNS = {
+    "name": ("наименование", "название", "позиция", "name"),
+    "unit": ("едизм", "единицаизмерения", "единица", "unit"),
+    "quantity": ("количество", "колво", "кол", "quantity", "qty"),
+    "module": ("модуль", "module"),
+    "delivery_date": ("датапоставки", "дата", "date", "deliverydate"),
+    "link": ("ссылка", "link", "url"),
+}
+IMPORT_COLUMN_LABELS = {
+    "name": "Наименование", "unit": "Ед. изм.", "quantity": "Кол-во",
+    "module": "Модуль", "delivery_date": "Дата поставки", "link": "Ссылка",
+}
+IMPORT_REQUIRED_COLUMNS = ("name", "unit", "quantity", "module", "delivery_date")
+IMPORT_HEADER_SCAN_ROWS = 30 # в скольких первых строках искать заголовок
+IMPORT_DATE_FORMATS = ("%d.%m.%Y", "%Y-%m-%d", "%d.%m.%y", "%d/%m/%Y")
+IMPORT_EXTENSIONS = (".xlsx", ".csv")
+
+# Написания единиц измерения, которые встречаются в заявках (после normalize_unit)
+UNIT_ALIASES = {
+    "м": ("метр", "метра", "метров", "мп", "пм", "погм"),
+    "м2": ("квм", "мкв", "кв", "квметр"),
+    "м3": ("кубм", "мкуб", "куб", "кубметр"),
+    "шт": ("штука", "штуки", "штук", "штк"),
+    "компл": ("комплект", "комплекта", "комплектов", "кт", "компл", "кмпл"),
+    "л": ("литр", "литра", "литров"),
+    "кг": ("килограмм", "килограмма", "килограммов", "кило"),
+    "тн": ("т", "тонна", "тонны", "тонн"),
+}
+
+_HEADER_CLEAN_RE = re.compile(r"[\W_]+")
+_UNIT_CLEAN_RE = re.compile(r"[\s.\-]+")
+_IMPORT_ALIASES = {alias: field for field, aliases in IMPORT_COLUMNS.items() for alias in aliases}
+_SHORT_DATE_RE = re.compile(r"(\d{1,2})[./](\d{1,2})")
+
+def normalize_unit(text):
+    return _UNIT_CLEAN_RE.sub("", text.lower().replace("ё", "е").replace("²", "2").replace("³", "3"))
+
+# Окончания, которые отбрасываются при сравнении написаний ("метрами" -> "метр", "штуку" -> "штук")
+UNIT_ENDINGS = ("ами", "ями", "ов", "ев", "ей", "ах", "ях", "ам", "ям", "ом", "ем", "ой", "ы", "и", "а", "я", "у", "ю", "е")
+
+def unit_stem(key):
+    """Написание единицы без окончания; от слова остается не меньше трех букв."""
+    for ending in UNIT_ENDINGS:
+        if key.endswith(ending) and len(key) - len(ending) >= 3:
+            return key[:-len(ending)]
+    return key
+
+def edit_distance(a, b, limit):
+    """Число правок (вставка, удаление, замена, перестановка соседних букв) или limit + 1, если их больше."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous, current = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        before, previous, current = previous, current, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+    return current[-1]
+
+_UNIT_SPELLINGS = {normalize_unit(unit): unit for unit in units}
+_UNIT_SPELLINGS.update(
+    (normalize_unit(alias), unit) for unit, aliases in UNIT_ALIASES.items() if unit in units for alias in aliases
+)
+_UNIT_STEMS = {}
+for _spelling, _unit in _UNIT_SPELLINGS.items():
+    _UNIT_STEMS.setdefault(unit_stem(_spelling), set()).add(_unit)
+
+def _single_unit(candidates):
+    return next(iter(candidates)) if len(candidates) == 1 else None
+
+@functools.lru_cache(maxsize=256)
+def match_unit(text):
+    """
+    Единица измерения из списка units по написанию пользователя: точное совпадение,
+    известное сокращение, другая форма слова ("метры" -> "м"), начало слова ("килогр" -> "кг")
+    или слово с опечаткой ("килограм" -> "кг"), если они однозначно указывают на одну единицу.
+    None, если не распознано.
+    """
+    key = normalize_unit(text)
+    if key in _UNIT_SPELLINGS:
+        return _UNIT_SPELLINGS[key]
+    if len(key) < 3:
+        return None
+    stem = unit_stem(key)
+    unit = _single_unit(_UNIT_STEMS.get(stem, ()))
+    if unit is None:
+        unit = _single_unit({unit for spelling, unit in _UNIT_SPELLINGS.items() if spelling.startswith(key)})
+    if unit is None and len(stem) >= 4:
+        # Короткие написания с опечаткой не угадываются: "метр" и "литр" отличаются двумя буквами
+        limit = 1 if len(stem) < 7 else 2
+        unit = _single_unit({
+            unit for spelling_stem, stem_units in _UNIT_STEMS.items() if len(spelling_stem) >= 4
+            and edit_distance(stem, spelling_stem, limit) <= limit for unit in stem_units
+        })
+    return unit
+
+def import_header(row):
+    """Номера столбцов {поле: индекс} для строки заголовков (None, если строка на нее не похожа)."""
+    columns = {}
+    for i, value in enumerate(row):
+        field = _IMPORT_ALIASES.get(_HEADER_CLEAN_RE.sub("", str(value)).lower()) if value is not None else None
+        if field and field not in columns:
+            columns[field] = i
+    return columns if len(columns) >= 2 and "name" in columns else None
+
+def _cell_text(value):
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+def import_unit(value):
+    unit = match_unit(_cell_text(value))
+    if unit is None:
+        raise ValueError(f"ед.изм. «{_cell_text(value)}» нет в списке ({', '.join(units)})")
+    return unit
+
+def import_module(value):
+    text = _cell_text(value)
+    if text not in modules:
+        raise ValueError(f"модуль «{text}» нет в списке (1-{len(modules)})")
+    return text
+
+def import_quantity(value):
+    try:
+        if isinstance(value, (int, float)):
+            return parse_quantity(value)
+        return parse_quantity(_cell_text(value).replace(" ", "").replace(",", "."))
+    except ValueError:
+        raise ValueError(f"количество «{_cell_text(value)}» не положительное число") from None
+
+def import_date(value):
+    if isinstance(value, (datetime, date)):
+        return parse_delivery_date(value)
+    text = _cell_text(value)
+    for date_format in IMPORT_DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).date()
+        except ValueError:
+            pass
+    if match := _SHORT_DATE_RE.fullmatch(text):
+        # День и месяц без года - ближайшая такая дата, не раньше сегодняшней
+        today = date.today()
+        day, month = int(match.group(1)), int(match.group(2))
+        for year in (today.year, today.year + 1):
+            try:
+                candidate = date(year, month, day)
+            except ValueError:
+                continue
+            if candidate >= today:
+                return candidate
+        raise ValueError(f"дата поставки «{text}»: такой даты нет в ближайший год")
+    raise ValueError(f"дата поставки «{text}» не в формате ДД.ММ.ГГГГ или ДД.ММ")
+
+def import_row(row, columns):
+    """Позиция из строки таблицы; ValueError со всеми ошибками строки через "; "."""
+    def cell(field):
+        index = columns.get(field)
+        return row[index] if index is not None and index < len(row) else None
+
+    values, errors = {}, []
+    for field, parse in (("unit", import_unit), ("quantity", import_quantity),
+                         ("module", import_module), ("delivery_date", import_date)):
+        if _cell_text(cell(field)) == "":
+            errors.append(f"не заполнено поле «{IMPORT_COLUMN_LABELS[field]}»")
+            continue
+        try:
+            values[field] = parse(cell(field))
+        except ValueError as e:
+            errors.append(str(e))
+    name = _cell_text(cell("name"))
+    if not name:
+        errors.insert(0, "не заполнено наименование")
+    link = _cell_text(cell("link")) or None
+    if link:
+        try:
+            values["link"] = parse_link(link)
+        except ValueError:
+            errors.append(f"ссылка «{link}» должна начинаться с http:// или https://")
+    if errors:
+        raise ValueError("; ".join(errors))
+    return Position(name, **values)
+
+def _xlsx_rows(data):
+    try:
+        workbook = load_workbook(BytesIO(data), read_only=True, data_only=True)
+    except zipfile.BadZipFile:
+        raise ValueError("файл не похож на книгу Excel (.xlsx)") from None
+    try:
+        yield from workbook.active.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+def _csv_rows(data):
+    for encoding in ("utf-8-sig", "cp1251"):
+        try:
+            text = data.decode(encoding)
+            break
+        except UnicodeDecodeError:
+            continue
+    else:
+        raise ValueError("не удалось определить кодировку файла, сохраните его в UTF-8")
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=";,\t")
+    except csv.Error:
+        # Excel с русской локалью сохраняет CSV через точку с запятой
+        yield from csv.reader(StringIO(text), delimiter=";")
+    else:
+        yield from csv.reader(StringIO(text), dialect)
+
+def parse_positions_file(data, file_name):
+    """
+    Разбирает файл с позициями. Возвращает список позиций и список ошибок вида
+    "Строка N: ...". ValueError - если файл целиком не подходит (нет заголовков и т.п.).
+    """
+    rows = _csv_rows(data) if file_name.lower().endswith(".csv") else _xlsx_rows(data)
+
+    positions, errors = [], []
+    columns = None
+    for number, row in enumerate(rows, start=1):
+        if columns is None:
+            columns = import_header(row)
+            if columns is None and number >= IMPORT_HEADER_SCAN_ROWS:
+                break
+            if columns is not None:
+                missing = [IMPORT_COLUMN_LABELS[field] for field in IMPORT_REQUIRED_COLUMNS if field not in columns]
+                if missing:
+                    raise ValueError(f"в заголовке нет столбцов: {', '.join(missing)}")
+            continue
+        # Пустые строки и подвал бланка (без наименования, ед.изм. и модуля) пропускаются
+        if not any(_cell_text(row[columns[field]]) for field in ("name", "unit", "module") if columns[field] < len(row)):
+            continue
+        if len(positions) >= IMPORT_MAX_POSITIONS:
+            errors.append(f"Строка {number} и следующие: не более {IMPORT_MAX_POSITIONS} позиций за один импорт")
+            break
+        try:
+            positions.append(import_row(row, columns))
+        except ValueError as e:
+            errors.append(f"Строка {number}: {e}")
+
+    if columns is None:
+        raise ValueError(
+            "не найдена строка заголовков. Нужны столбцы: "
+            + ", ".join(IMPORT_COLUMN_LABELS[field] for field in IMPORT_REQUIRED_COLUMNS) + " и, по желанию, Ссылка"
+        )
+    return positions, errors
+
+# --- БЫСТРЫЙ ВВОД ---
+# Несколько позиций одним сообщением, по строке на позицию:
+#     Кабель ВВГ 3x2.5; м; 150; 7; 25.08
+# Поля разделяются ";" или табуляцией (так копируются ячейки из Excel), ссылка - шестым полем
+# по желанию. Значения проверяются так же, как при импорте из файла.
+
+QUICK_ENTRY_COLUMNS = {field: i for i, field in enumerate(("name", "unit", "quantity", "module", "delivery_date", "link"))}
+QUICK_ENTRY_EXAMPLE = "Кабель ВВГ 3x2.5; м; 150; 7; 25.08"
+_QUICK_ENTRY_SPLIT_RE = re.compile(r"[ ]*[;\t][ ]*")
+_QUICK_ENTRY_SEPARATORS_RE = re.compile(r"[;\t\n]")
+
+def looks_like_quick_entry(text):
+    """
+    Похоже ли сообщение на быстрый ввод: есть разделители полей или несколько строк и хотя бы
+    в одной строке после наименования идет единица измерения или количество. Наименование
+    с «;» без них остается наименованием.
+    """
+    if not _QUICK_ENTRY_SEPARATORS_RE.search(text):
+        return False
+    for line in text.splitlines():
+        for field in _QUICK_ENTRY_SPLIT_RE.split(line.strip().rstrip(";").rstrip())[1:]:
+            if match_unit(field):
+                return True
+            try:
+                import_quantity(field)
+                return True
+            except ValueError:
+                pass
+    return False
+
+class QuickEntryFilter(filters.MessageFilter):
+    """Сообщения быстрого ввода; остальной текст достается обычным обработчикам состояния."""
+
+    def filter(self, message):
+        return bool(message.text) and looks_like_quick_entry(message.text)
+
+QUICK_ENTRY_FILTER = filters.TEXT & ~filters.COMMAND & QuickEntryFilter()
+
+def parse_quick_entry(text):
+    """Позиции из строк быстрого ввода. Возвращает список позиций и ошибки вида "Строка N: ..."."""
+    positions, errors = [], []
+    for number, line in enumerate(text.splitlines(), start=1):
+        line = line.strip().rstrip(";").rstrip()
+        if not line:
+            continue
+        fields = _QUICK_ENTRY_SPLIT_RE.split(line)
+        if not 5 <= len(fields) <= 6:
+            errors.append(f"Строка {number}: нужно 5 или 6 полей через «;», а не {len(fields)} (пример: {QUICK_ENTRY_EXAMPLE})")
+            continue
+        if len(positions) >= IMPORT_MAX_POSITIONS:
+            errors.append(f"Строка {number} и следующие: не более {IMPORT_MAX_POSITIONS} позиций за один раз")
+            break
+        try:
+            positions.append(import_row(fields, QUICK_ENTRY_COLUMNS))
+        except ValueError as e:
+            errors.append(f"Строка {number}: {e}")
+    return positions, errors
+
+# --- ФОРМИРОВАНИЕ EXCEL ---
+
+_ROW_RE = re.compile(r'<row r="(\d+)"([^>]*?)(/>|>(.*?)</row>)', re.S)
+_CELL_RE = re.compile(r'<c r="([A-Z]+)\d+"(([^>]*?)(?:/>|>.*?</c>))', re.S)
+_CELL_REF_RE = re.compile(r'(\$?[A-Z]{1,3}\$?)(\d+)')
+_SHIFTABLE_REF_RE = re.compile(r'( ref="|sqref="|<xm:sqref>)([^"<]*)')
+_STYLE_RE = re.compile(r' s="(\d+)"')
+_PLAIN_SI_RE = re.compile(r'<si><t(?: xml:space="preserve")?>([^<]*)</t></si>')
+_ILLEGAL_XML_CHARS_RE = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+@functools.lru_cache(maxsize=None)
+def column_letter(col):
+    """Переводит номер столбца (1, 2, ...) в буквенное обозначение (A, B, ...)."""
+    letters = ""
+    while col:
+        col, rem = divmod(col - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+def column_index(letters):
+    col = 0
+    for ch in letters:
+        col = col * 26 + ord(ch) - 64
+    return col
+
+class _SharedStrings:
+    """Общие строки книги: строки шаблона плюс добавленные при заполнении заявки."""
+
+    def __init__(self, template):
+        self._template = template
+        self._indexes = {}
+        self._added = []
+        self.references = 0
+
+    def index(self, text):
+        self.references += 1
+        idx = self._template.string_indexes.get(text)
+        if idx is None:
+            idx = self._indexes.get(text)
+        if idx is None:
+            idx = self._template.unique_strings + len(self._added)
+            self._indexes[text] = idx
+            self._added.append(text)
+        return idx
+
+    def xml(self):
+        items = []
+        for text in self._added:
+            space = ' xml:space="preserve"' if text != text.strip() else ''
+            items.append(f'<si><t{space}>{xml_escape(text)}</t></si>')
+        unique = self._template.unique_strings + len(self._added)
+        head = self._template.strings_head.replace(
+            "{count}", str(self._template.string_count + self.references)
+        ).replace("{unique}", str(unique))
+        return head + self._template.strings_body + "".join(items) + "</sst>"
+
+def shift_refs(text, from_row, extra):
+    """Сдвигает на extra строк все ссылки на ячейки в text, начиная со строки from_row."""
+    def shift(m):
+        row = int(m.group(2))
+        return f"{m.group(1)}{row + extra if row >= from_row else row}"
+    return _CELL_REF_RE.sub(shift, text)
+
+def excel_extra_rows(positions_count):
+    """Сколько строк нужно добавить в таблицу позиций шаблона, чтобы поместились все позиции."""
+    return max(0, positions_count - (EXCEL_LAST_DATA_ROW - EXCEL_FIRST_DATA_ROW + 1))
+
+class CompiledTemplate:
+    """
+    Шаблон Excel, один раз разобранный на готовые части zip-архива.
+    Для каждой заявки заново формируются только XML активного листа и sharedStrings,
+    остальные части архива копируются в сжатом виде байт в байт. Если позиций больше,
+    чем строк в таблице шаблона, таблица растягивается: строки добавляются по образцу
+    строк шаблона, подвал и ссылки на диапазоны (таблица, проверки данных, область печати)
+    сдвигаются вниз.
+    """
+
+    def __init__(self, template_bytes, first_data_row=EXCEL_FIRST_DATA_ROW, last_data_row=EXCEL_LAST_DATA_ROW):
+        self.first_data_row = first_data_row
+        self.last_data_row = last_data_row
+        with zipfile.ZipFile(BytesIO(template_bytes)) as zf:
+            self.sheet_path, sheet_name, sheet_index = self._active_sheet(zf)
+            self.strings_path = "xl/sharedStrings.xml"
+            sheet_xml = zf.read(self.sheet_path).decode("utf-8")
+            strings_xml = zf.read(self.strings_path).decode("utf-8")
+
+            # Части, которые меняются только при растягивании таблицы позиций
+            self._resizable = {"xl/workbook.xml": zf.read("xl/workbook.xml").decode("utf-8")}
+            for table_path in self._sheet_tables(zf, self.sheet_path):
+                self._resizable[table_path] = zf.read(table_path).decode("utf-8")
+            self._sheet_ref_prefixes = (f"'{sheet_name}'!", f"{sheet_name}!")
+            self._sheet_index = str(sheet_index)
+
+            # Сжатые данные каждой части архива, как они лежат в шаблоне
+            self._members = []
+            for info in zf.infolist():
+                start = info.header_offset
+                name_len, extra_len = struct.unpack("<HH", template_bytes[start + 26:start + 30])
+                data_start = start + 30 + name_len + extra_len
+                raw = template_bytes[data_start:data_start + info.compress_size]
+                self._members.append((info, raw))
+
+        self._compile_sheet(sheet_xml)
+        self._compile_strings(strings_xml)
+
+    @staticmethod
+    def _active_sheet(zf):
+        workbook = zf.read("xl/workbook.xml").decode("utf-8")
+        rels = zf.read("xl/_rels/workbook.xml.rels").decode("utf-8")
+        active = re.search(r'activeTab="(\d+)"', workbook)
+        sheet_index = int(active.group(1)) if active else 0
+        sheet_name, rel_id = re.findall(r'<sheet name="([^"]+)"[^>]*?r:id="([^"]+)"', workbook)[sheet_index]
+        target = re.search(rf'Id="{rel_id}"[^>]*?Target="([^"]+)"|Target="([^"]+)"[^>]*?Id="{rel_id}"', rels)
+        target = target.group(1) or target.group(2)
+        path = target.lstrip("/") if target.startswith("/") else f"xl/{target}"
+        return path, xml_unescape(sheet_name), sheet_index
+
+    @staticmethod
+    def _sheet_tables(zf, sheet_path):
+        folder, name = sheet_path.rsplit("/", 1)
+        rels_path = f"{folder}/_rels/{name}.rels"
+        if rels_path not in zf.namelist():
+            return []
+        rels = zf.read(rels_path).decode("utf-8")
+        return [
+            os.path.normpath(f"{folder}/{target}").replace(os.sep, "/")
+            for target in re.findall(r'Type="[^"]*/table" Target="([^"]+)"', rels)
+        ]
+
+    def _compile_sheet(self, sheet_xml):
+        start = sheet_xml.index("<sheetData>") + len("<sheetData>")
+        end = sheet_xml.index("</sheetData>")
+        self.sheet_head = sheet_xml[:start]
+        self.sheet_tail = sheet_xml[end:]
+        # Номер строки -> (XML строки, атрибуты строки, {номер столбца: (буквы, XML после ссылки, атрибут стиля)})
+        self.rows = {}
+        for m in _ROW_RE.finditer(sheet_xml, start, end):
+            cells = {}
+            for c in _CELL_RE.finditer(m.group(4) or ""):
+                style = _STYLE_RE.search(c.group(3))
+                cells[column_index(c.group(1))] = (c.group(1), c.group(2), style.group(0) if style else "")
+            self.rows[int(m.group(1))] = (m.group(0), m.group(2), cells)
+
+    def _compile_strings(self, strings_xml):
+        open_end = strings_xml.index(">", strings_xml.index("<sst")) + 1
+        head = strings_xml[:open_end]
+        head = re.sub(r' count="\d+"', ' count="{count}"', head)
+        head = re.sub(r' uniqueCount="\d+"', ' uniqueCount="{unique}"', head)
+        self.strings_head = head
+        self.strings_body = strings_xml[open_end:strings_xml.rindex("</sst>")]
+        count = re.search(r' count="(\d+)"', strings_xml[:open_end])
+        self.unique_strings = self.strings_body.count("<si>")
+        self.string_count = int(count.group(1)) if count else self.unique_strings
+        self.string_indexes = {}
+        for idx, si in enumerate(re.findall(r"<si>.*?</si>", self.strings_body, re.S)):
+            m = _PLAIN_SI_RE.fullmatch(si)
+            if m:
+                self.string_indexes.setdefault(xml_unescape(m.group(1)), idx)
+
+    @staticmethod
+    def _cell_xml(ref, style, value, strings):
+        if value is None or value == "":
+            return f'<c r="{ref}"{style}/>'
+        if isinstance(value, bool):
+            return f'<c r="{ref}"{style} t="b"><v>{int(value)}</v></c>'
+        if isinstance(value, (int, float)):
+            return f'<c r="{ref}"{style}><v>{value!r}</v></c>'
+        text = _ILLEGAL_XML_CHARS_RE.sub("", str(value))
+        return f'<c r="{ref}"{style} t="s"><v>{strings.index(text)}</v></c>'
+
+    def _shift_ranges(self, xml, extra):
+        """Сдвигает ссылки в атрибутах ref/sqref, указывающие на строки таблицы и ниже."""
+        return _SHIFTABLE_REF_RE.sub(
+            lambda m: m.group(1) + shift_refs(m.group(2), self.last_data_row, extra), xml
+        )
+
+    def _shift_defined_names(self, workbook_xml, extra):
+        def shift(m):
+            attrs, formula = m.group(1), m.group(2)
+            if f'localSheetId="{self._sheet_index}"' in attrs or formula.startswith(self._sheet_ref_prefixes):
+                formula = shift_refs(formula, self.last_data_row, extra)
+            return f"<definedName{attrs}>{formula}</definedName>"
+        return re.sub(r"<definedName([^>]*)>([^<]*)</definedName>", shift, workbook_xml)
+
+    def _source_row(self, row_num, extra):
+        """Строка шаблона, по образцу которой формируется строка row_num итогового листа."""
+        if row_num < self.first_data_row:
+            return row_num
+        last_row = self.last_data_row + extra
+        if row_num < last_row:
+            pattern = self.last_data_row - self.first_data_row
+            return self.first_data_row + (row_num - self.first_data_row) % pattern
+        if row_num == last_row:
+            return self.last_data_row
+        return row_num - extra
+
+    def _render_sheet(self, cells, extra, strings):
+        by_row = {}
+        for (row, col), value in cells.items():
+            by_row.setdefault(row, {})[col] = value
+
+        target_rows = {
+            row_num + extra if row_num > self.last_data_row else row_num
+            for row_num in self.rows
+        }
+        if extra:
+            target_rows.update(range(self.last_data_row, self.last_data_row + extra + 1))
+
+        head = self.sheet_head
+        if extra:
+            head = re.sub(r'<dimension ref="([^"]*)"',
+                          lambda m: f'<dimension ref="{shift_refs(m.group(1), self.last_data_row, extra)}"', head)
+        parts = [head]
+        for row_num in sorted(target_rows | by_row.keys()):
+            source = self._source_row(row_num, extra)
+            row_xml, row_attrs, row_cells = self.rows.get(source, (None, "", {}))
+            values = by_row.get(row_num)
+            if not values and source == row_num and row_xml is not None:
+                parts.append(row_xml)
+                continue
+            values = values or {}
+            row_parts = []
+            for col in sorted(row_cells.keys() | values.keys()):
+                if col in values:
+                    style = row_cells[col][2] if col in row_cells else ""
+                    row_parts.append(self._cell_xml(f"{column_letter(col)}{row_num}", style, values[col], strings))
+                else:
+                    letters, rest, _ = row_cells[col]
+                    row_parts.append(f'<c r="{letters}{row_num}"{rest}')
+            if row_parts:
+                parts.append(f'<row r="{row_num}"{row_attrs}>{"".join(row_parts)}</row>')
+            else:
+                parts.append(f'<row r="{row_num}"{row_attrs}/>')
+        parts.append(self._shift_ranges(self.sheet_tail, extra) if extra else self.sheet_tail)
+        return "".join(parts)
+
+    def render(self, cells, extra_rows=0):
+        """
+        Собирает книгу: cells - словарь {(строка, столбец): значение}, extra_rows - сколько строк
+        добавить в таблицу позиций. Возвращает содержимое xlsx.
+        """
+        strings = _SharedStrings(self)
+        sheet = self._render_sheet(cells, extra_rows, strings).encode("utf-8")
+        rendered = {self.sheet_path: sheet, self.strings_path: strings.xml().encode("utf-8")}
+        if extra_rows:
+            for path, xml in self._resizable.items():
+                if path == "xl/workbook.xml":
+                    xml = self._shift_defined_names(xml, extra_rows)
+                else:
+                    xml = self._shift_ranges(xml, extra_rows)
+                rendered[path] = xml.encode("utf-8")
+
+        out = BytesIO()
+        central = []
+        for info, raw in self._members:
+            data = rendered.get(info.filename)
+            if data is not None:
+                crc, size = zlib.crc32(data), len(data)
+                compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+                raw = compressor.compress(data) + compressor.flush()
+                method = zipfile.ZIP_DEFLATED
+            else:
+                crc, size, method = info.CRC, info.file_size, info.compress_type
+            name = info.filename.encode("utf-8")
+            flags = (info.flag_bits & ~0x08) | (0x800 if not info.filename.isascii() else 0)
+            y, mo, d, h, mi, sec = info.date_time
+            dos_time = (h << 11) | (mi << 5) | (sec // 2)
+            dos_date = ((y - 1980) << 9) | (mo << 5) | d
+            offset = out.tell()
+            out.write(struct.pack("<4s5H3L2H", b"PK\x03\x04", 20, flags, method, dos_time, dos_date,
+                                  crc, len(raw), size, len(name), 0))
+            out.write(name)
+            out.write(raw)
+            central.append(struct.pack("<4s6H3L5H2L", b"PK\x01\x02", 20, 20, flags, method, dos_time, dos_date,
+                                       crc, len(raw), size, len(name), 0, 0, 0, 0, info.external_attr, offset) + name)
+        cd_offset = out.tell()
+        cd = b"".join(central)
+        out.write(cd)
+        out.write(struct.pack("<4s4H2LH", b"PK\x05\x06", 0, 0, len(central), len(central), len(cd), cd_offset, 0))
+        return out.getvalue()
+
+# Содержимое template.xlsx; читается с диска один раз при запуске в каждом процессе
+_excel_template = None
+_compiled_template = None
+_excel_pool = None
+
+def _init_excel_worker(template_bytes):
+    """Инициализатор процесса пула: загружает и компилирует шаблон один раз на процесс."""
+    global _excel_template, _compiled_template
+    _excel_template = template_bytes
+    _compiled_template = CompiledTemplate(template_bytes) if EXCEL_RENDERER == "xml" else None
+
+def start_excel_pool():
+    """Загружает шаблон и запускает пул процессов для формирования Excel-файлов."""
+    global _excel_pool
+    with open(TEMPLATE_PATH, "rb") as f:
+        template_bytes = f.read()
+    _init_excel_worker(template_bytes)
+    if EXCEL_WORKERS > 0:
+        _excel_pool = ProcessPoolExecutor(
+            max_workers=EXCEL_WORKERS, initializer=_init_excel_worker, initargs=(template_bytes,)
+        )
+
+def stop_excel_pool():
+    if _excel_pool:
+        _excel_pool.shutdown(wait=True)
+
+def excel_filename(project, object_name, user_full_name):
+    sanitized_user_name = user_full_name.replace(" ", "_")
+    return f"Заявка_{project}_{object_name}_{sanitized_user_name}_{datetime.today().strftime('%Y-%m-%d')}.xlsx"
+
+def excel_cells(project, object_name, positions, user_full_name, telegram_id_or_username):
+    """
+    Возвращает значения ячеек заявки в виде {(строка, столбец): значение}:
+    дату, проект, объект, данные пользователя и по строке на каждую позицию.
+    Подвал с данными пользователя смещается вниз, если позиции не помещаются в таблицу шаблона.
+    """
+    today = datetime.today().strftime("%d.%m.%Y")
+    footer_row = 16 + excel_extra_rows(len(positions))
+    cells = {
+        (2, 7): today,
+        (3, 7): project,
+        (4, 7): object_name,
+        (footer_row, 5): user_full_name,
+        (footer_row + 1, 5): telegram_id_or_username,
+    }
+    logger.info(f"Writing to Excel: G2={today}, G3={project}, G4={object_name}, "
+                f"E{footer_row}={user_full_name}, E{footer_row + 1}={telegram_id_or_username}")
+
+    row_start_data = EXCEL_FIRST_DATA_ROW
+    for i, pos in enumerate(positions):
+        row = row_start_data + i
+
+        cells[(row, 1)] = i + 1
+        for column, value in enumerate(pos.excel_row(), start=2):
+            cells[(row, column)] = value
+        logger.debug(f"Writing position {i+1} to Excel: {pos}")
+    return cells
+
+def _render_with_openpyxl(cells, extra_rows):
+    wb = load_workbook(BytesIO(_excel_template))
+    ws = wb.active
+
+    if extra_rows:
+        # Одна вставка блока строк перед последней строкой таблицы: подвал уезжает вниз целиком
+        first, last = EXCEL_FIRST_DATA_ROW, EXCEL_LAST_DATA_ROW
+        max_row = ws.max_row
+        ws.insert_rows(last, extra_rows)
+        for row_num in range(max_row, last - 1, -1):
+            if row_num in ws.row_dimensions:
+                ws.row_dimensions[row_num + extra_rows].height = ws.row_dimensions[row_num].height
+        for row_num in range(last, last + extra_rows):
+            source = first + (row_num - first) % (last - first)
+            ws.row_dimensions[row_num].height = ws.row_dimensions[source].height
+            for cell in ws[source]:
+                if cell.has_style:
+                    ws.cell(row=row_num, column=cell.column)._style = copy(cell._style)
+        for table in ws.tables.values():
+            table.ref = shift_refs(table.ref, last, extra_rows)
+            if table.autoFilter:
+                table.autoFilter.ref = shift_refs(table.autoFilter.ref, last, extra_rows)
+        for dv in ws.data_validations.dataValidation:
+            dv.sqref = MultiCellRange(shift_refs(str(dv.sqref), last, extra_rows))
+        if ws.print_area:
+            ws.print_area = shift_refs(ws.print_area.split("!")[-1], last, extra_rows)
+
+    for (row, col), value in cells.items():
+        ws.cell(row=row, column=col).value = value
+    buffer = BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
 def fill_excel(project, object_name, positions, user_full_name, telegram_id_or_username):
     """
     Заполняет Excel-файл данными, включая дату поставки для каждой позиции, проект, объект,
     а также информацию о пользователе, от которого пришла заявка.
+    Файл формируется в памяти из загруженного шаблона; возвращает имя файла и его содержимое.
     """
-    today = datetime.today().strftime("%d.%m.%Y")
-    sanitized_user_name = user_full_name.replace(" ", "_")
-    filename = f"Заявка_{project}_{object_name}_{sanitized_user_name}_{datetime.today().strftime('%Y-%m-%d')}.xlsx"
-    output_dir = "out"
+    filename = excel_filename(project, object_name, user_full_name)
+    cells = excel_cells(project, object_name, positions, user_full_name, telegram_id_or_username)
+    extra_rows = excel_extra_rows(len(positions))
+
+    if _compiled_template is not None:
+        data = _compiled_template.render(cells, extra_rows)
+    else:
+        data = _render_with_openpyxl(cells, extra_rows)
+    logger.info(f"Excel file {filename} rendered ({len(data)} bytes, {len(positions)} positions)")
+    return filename, data
+
+async def render_excel(project, object_name, positions, user_full_name, telegram_id_or_username):
+    """Формирует Excel-файл в пуле процессов, не блокируя цикл событий."""
+    args = (project, object_name, positions, user_full_name, telegram_id_or_username)
+    if _excel_pool is None:
+        return await asyncio.to_thread(fill_excel, *args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_excel_pool, fill_excel, *args)
+
+async def archived_excel(request_id, project, object_name, positions, user_full_name, telegram_id_or_username):
+    """
+    Формирует Excel-файл заявки и сохраняет его копию в архив (если он включен и известен
+    номер заявки). Ошибка сохранения копии не мешает отправке.
+    """
+    excel_name, excel_bytes = await render_excel(project, object_name, positions, user_full_name, telegram_id_or_username)
+    if request_archive is not None and request_id is not None:
+        try:
+            await asyncio.to_thread(
+                request_archive.save, request_id, excel_name, excel_bytes,
+                project, object_name, len(positions), user_full_name, telegram_id_or_username,
+            )
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении копии Excel файла: {e}")
+    return excel_name, excel_bytes
+
+# --- ОТПРАВКА ПОЧТЫ ---
 
-    template_full_path = os.path.abspath(TEMPLATE_PATH)
+class OutgoingMail:
+    """
+    Письмо, которое собирается прямо во время отправки: вложения читаются с диска
+    блоками и кодируются в base64 на лету, поэтому ни файлы, ни готовое письмо
+    целиком в памяти не находятся. Вложение - путь к файлу или небольшие bytes.
+    """
 
-    os.makedirs(output_dir, exist_ok=True)
-    new_path = os.path.join(output_dir, filename)
+    # Кратно 57 байтам, чтобы каждый блок давал целые строки base64 по 76 символов
+    CHUNK_SIZE = 57 * 1024
+
+    def __init__(self, subject, sender, recipient, body):
+        self.sender = sender
+        self.recipients = [address for _, address in getaddresses([recipient]) if address]
+        self.boundary = f"===============_{secrets.token_hex(16)}=="
+
+        headers = EmailMessage()
+        headers["Subject"] = subject
+        headers["From"] = sender
+        headers["To"] = recipient
+        headers["MIME-Version"] = "1.0"
+        headers.add_header("Content-Type", "multipart/mixed", boundary=self.boundary)
+        self._headers = self._fold(headers)
+
+        text = MIMEPart()
+        text.set_content(body)
+        self._text = text.as_bytes(policy=email.policy.SMTP)
+        # Строки, начинающиеся с точки, удваиваются (RFC 5321, 4.5.2)
+        self._text = re.sub(rb"(?m)^\.", b"..", self._text)
+        if not self._text.endswith(b"\r\n"):
+            self._text += b"\r\n"
+        self._parts = []
+
+    @staticmethod
+    def _fold(part):
+        return b"".join(email.policy.SMTP.fold_binary(name, value) for name, value in part.items())
+
+    def attach(self, source, mime_type, filename):
+        part = MIMEPart()
+        part["Content-Type"] = mime_type
+        part["Content-Transfer-Encoding"] = "base64"
+        part.add_header("Content-Disposition", "attachment", filename=filename)
+        self._parts.append((self._fold(part), source))
+
+    def chunks(self):
+        """Генерирует письмо блоками; при каждом вызове - заново, что позволяет повторить отправку."""
+        delimiter = b"\r\n--" + self.boundary.encode() + b"\r\n"
+        # Пустая строка отделяет заголовки письма от тела
+        yield self._headers + b"\r\n" + delimiter[2:] + self._text
+        for headers, source in self._parts:
+            yield delimiter + headers + b"\r\n"
+            with open(source, "rb") if isinstance(source, str) else BytesIO(source) as f:
+                while block := f.read(self.CHUNK_SIZE):
+                    yield base64.encodebytes(block).replace(b"\n", b"\r\n")
+        yield b"\r\n--" + self.boundary.encode() + b"--\r\n"
+
+class SmtpPool:
+    """
+    Пул авторизованных SMTP-соединений, переиспользуемых между письмами.
+    Вся работа с сокетами выполняется в выделенных потоках, поэтому медленный
+    почтовый сервер не блокирует обработку обновлений других пользователей.
+    """
 
-    shutil.copy(template_full_path, new_path)
-    wb = load_workbook(new_path)
-    ws = wb.active
+    def __init__(self, host, port, login, password, size=2, timeout=30, keepalive=60, max_idle=240):
+        self.host = host
+        self.port = port
+        self.login = login
+        self.password = password
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.max_idle = max_idle
+        # Свободные соединения вместе со временем последнего использования
+        self._idle = queue.LifoQueue()
+        # Число потоков ограничивает и число одновременно открытых соединений
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="smtp")
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            server.starttls()
+            server.login(self.login, self.password)
+        except Exception:
+            server.close()
+            raise
+        logger.info(f"SMTP connection to {self.host}:{self.port} established ({threading.current_thread().name})")
+        return server
+
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except Exception:
+            server.close()
 
-    ws['G2'] = today
-    ws['G3'] = project
-    ws['G4'] = object_name
-    ws['E16'] = user_full_name
-    ws['E17'] = telegram_id_or_username
+    def _acquire(self):
+        """Берет свободное соединение из пула, проверяя его после простоя, или открывает новое."""
+        try:
+            server, last_used = self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+        idle_for = time.monotonic() - last_used
+        if idle_for > self.max_idle:
+            self._close(server)
+            return self._connect()
+        if idle_for > self.keepalive:
+            try:
+                if server.noop()[0] == 250:
+                    return server
+            except (smtplib.SMTPException, OSError) as e:
+                logger.info(f"Idle SMTP connection is dead, reconnecting: {e}")
+            self._close(server)
+            return self._connect()
+        return server
+
+    def _release(self, server):
+        self._idle.put((server, time.monotonic()))
+
+    @staticmethod
+    def _transmit(server, mail):
+        """Передает письмо командами MAIL/RCPT/DATA, записывая его в сокет по блокам."""
+        server.ehlo_or_helo_if_needed()
+        code, response = server.mail(mail.sender)
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, response, mail.sender)
+        for recipient in mail.recipients:
+            code, response = server.rcpt(recipient)
+            if code not in (250, 251):
+                raise smtplib.SMTPRecipientsRefused({recipient: (code, response)})
+        code, response = server.docmd("data")
+        if code != 354:
+            raise smtplib.SMTPDataError(code, response)
+        for chunk in mail.chunks():
+            server.send(chunk)
+        server.send(b".\r\n")
+        code, response = server.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, response)
+
+    def _send_blocking(self, mail):
+        server = self._acquire()
+        try:
+            self._transmit(server, mail)
+        except (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError) as e:
+            # Сервер закрыл соединение: переподключаемся и повторяем отправку один раз
+            logger.warning(f"SMTP connection lost while sending, retrying on a new one: {e}")
+            server.close()
+            server = self._connect()
+            try:
+                self._transmit(server, mail)
+            except Exception:
+                server.close()
+                raise
+        except Exception:
+            self._close(server)
+            raise
+        self._release(server)
+
+    async def send(self, mail):
+        """Отправляет письмо (OutgoingMail) в потоке пула, не блокируя цикл событий."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._send_blocking, mail)
+
+    def close(self):
+        """Закрывает все свободные соединения и останавливает потоки пула."""
+        self._executor.shutdown(wait=True)
+        while True:
+            try:
+                server, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._close(server)
+
+smtp_pool = SmtpPool(
+    SMTP_SERVER, SMTP_PORT, EMAIL_LOGIN, EMAIL_PASSWORD,
+    size=SMTP_POOL_SIZE, timeout=SMTP_TIMEOUT, keepalive=SMTP_KEEPALIVE, max_idle=SMTP_MAX_IDLE,
+)
 
-    logger.info(f"Writing to Excel: G2={today}, G3={project}, G4={object_name}, E16={user_full_name}, E17={telegram_id_or_username}")
+# --- КЭШ ВЛОЖЕНИЙ ---
 
+class AttachmentCache:
+    """
+    Локальный кэш файлов из Telegram, ключ - file_unique_id (один и тот же файл,
+    прикрепленный к нескольким позициям или заявкам, скачивается один раз).
+    Файлы начинают скачиваться в фоне сразу после получения документа, размер кэша
+    ограничен max_bytes: давно не использованные файлы удаляются. Файлы, которые сейчас
+    прикрепляются к письму, закреплены и не удаляются.
+    """
 
-    row_start_data = 9
-    for i, pos in enumerate(positions):
-        row = row_start_data + i
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict() # ключ -> размер файла
+        self._size = 0
+        self._downloads = {}
+        self._pinned = {}
+        self._prefetches = set()
+
+    def load(self):
+        """Восстанавливает индекс по файлам, оставшимся в каталоге с прошлого запуска."""
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".part"):
+                os.remove(entry.path)
+            elif entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+            self._size += size
+        logger.info(f"Attachment cache: {len(self._entries)} files, {self._size} bytes")
+
+    @staticmethod
+    def key(file_data):
+        return file_data.file_unique_id or file_data.file_id
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    async def _download(self, bot, file_data, key):
+        path = self.path(key)
+        part_path = f"{path}.part"
+        telegram_file = await bot.get_file(file_data.file_id)
+        await telegram_file.download_to_drive(custom_path=part_path)
+        os.replace(part_path, path)
+        size = os.path.getsize(path)
+        self._entries[key] = size
+        self._size += size
+        self._evict()
+        logger.info(f"Attachment '{file_data.file_name}' cached as {key} ({size} bytes)")
+
+    def _evict(self):
+        for key in list(self._entries):
+            if self._size <= self.max_bytes:
+                break
+            if self._pinned.get(key):
+                continue
+            size = self._entries.pop(key)
+            self._size -= size
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    async def fetch(self, bot, file_data):
+        """Возвращает путь к файлу в кэше, скачивая его при необходимости (одновременные запросы объединяются)."""
+        key = self.key(file_data)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self.path(key)
+        download = self._downloads.get(key)
+        if download is None:
+            download = self._downloads[key] = asyncio.ensure_future(self._download(bot, file_data, key))
+            download.add_done_callback(lambda _: self._downloads.pop(key, None))
+        await asyncio.shield(download)
+        return self.path(key)
+
+    def prefetch(self, bot, file_data):
+        """Запускает фоновое скачивание файла, не дожидаясь результата."""
+        async def run():
+            try:
+                await self.fetch(bot, file_data)
+            except Exception as e:
+                logger.warning(f"Prefetch of '{file_data.file_name}' failed, will retry on submission: {e}")
+        task = asyncio.create_task(run())
+        self._prefetches.add(task)
+        task.add_done_callback(self._prefetches.discard)
+
+    async def acquire(self, bot, file_data):
+        """Как fetch, но закрепляет файл в кэше до вызова release."""
+        key = self.key(file_data)
+        self._pinned[key] = self._pinned.get(key, 0) + 1
+        try:
+            return await self.fetch(bot, file_data)
+        except BaseException:
+            self.release(file_data)
+            raise
+
+    def release(self, file_data):
+        key = self.key(file_data)
+        count = self._pinned.get(key, 0) - 1
+        if count > 0:
+            self._pinned[key] = count
+        else:
+            self._pinned.pop(key, None)
+            self._evict()
+
+    async def stop(self):
+        for task in self._prefetches:
+            task.cancel()
+        await asyncio.gather(*self._prefetches, return_exceptions=True)
+
+attachment_cache = AttachmentCache(ATTACHMENT_CACHE_DIR, ATTACHMENT_CACHE_MAX_BYTES)
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(1024 * 1024):
+            digest.update(block)
+    return digest.hexdigest()
+
+def attachment_file_name(file_data, index):
+    """Имя файла вложения; у файлов без имени - file_<номер> с расширением по MIME-типу."""
+    if file_data.file_name:
+        return file_data.file_name
+    ext = mimetypes.guess_extension(file_data.mime_type or "") or ""
+    return f"file_{index}{ext}"
+
+def bundle_attachments(attachments, directory, max_bytes):
+    """
+    Упаковывает вложения в zip-архивы с папкой на каждую позицию. Одинаковые по содержимому
+    файлы (по sha256) кладутся в архив один раз. Когда очередной файл не помещается
+    в max_bytes, начинается следующий архив.
+    Возвращает пути к архивам и опись: строки вида "позиция: файл -> место в архиве".
+    """
+    stored = {} # sha256 -> (имя в архиве, номер архива)
+    used_names = set()
+    archives = []
+    manifest = []
+    archive = None
+    try:
+        for index, (pos_index, file_data, path) in enumerate(attachments, start=1):
+            file_name = attachment_file_name(file_data, index)
+            digest = file_sha256(path)
+            if digest in stored:
+                name, number = stored[digest]
+                manifest.append(f"Позиция {pos_index}: {file_name} -> {name} (архив {number}, тот же файл)")
+                continue
+
+            size = os.path.getsize(path)
+            if archive is None or (archive.infolist() and archive.fp.tell() + size > max_bytes):
+                if archive is not None:
+                    archive.close()
+                archives.append(os.path.join(directory, f"{len(archives) + 1}.zip"))
+                archive = zipfile.ZipFile(archives[-1], "w", zipfile.ZIP_DEFLATED)
+
+            name = f"Позиция_{pos_index}/{file_name}"
+            stem, ext = os.path.splitext(name)
+            copy_number = 1
+            while name in used_names:
+                copy_number += 1
+                name = f"{stem}_{copy_number}{ext}"
+            used_names.add(name)
+            archive.write(path, name)
+            stored[digest] = (name, len(archives))
+            manifest.append(f"Позиция {pos_index}: {file_name} -> {name} (архив {len(archives)})")
+    finally:
+        if archive is not None:
+            archive.close()
+    return archives, manifest
+
+def describe_error(error):
+    """Короткое описание ошибки для пользователя (у таймаутов пустой текст)."""
+    if isinstance(error, asyncio.TimeoutError):
+        return "превышено время ожидания"
+    return str(error) or error.__class__.__name__
+
+async def download_attachments(bot, files_to_attach):
+    """
+    Собирает вложения позиций. Обычно они уже скачаны в кэш заранее; недостающие
+    скачиваются из Telegram параллельно, не больше ATTACHMENT_DOWNLOAD_CONCURRENCY одновременно
+    и не дольше ATTACHMENT_DOWNLOAD_TIMEOUT на файл.
+    Возвращает пути к файлам в кэше (или исключение) в порядке files_to_attach;
+    скачанные файлы закреплены в кэше, после отправки их нужно освободить через
+    attachment_cache.release.
+    """
+    semaphore = asyncio.Semaphore(ATTACHMENT_DOWNLOAD_CONCURRENCY)
+
+    async def download(file_data):
+        async with semaphore:
+            return await asyncio.wait_for(attachment_cache.acquire(bot, file_data), timeout=ATTACHMENT_DOWNLOAD_TIMEOUT)
+
+    return await asyncio.gather(
+        *(download(file_data) for _, file_data in files_to_attach),
+        return_exceptions=True,
+    )
+
+def request_summary(project, object_name, positions, user_full_name, telegram_id_or_username):
+    """
+    Текст заявки для отдела снабжения (без вступительной фразы) и список вложений
+    в виде пар (номер позиции, file_data).
+    """
+    email_body = f"Проект: {project}\n"
+    email_body += f"Объект: {object_name}\n"
+    email_body += f"От кого: {user_full_name}\n"
+    email_body += f"Telegram ID: {telegram_id_or_username}\n\n"
+    email_body += "Позиции:\n"
+
+    files_to_attach = []
+    links_in_email = []
+
+    for i, p in enumerate(positions):
+        email_body += f"{i+1}. {p.summary_line()}\n"
+        if p.link:
+            links_in_email.append(f"Позиция {i+1} ({p.name}): {p.link}")
+        files_to_attach.extend((i+1, file_item) for file_item in p.files)
+
+    if links_in_email:
+        email_body += "\nОтдельные ссылки для позиций:\n" + "\n".join(links_in_email) + "\n"
+    return email_body, files_to_attach
+
+async def send_email(chat_id, project, object_name, positions, user_full_name, telegram_id_or_username, bot=None,
+                     request_id=None):
+    """
+    Отправляет сгенерированный Excel-файл по электронной почте,
+    с возможностью прикрепления дополнительных файлов и ссылок, привязанных к позициям,
+    а также информацией о пользователе. request_id - номер заявки для архива.
+    """
+    summary, files_to_attach = request_summary(project, object_name, positions, user_full_name, telegram_id_or_username)
+    email_body = "Во вложении заявка на снабжение.\n\n" + summary
+
+    # Excel формируется, пока скачиваются вложения
+    excel_task = asyncio.create_task(
+        archived_excel(request_id, project, object_name, positions, user_full_name, telegram_id_or_username)
+    )
+    downloads = await download_attachments(bot, files_to_attach) if bot else []
+    try:
+        return await _send_collected(
+            chat_id, project, object_name, email_body, excel_task, files_to_attach, downloads,
+        )
+    finally:
+        for (_, file_data), result in zip(files_to_attach, downloads):
+            if not isinstance(result, Exception):
+                attachment_cache.release(file_data)
+
+async def _send_collected(chat_id, project, object_name, email_body, excel_task, files_to_attach, downloads):
+    attachments = []
+    for (pos_index, file_data), result in zip(files_to_attach, downloads):
+        file_name = file_data.file_name or NOT_SPECIFIED
+        if isinstance(result, Exception):
+            logger.error(f"Ошибка при скачивании файла '{file_name}' для позиции {pos_index}: {result!r}")
+            email_body += f"\n\nВнимание: Не удалось прикрепить файл '{file_name}' для позиции {pos_index} из-за ошибки: {describe_error(result)}"
+        else:
+            attachments.append((pos_index, file_data, result))
+
+    if BUNDLE_ATTACHMENTS and attachments:
+        with tempfile.TemporaryDirectory(prefix="bundle_") as directory:
+            archives, manifest = await asyncio.to_thread(bundle_attachments, attachments, directory, BUNDLE_MAX_BYTES)
+            email_body += (
+                f"\n\nВложения упакованы в zip-архив ({len(archives)} шт.), "
+                f"одинаковые файлы включены один раз:\n" + "\n".join(manifest) + "\n"
+            )
+            return await _send_mails(chat_id, project, object_name, email_body, excel_task, [], archives)
+    return await _send_mails(chat_id, project, object_name, email_body, excel_task, attachments, [])
+
+async def _send_mails(chat_id, project, object_name, email_body, excel_task, attachments, archives):
+    """
+    Отправляет заявку: Excel, отдельные вложения и первый архив - в основном письме,
+    остальные архивы - следующими письмами с номером в теме.
+    """
+    subject = f"Заявка на снабжение: {project} - {object_name}"
+    total = max(len(archives), 1)
+    if total > 1:
+        email_body += f"\nАрхив с вложениями разделен на {total} части, они отправлены отдельными письмами.\n"
+    msg = OutgoingMail(subject if total == 1 else f"{subject} (письмо 1 из {total})", EMAIL_LOGIN, EMAIL_RECEIVER, email_body)
+    logger.info(f"Email body generated for chat_id {chat_id}: \n{email_body}")
+
+    try:
+        excel_name, excel_bytes = await excel_task
+        msg.attach(excel_bytes, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", excel_name)
+        logger.info(f"Excel file '{excel_name}' прикреплен к письму")
+    except Exception as e:
+        logger.error(f"Ошибка при создании или прикреплении Excel файла: {e}")
+
+    for index, (pos_index, file_data, path) in enumerate(attachments, start=1):
+        file_name = attachment_file_name(file_data, index)
+        mime_type = file_data.mime_type or "application/octet-stream"
+        msg.attach(path, mime_type, f"Позиция_{pos_index}_{file_name}")
+        logger.info(f"Дополнительный файл '{file_name}' для позиции {pos_index} прикреплен к письму")
+
+    mails = [msg]
+    for number, archive_path in enumerate(archives, start=1):
+        archive_name = "Вложения.zip" if total == 1 else f"Вложения_{number}_из_{total}.zip"
+        if number > 1:
+            msg = OutgoingMail(
+                f"{subject} (письмо {number} из {total})", EMAIL_LOGIN, EMAIL_RECEIVER,
+                f"Продолжение заявки на снабжение: {project} - {object_name}.\n"
+                f"Во вложении часть {number} из {total} архива с файлами позиций.\n",
+            )
+            mails.append(msg)
+        msg.attach(archive_path, "application/zip", archive_name)
+
+    try:
+        for msg in mails:
+            await smtp_pool.send(msg)
+        logger.info(f"Письмо успешно отправлено на {EMAIL_RECEIVER}")
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при отправке письма: {e}")
+        raise
+
+# --- ДОСТАВКА В TELEGRAM ---
+
+def delivery_backend(project):
+    """Способ доставки заявки для проекта: "email" или "telegram"."""
+    return PROJECT_DELIVERY.get(project, DELIVERY_BACKEND)
+
+def split_message(text, limit=MessageLimit.MAX_TEXT_LENGTH):
+    """Делит длинный текст на сообщения по границам строк."""
+    chunks = []
+    current = ""
+    for line in text.splitlines(keepends=True):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if len(current) + len(line) > limit:
+            chunks.append(current)
+            current = ""
+        current += line
+    if current.strip():
+        chunks.append(current)
+    return chunks
+
+async def send_to_chat(bot, project, object_name, positions, user_full_name, telegram_id_or_username, request_id=None,
+                       progress=0, on_progress=None):
+    """
+    Публикует заявку в чате отдела снабжения: текст заявки, Excel-файл и вложения позиций.
+    Вложения пересылаются по их file_id группами до 10 документов, поэтому файлы
+    не скачиваются и не загружаются ботом заново. request_id - номер заявки для архива.
+
+    Доставка идет по шагам: части текста, Excel-файл, группы вложений. После каждого шага
+    вызывается on_progress(число выполненных шагов), а при повторе шаги до progress
+    пропускаются, поэтому после сбоя в чат досылается только недостающее. Повторно может
+    прийти лишь шаг, на котором случился сбой (если Telegram принял его, но не ответил).
+    """
+    if not PROCUREMENT_CHAT_ID:
+        raise RuntimeError("не задан PROCUREMENT_CHAT_ID")
+
+    summary, files_to_attach = request_summary(project, object_name, positions, user_full_name, telegram_id_or_username)
+    chunks = split_message(f"Заявка на снабжение\n\n{summary}")
+    documents = [
+        (file_data.file_id, f"Позиция {pos_index}: {file_data.file_name or NOT_SPECIFIED}")
+        for pos_index, file_data in files_to_attach
+    ]
+    groups = [documents[start:start + 10] for start in range(0, len(documents), 10)]
+
+    async def done(step):
+        if on_progress:
+            await on_progress(step + 1)
+
+    excel_step = len(chunks)
+    excel_task = None
+    if progress <= excel_step:
+        excel_task = asyncio.create_task(
+            archived_excel(request_id, project, object_name, positions, user_full_name, telegram_id_or_username)
+        )
+    try:
+        for step, chunk in enumerate(chunks):
+            if step >= progress:
+                await bot.send_message(chat_id=PROCUREMENT_CHAT_ID, text=chunk)
+                await done(step)
+    except BaseException:
+        if excel_task is not None:
+            excel_task.cancel()
+        raise
+
+    if excel_task is not None:
+        try:
+            excel_name, excel_bytes = await excel_task
+        except Exception as e:
+            # Без Excel-файла заявка не доставлена: попытка завершается ошибкой и будет повторена с этого шага
+            logger.error(f"Ошибка при создании Excel файла: {e}")
+            raise
+        await bot.send_document(chat_id=PROCUREMENT_CHAT_ID, document=InputFile(excel_bytes, filename=excel_name))
+        await done(excel_step)
+
+    for step, group in enumerate(groups, start=excel_step + 1):
+        if step < progress:
+            continue
+        if len(group) == 1:
+            # В группе должно быть хотя бы два документа
+            file_id, caption = group[0]
+            await bot.send_document(chat_id=PROCUREMENT_CHAT_ID, document=file_id, caption=caption)
+        else:
+            await bot.send_media_group(
+                chat_id=PROCUREMENT_CHAT_ID,
+                media=[InputMediaDocument(file_id, caption=caption) for file_id, caption in group],
+            )
+        await done(step)
+    if progress:
+        logger.info(f"Заявка {project} - {object_name}: доставка продолжена с шага {progress + 1}")
+    logger.info(f"Заявка {project} - {object_name} опубликована в чате {PROCUREMENT_CHAT_ID}, вложений: {len(documents)}")
+    return True
+
+async def deliver_request(bot, chat_id, request, request_id=None, progress=0, on_progress=None):
+    """
+    Доставляет заявку из очереди способом, выбранным для ее проекта. progress и on_progress -
+    выполненные шаги доставки в чат (см. send_to_chat); письмо отправляется целиком.
+    """
+    args = (
+        request["project"],
+        request["object"],
+        [Position.from_data(p) for p in request["positions"]],
+        request["user_full_name"],
+        request["telegram_id_or_username"],
+    )
+    if delivery_backend(request["project"]) == "telegram":
+        return await send_to_chat(bot, *args, request_id=request_id, progress=progress, on_progress=on_progress)
+    return await send_email(chat_id, *args, bot=bot, request_id=request_id)
+
+# --- ОЧЕРЕДЬ ОТПРАВКИ ---
+
+def shard_filter(shard_index, shard_count):
+    """Условие SQL (и его параметры), отбирающее строки чатов одного шарда."""
+    if shard_count <= 1:
+        return "", ()
+    return " AND abs(chat_id) % ? = ?", (shard_count, shard_index)
+
+def open_db(path):
+    """Открывает базу SQLite в режиме WAL, общую для всех потоков бота."""
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.row_factory = sqlite3.Row
+    return conn
+
+class Outbox:
+    """
+    Постоянная очередь заявок на отправку. Заявка сначала сохраняется в SQLite,
+    а затем отправляется фоновым обработчиком с повторами. Заявки, которые так и не
+    удалось отправить, остаются в таблице со статусом 'dead'.
+    При нескольких процессах каждый обрабатывает только заявки своего шарда чатов.
+    Все методы блокирующие и вызываются через asyncio.to_thread.
+    """
+
+    def __init__(self, path, shard_index=0, shard_count=1):
+        self._conn = open_db(path)
+        self._lock = threading.Lock()
+        self._shard_sql, self._shard_args = shard_filter(shard_index, shard_count)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                sent_at REAL,
+                progress INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at);
+        """)
+        # Таблица, созданная до появления столбца progress
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(outbox)")}
+        if "progress" not in columns:
+            self._conn.execute("ALTER TABLE outbox ADD COLUMN progress INTEGER NOT NULL DEFAULT 0")
+
+    def enqueue(self, chat_id, message_id, payload):
+        now = time.time()
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO outbox (chat_id, message_id, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)",
+                (chat_id, message_id, json.dumps(payload, ensure_ascii=False), now, now),
+            )
+        return cur.lastrowid
+
+    def recover(self):
+        """Возвращает в очередь заявки, отправка которых прервалась из-за остановки бота."""
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE outbox SET status = 'pending' WHERE status = 'sending'" + self._shard_sql, self._shard_args
+            )
+        return cur.rowcount
+
+    def claim_due(self, limit):
+        """Забирает готовые к отправке заявки, помечая их как отправляемые."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT * FROM outbox WHERE status = 'pending' AND next_attempt_at <= ?" + self._shard_sql
+                    + " ORDER BY id LIMIT ?",
+                    (now, *self._shard_args, limit),
+                ).fetchall()
+                self._conn.executemany(
+                    "UPDATE outbox SET status = 'sending' WHERE id = ?", [(row["id"],) for row in rows]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return rows
+
+    def next_due_in(self):
+        """Сколько секунд осталось до ближайшей отложенной попытки (None, если очередь пуста)."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'" + self._shard_sql, self._shard_args
+            ).fetchone()
+        if row[0] is None:
+            return None
+        return max(0.0, row[0] - time.time())
+
+    def set_progress(self, entry_id, progress):
+        """Запоминает, сколько шагов доставки заявки уже выполнено (см. send_to_chat)."""
+        with self._lock:
+            self._conn.execute("UPDATE outbox SET progress = ? WHERE id = ?", (progress, entry_id))
+
+    def mark_sent(self, entry_id, attempts):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE outbox SET status = 'sent', attempts = ?, sent_at = ?, last_error = NULL WHERE id = ?",
+                (attempts, time.time(), entry_id),
+            )
+
+    def mark_failed(self, entry_id, attempts, error):
+        """Планирует повтор с экспоненциальной задержкой или переводит заявку в 'dead'."""
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            status, next_attempt_at = 'dead', time.time()
+        else:
+            delay = min(OUTBOX_RETRY_BASE * 2 ** (attempts - 1), OUTBOX_RETRY_MAX)
+            status, next_attempt_at = 'pending', time.time() + delay * random.uniform(0.8, 1.2)
+        with self._lock:
+            self._conn.execute(
+                "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (status, attempts, next_attempt_at, error, entry_id),
+            )
+        return status
+
+    def requests_after(self, last_id, limit):
+        """Заявки всех шардов с номером больше last_id (для индекса наименований)."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, payload FROM outbox WHERE id > ? ORDER BY id LIMIT ?", (last_id, limit)
+            ).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class OutboxWorker:
+    """Фоновая задача, которая разбирает очередь отправки и сообщает пользователям результат."""
+
+    def __init__(self, outbox):
+        self.outbox = outbox
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+        self._task = None
+        self._deliveries = set()
+
+    def start(self, bot):
+        self._task = asyncio.create_task(self._run(bot))
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def stop(self):
+        tasks = [t for t in [self._task, *self._deliveries] if t]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, bot):
+        recovered = await asyncio.to_thread(self.outbox.recover)
+        if recovered:
+            logger.info(f"Outbox: {recovered} interrupted request(s) returned to the queue")
+        while True:
+            try:
+                rows = await asyncio.to_thread(self.outbox.claim_due, OUTBOX_CONCURRENCY)
+                for row in rows:
+                    task = asyncio.create_task(self._deliver(bot, row))
+                    self._deliveries.add(task)
+                    task.add_done_callback(self._deliveries.discard)
+                timeout = await asyncio.to_thread(self.outbox.next_due_in)
+            except Exception as e:
+                logger.error(f"Outbox: ошибка при разборе очереди: {e}")
+                timeout = None
+            timeout = OUTBOX_POLL_INTERVAL if timeout is None else min(timeout, OUTBOX_POLL_INTERVAL)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _deliver(self, bot, row):
+        entry_id = row["id"]
+        chat_id = row["chat_id"]
+        request = json.loads(row["payload"])
+        attempts = row["attempts"] + 1
+
+        by_email = delivery_backend(request["project"]) != "telegram"
+
+        async def save_progress(progress):
+            await asyncio.to_thread(self.outbox.set_progress, entry_id, progress)
+
+        async with self._semaphore:
+            try:
+                await deliver_request(bot, chat_id, request, entry_id, row["progress"], save_progress)
+            except Exception as e:
+                status = await asyncio.to_thread(self.outbox.mark_failed, entry_id, attempts, str(e))
+                if request_archive is not None:
+                    await asyncio.to_thread(request_archive.set_status, entry_id, status)
+                logger.error(f"Outbox: попытка {attempts} отправки заявки №{entry_id} не удалась ({status}): {e}")
+                # Пересчитываем время ожидания с учетом нового срока повтора
+                self.wake()
+                if status == 'dead':
+                    text = (f"Не удалось отправить заявку №{entry_id} после {attempts} попыток: {e}\n"
+                            f"Пожалуйста, сообщите в отдел снабжения.")
+                elif attempts == 1:
+                    service = "почтовый сервер" if by_email else "Telegram"
+                    text = f"Заявка №{entry_id} сохранена, но {service} сейчас недоступен. Отправка будет повторена автоматически."
+                else:
+                    text = None
+            else:
+                await asyncio.to_thread(self.outbox.mark_sent, entry_id, attempts)
+                if request_archive is not None:
+                    await asyncio.to_thread(request_archive.set_status, entry_id, 'sent')
+                logger.info(f"Outbox: заявка №{entry_id} отправлена с попытки {attempts}")
+                destination = "на почту в отдел снабжения" if by_email else "в чат отдела снабжения"
+                text = f"Заявка №{entry_id} успешно отправлена {destination}!"
+
+        if text and row["message_id"]:
+            try:
+                await bot.edit_message_text(chat_id=chat_id, message_id=row["message_id"], text=text)
+            except Exception as e:
+                logger.warning(f"Failed to report delivery result to chat {chat_id}: {e}")
+
+# Создаются в open_storage() при запуске бота, а не при импорте модуля
+outbox = None
+outbox_worker = None
+
+# --- ИСТОРИЯ ЗАЯВОК ---
+
+class RequestHistory:
+    """
+    Отправленные заявки для повтора: позиции заявки по ее номеру (номер тот же, что
+    в очереди отправки), последние заявки пользователя и последняя заявка по проекту
+    и объекту. Каждое чтение - один поиск по индексу, сколько бы заявок ни накопилось.
+    """
+
+    def __init__(self, path):
+        self._conn = open_db(path)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS request_history (
+                    id INTEGER PRIMARY KEY,
+                    chat_id INTEGER NOT NULL,
+                    project TEXT NOT NULL,
+                    object TEXT NOT NULL,
+                    position_count INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    positions TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS request_history_chat ON request_history (chat_id, id);
+                CREATE INDEX IF NOT EXISTS request_history_scope ON request_history (project, object, id);
+            """)
+
+    def catch_up(self):
+        """
+        Переносит из очереди отправки заявки, которых еще нет в истории: отправленные до ее
+        появления и те, что не записались в историю из-за ошибки или остановки бота.
+        Пропуски ищутся по всей очереди, а не только после последней записанной заявки:
+        следующие заявки (в том числе других шардов) могли записаться раньше.
+        """
+        with self._lock:
+            cur = self._conn.execute("""
+                INSERT OR IGNORE INTO request_history (id, chat_id, project, object, position_count, created_at, positions)
+                SELECT o.id, o.chat_id, json_extract(o.payload, '$.project'), json_extract(o.payload, '$.object'),
+                       json_array_length(o.payload, '$.positions'), o.created_at, json_extract(o.payload, '$.positions')
+                FROM outbox o
+                WHERE NOT EXISTS (SELECT 1 FROM request_history h WHERE h.id = o.id) AND json_valid(o.payload)
+            """)
+            return cur.rowcount
+
+    def record(self, entry_id, chat_id, request):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO request_history (id, chat_id, project, object, position_count, created_at, positions)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (entry_id, chat_id, request["project"], request["object"], len(request["positions"]), time.time(),
+                 json.dumps(request["positions"], ensure_ascii=False, separators=(",", ":"))),
+            )
+
+    def get(self, entry_id):
+        with self._lock:
+            return self._conn.execute("SELECT * FROM request_history WHERE id = ?", (entry_id,)).fetchone()
+
+    def last_for_scope(self, project, object_name):
+        """Последняя заявка по проекту и объекту (от любого пользователя)."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT * FROM request_history WHERE project = ? AND object = ? ORDER BY id DESC LIMIT 1",
+                (project, object_name),
+            ).fetchone()
+
+    def recent_for_chat(self, chat_id, limit):
+        """Последние заявки пользователя, без позиций."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, project, object, position_count, created_at FROM request_history"
+                " WHERE chat_id = ? ORDER BY id DESC LIMIT ?",
+                (chat_id, limit),
+            ).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+request_history = None # создается в open_storage()
+
+# --- АРХИВ ЗАЯВОК ---
+
+ARCHIVE_UNSAFE_CHARS = re.compile(r'[\\/:*?"<>|\x00-\x1f]')
+# Имя файла заявки, сохраненного до появления архива (см. excel_filename)
+LEGACY_ARCHIVE_NAME = re.compile(r"Заявка_.+_\d{4}-\d{2}-\d{2}\.xlsx")
+
+class RequestArchive:
+    """
+    Архив сформированных Excel-файлов заявок. Файл лежит в папке ГГГГ/ММ/ДД и называется
+    по номеру заявки, поэтому две заявки одного пользователя за день не затирают друг
+    друга, а повторная попытка отправки той же заявки перезаписывает только свой файл.
+    Сведения о файлах (пользователь, проект, объект, число позиций, размер, статус
+    доставки) хранятся в таблице archive. Фоновая очистка удаляет файлы старше
+    retention_days и самые старые сверх max_bytes, а также опустевшие папки. Если база
+    переведена в режим auto_vacuum=INCREMENTAL (RUN_MODE=vacuum), после очистки освободившиеся
+    страницы возвращаются системе.
+    """
+
+    def __init__(self, path, directory, retention_days=0, max_bytes=0, cleanup_interval=3600):
+        self.directory = directory
+        self.retention_days = retention_days
+        self.max_bytes = max_bytes
+        self.cleanup_interval = cleanup_interval
+        self._conn = open_db(path)
+        self._lock = threading.Lock()
+        self._task = None
+        with self._lock:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS archive (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    request_id INTEGER UNIQUE, -- номер в очереди отправки; NULL - файл из прежнего архива
+                    path TEXT NOT NULL, -- относительно каталога архива
+                    user_full_name TEXT,
+                    telegram_id_or_username TEXT,
+                    project TEXT,
+                    object TEXT,
+                    position_count INTEGER,
+                    size INTEGER NOT NULL,
+                    status TEXT, -- статус доставки, как в очереди отправки
+                    created_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS archive_created ON archive (created_at);
+                CREATE INDEX IF NOT EXISTS archive_scope ON archive (project, object, created_at);
+            """)
+
+    def save(self, request_id, file_name, data, project, object_name, position_count, user_full_name, telegram_id_or_username):
+        """Сохраняет Excel-файл заявки (целиком или никак) и возвращает путь к нему."""
+        with self._lock:
+            row = self._conn.execute("SELECT path FROM archive WHERE request_id = ?", (request_id,)).fetchone()
+        if row is not None:
+            relative = row["path"]
+        else:
+            relative = os.path.join(
+                datetime.now().strftime(os.path.join("%Y", "%m", "%d")),
+                f"{request_id:06d}_{ARCHIVE_UNSAFE_CHARS.sub('_', file_name)}",
+            )
+        path = os.path.join(self.directory, relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix=".part", delete=False) as f:
+            f.write(data)
+        os.replace(f.name, path)
+
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO archive (request_id, path, user_full_name, telegram_id_or_username, project, object,"
+                " position_count, size, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'sending', ?)"
+                " ON CONFLICT (request_id) DO UPDATE SET size = excluded.size",
+                (request_id, relative, user_full_name, telegram_id_or_username, project, object_name,
+                 position_count, len(data), time.time()),
+            )
+        logger.info(f"Excel file saved to: {path}")
+        return path
+
+    def set_status(self, request_id, status):
+        """Отмечает статус доставки заявки; ошибка только записывается в журнал."""
+        try:
+            with self._lock:
+                self._conn.execute("UPDATE archive SET status = ? WHERE request_id = ?", (status, request_id))
+        except sqlite3.Error as e:
+            logger.warning(f"Archive: failed to update status of request #{request_id}: {e}")
+
+    def adopt_legacy_files(self):
+        """
+        Переносит файлы, сохраненные до появления архива прямо в его каталог, в папки по дате
+        изменения и учитывает их в таблице, чтобы на них тоже действовала очистка.
+        Переносятся только файлы с именами, которые давал заявкам бот (LEGACY_ARCHIVE_NAME).
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        adopted = 0
+        for entry in os.scandir(self.directory):
+            if not (entry.is_file() and LEGACY_ARCHIVE_NAME.fullmatch(entry.name)):
+                continue
+            stat = entry.stat()
+            relative = os.path.join(datetime.fromtimestamp(stat.st_mtime).strftime(os.path.join("%Y", "%m", "%d")), entry.name)
+            os.makedirs(os.path.join(self.directory, os.path.dirname(relative)), exist_ok=True)
+            os.replace(entry.path, os.path.join(self.directory, relative))
+            with self._lock:
+                self._conn.execute(
+                    "INSERT INTO archive (path, size, created_at) VALUES (?, ?, ?)", (relative, stat.st_size, stat.st_mtime)
+                )
+            adopted += 1
+        return adopted
+
+    def _remove(self, rows):
+        for row in rows:
+            path = os.path.join(self.directory, row["path"])
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            # Удаляем опустевшие папки дня, месяца и года
+            directory = os.path.dirname(path)
+            while os.path.normpath(directory) != os.path.normpath(self.directory):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+                directory = os.path.dirname(directory)
+        with self._lock:
+            self._conn.executemany("DELETE FROM archive WHERE id = ?", [(row["id"],) for row in rows])
+
+    def cleanup(self):
+        """Удаляет файлы старше retention_days и самые старые сверх max_bytes; возвращает их число."""
+        removed = 0
+        if self.retention_days:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT id, path FROM archive WHERE created_at < ?", (time.time() - self.retention_days * 24 * 3600,)
+                ).fetchall()
+            self._remove(rows)
+            removed += len(rows)
+        if self.max_bytes:
+            with self._lock:
+                excess = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM archive").fetchone()[0] - self.max_bytes
+                rows = []
+                if excess > 0:
+                    for row in self._conn.execute("SELECT id, path, size FROM archive ORDER BY created_at"):
+                        rows.append(row)
+                        excess -= row["size"]
+                        if excess <= 0:
+                            break
+            self._remove(rows)
+            removed += len(rows)
+        return removed
+
+    def compact(self):
+        """
+        Возвращает системе свободные страницы базы, если она в режиме auto_vacuum=INCREMENTAL;
+        иначе они остаются в базе и используются для новых строк.
+        """
+        with self._lock:
+            if self._conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                return
+            # executescript проходит команду до конца: execute освободил бы одну страницу
+            self._conn.executescript("PRAGMA incremental_vacuum")
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        adopted = await asyncio.to_thread(self.adopt_legacy_files)
+        if adopted:
+            logger.info(f"Archive: {adopted} file(s) from the old flat layout moved into date folders")
+        while True:
+            try:
+                removed = await asyncio.to_thread(self.cleanup)
+                if removed:
+                    await asyncio.to_thread(self.compact)
+                    logger.info(f"Archive: {removed} old file(s) removed")
+            except Exception as e:
+                logger.error(f"Archive: ошибка при очистке: {e}")
+            await asyncio.sleep(self.cleanup_interval)
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        with self._lock:
+            self._conn.close()
+
+request_archive = None # создается в open_storage(), если задан ARCHIVE_DIR
+
+# --- ИНДЕКС НАИМЕНОВАНИЙ ---
+
+def name_key(name):
+    """Ключ наименования для поиска: без учета регистра, разницы между ё и е и лишних пробелов."""
+    return " ".join(name.casefold().replace("ё", "е").split())
+
+def name_trigrams(key):
+    """Триграммы слов ключа (через пробел между словами триграммы не строятся)."""
+    return {word[i:i + 3] for word in key.split() for i in range(len(word) - 2)}
+
+class NameIndex:
+    """
+    Наименования позиций из всех заявок в очереди отправки - для подсказок в inline-запросах.
+
+    Данные наименований хранятся в плотных массивах по номеру, а номера при перестроении
+    индекса раздаются по убыванию частоты. Запрос короче трех букв ищется по спискам
+    наименований с теми же первыми буквами, более длинный - по триграммам: берется самый
+    короткий список наименований с одной из триграмм запроса и в них проверяется вхождение
+    слов. Списки упорядочены по частоте, поэтому просмотр останавливается, набрав
+    SCAN_MATCHES совпадений, и время поиска не растет с размером индекса. Из найденного
+    выше наименования, которые начинаются с запроса, затем чаще встречавшиеся в заявках
+    выбранного проекта и объекта, затем чаще встречавшиеся вообще.
+
+    Индекс пополняется из очереди отправки (refresh) и держит не больше max_names
+    наименований: при переполнении самые редкие вытесняются.
+    """
+
+    MAX_NAME_LENGTH = 200 # длиннее наименования в индекс не попадают целиком
+    SCAN_MATCHES = 200 # сколько самых частых совпадений ранжировать по проекту и объекту
+    PREFIX_LENGTH = 2 # длина начала наименования в списках для коротких запросов
+
+    def __init__(self, max_names):
+        self.max_names = max_names
+        self.last_id = 0
+        self.refreshed_at = None
+        self._lock = asyncio.Lock()
+        self._clear()
+
+    def _clear(self):
+        self._ids = {} # ключ -> номер
+        self._names = [] # номер -> наименование в том виде, в каком его ввели впервые
+        self._keys = []
+        self._counts = array("I") # номер -> сколько раз встречалось
+        self._units = [] # номер -> обычная единица измерения
+        self._unit_votes = array("i")
+        self._scopes = {} # (проект, объект) -> array: номер -> сколько раз встречалось
+        self._prefixes = {} # первые буквы ключа -> array номеров
+        self._trigrams = {} # триграмма -> array номеров
+        self._indexed = 0 # наименования с меньшими номерами есть в _prefixes и _trigrams
+        self._bumps = 0 # сколько раз наименования встретились с последнего перестроения
+
+    def __len__(self):
+        return len(self._names)
+
+    def _add(self, name, unit, scope):
+        key = name_key(name)[:self.MAX_NAME_LENGTH]
+        if not key:
+            return
+        i = self._ids.get(key)
+        if i is None:
+            i = self._ids[key] = len(self._names)
+            self._names.append(" ".join(name.split())[:self.MAX_NAME_LENGTH])
+            self._keys.append(key)
+            self._counts.append(0)
+            self._units.append(unit)
+            self._unit_votes.append(0)
+        self._counts[i] += 1
+        self._bumps += 1
+        # Обычная единица измерения выбирается голосованием большинства (алгоритм Бойера-Мура):
+        # так не нужен отдельный счетчик для каждой единицы каждого наименования
+        if unit is not None:
+            if unit == self._units[i]:
+                self._unit_votes[i] += 1
+            elif self._unit_votes[i] == 0:
+                self._units[i] = unit
+                self._unit_votes[i] = 1
+            else:
+                self._unit_votes[i] -= 1
+        if scope is not None:
+            scoped = self._scopes.get(scope)
+            if scoped is None:
+                scoped = self._scopes[scope] = array("I")
+            if len(scoped) <= i:
+                scoped.frombytes(bytes(scoped.itemsize * (len(self._names) - len(scoped))))
+            scoped[i] += 1
+
+    def _index_new(self):
+        """Добавляет в списки поиска новые наименования (с конца - они пока самые редкие)."""
+        for i in range(self._indexed, len(self._names)):
+            key = self._keys[i]
+            for gram in name_trigrams(key):
+                postings = self._trigrams.get(gram)
+                if postings is None:
+                    self._trigrams[gram] = array("I", (i,))
+                else:
+                    postings.append(i)
+            for length in range(1, min(len(key), self.PREFIX_LENGTH) + 1):
+                postings = self._prefixes.get(key[:length])
+                if postings is None:
+                    self._prefixes[key[:length]] = array("I", (i,))
+                else:
+                    postings.append(i)
+        self._indexed = len(self._names)
+
+    def _needs_rebuild(self):
+        # Много новых наименований (например, при запуске), переполнение или частоты
+        # заметно изменились с последнего перестроения
+        return (len(self._names) - self._indexed > 32 or len(self._names) > self.max_names
+                or self._bumps > max(len(self._names) // 4, 1000))
+
+    def _rebuilt(self):
+        """Новый индекс с номерами по убыванию частоты и без самых редких наименований при переполнении."""
+        order = sorted(range(len(self._names)), key=self._counts.__getitem__, reverse=True)
+        if len(order) > self.max_names:
+            order = order[:int(self.max_names * 0.9)]
+            logger.info(f"Индекс наименований: вытеснено {len(self._names) - len(order)} редких наименований")
+        fresh = NameIndex(self.max_names)
+        fresh._names = [self._names[i] for i in order]
+        fresh._keys = [self._keys[i] for i in order]
+        fresh._ids = {key: i for i, key in enumerate(fresh._keys)}
+        fresh._counts = array("I", (self._counts[i] for i in order))
+        fresh._units = [self._units[i] for i in order]
+        fresh._unit_votes = array("i", (self._unit_votes[i] for i in order))
+        for scope, scoped in self._scopes.items():
+            fresh._scopes[scope] = array("I", (scoped[i] if i < len(scoped) else 0 for i in order))
+        fresh._index_new()
+        return fresh
+
+    def _adopt(self, fresh):
+        for attribute in ("_ids", "_names", "_keys", "_counts", "_units", "_unit_votes", "_scopes",
+                          "_prefixes", "_trigrams", "_indexed"):
+            setattr(self, attribute, getattr(fresh, attribute))
+        self._bumps = 0
+
+    def add_requests(self, rows):
+        """Учитывает наименования из строк очереди отправки (id, payload); в поиске они появятся после update()."""
+        for row in rows:
+            try:
+                request = json.loads(row["payload"])
+                scope = (request["project"], request["object"])
+                for data in request["positions"]:
+                    name, unit = Position.name_and_unit(data)
+                    if name:
+                        self._add(name, unit, scope)
+            except (ValueError, KeyError, TypeError, IndexError) as e:
+                logger.warning(f"Индекс наименований: заявка №{row['id']} пропущена: {e}")
+            self.last_id = row["id"]
+
+    def update(self):
+        """Делает учтенные наименования доступными для поиска."""
+        if self._needs_rebuild():
+            self._adopt(self._rebuilt())
+        else:
+            self._index_new()
+
+    @property
+    def refreshing(self):
+        return self._lock.locked()
+
+    def stale(self, interval):
+        return self.refreshed_at is None or time.monotonic() - self.refreshed_at > interval
+
+    async def refresh(self, outbox, batch=1000):
+        """Подхватывает заявки, поставленные в очередь с прошлого обновления (в том числе другими шардами)."""
+        async with self._lock:
+            while rows := await asyncio.to_thread(outbox.requests_after, self.last_id, batch):
+                self.add_requests(rows)
+            if self._needs_rebuild():
+                # Пока индекс строится в потоке, поиск идет по старому: наименования меняются только здесь, под блокировкой
+                self._adopt(await asyncio.to_thread(self._rebuilt))
+            else:
+                self._index_new()
+            self.refreshed_at = time.monotonic()
+
+    def _ranked(self, ids, key, scope, limit):
+        keys, counts = self._keys, self._counts
+        scoped = self._scopes.get(scope) or ()
+        scoped_len = len(scoped)
+
+        def rank(i):
+            return keys[i].startswith(key), scoped[i] if i < scoped_len else 0, counts[i]
+
+        return [(self._names[i], self._units[i], counts[i]) for i in heapq.nlargest(limit, ids, key=rank)]
+
+    def _filtered(self, ids, test, text):
+        """Номера, ключи которых проходят test(ключ, text); проверка идет без вызовов Python-функций на каждый номер."""
+        ids, probe = itertools.tee(ids)
+        return itertools.compress(ids, map(test, map(self._keys.__getitem__, probe), itertools.repeat(text)))
+
+    def search(self, query, scope=None, limit=20):
+        """Подсказки для запроса: список (наименование, обычная единица измерения, сколько раз встречалось)."""
+        key = name_key(query)
+        grams = name_trigrams(key)
+        if not key:
+            matches = range(self._indexed)
+        elif grams:
+            postings = [self._trigrams.get(gram) for gram in grams]
+            if any(p is None for p in postings):
+                return []
+            matches = min(postings, key=len)
+            for word in key.split():
+                matches = self._filtered(matches, operator.contains, word)
+        else:
+            matches = self._prefixes.get(key[:self.PREFIX_LENGTH], ())
+            if len(key) > self.PREFIX_LENGTH:
+                matches = self._filtered(matches, str.startswith, key)
+        return self._ranked(itertools.islice(matches, self.SCAN_MATCHES), key, scope, limit)
+
+    def usual_unit(self, name):
+        """Единица измерения, с которой наименование обычно заказывали (None, если его нет в индексе)."""
+        i = self._ids.get(name_key(name)[:self.MAX_NAME_LENGTH])
+        return None if i is None else self._units[i]
+
+name_index = NameIndex(NAME_INDEX_MAX_NAMES)
+
+# --- ХРАНЕНИЕ ЧЕРНОВИКОВ ---
+
+class MemoryStateBackend:
+    """Хранилище без сохранения на диск: черновики живут только в памяти процесса."""
+
+    persistent = False
+
+    def load_draft(self, chat_id):
+        return None
+
+    def load_conversations(self, name):
+        return {}
+
+    def save(self, drafts, deleted, conversations, touched):
+        pass
+
+    def expire(self, cutoff):
+        return 0
+
+    def close(self):
+        pass
+
+class SqliteStateBackend:
+    """
+    Черновики заявок и состояния ConversationHandler в SQLite (режим WAL).
+    Методы блокирующие и вызываются через asyncio.to_thread.
+    """
+
+    persistent = True
+
+    def __init__(self, path, shard_index=0, shard_count=1):
+        self._conn = open_db(path)
+        self._lock = threading.Lock()
+        # Отдельное соединение для чтения: в режиме WAL чтение не ждет записи и удаления
+        # устаревших черновиков, которые держат основное соединение в транзакции
+        self._reader = open_db(path)
+        self._reader_lock = threading.Lock()
+        self._shard_sql, self._shard_args = shard_filter(shard_index, shard_count)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS drafts (
+                chat_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS drafts_updated_at ON drafts (updated_at);
+            CREATE TABLE IF NOT EXISTS conversations (
+                name TEXT NOT NULL,
+                key TEXT NOT NULL,
+                state INTEGER NOT NULL,
+                PRIMARY KEY (name, key)
+            );
+        """)
+
+    def load_draft(self, chat_id):
+        with self._reader_lock:
+            row = self._reader.execute("SELECT data FROM drafts WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row["data"] if row else None
+
+    def load_conversations(self, name):
+        # Строки удаляются при завершении диалога, поэтому здесь только незавершенные заявки
+        with self._reader_lock:
+            rows = self._reader.execute("SELECT key, state FROM conversations WHERE name = ?", (name,)).fetchall()
+        return {tuple(json.loads(row["key"])): row["state"] for row in rows}
+
+    def save(self, drafts, deleted, conversations, touched):
+        """
+        Записывает накопленные изменения одной транзакцией. touched - время последнего
+        обращения к черновикам, которые читались без изменений: по updated_at их срок
+        отсчитывается так же, как в памяти.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO drafts (chat_id, data, updated_at) VALUES (?, ?, ?)",
+                    [(chat_id, data, now) for chat_id, data in drafts.items()],
+                )
+                self._conn.executemany(
+                    "UPDATE drafts SET updated_at = MAX(updated_at, ?) WHERE chat_id = ?",
+                    [(used, chat_id) for chat_id, used in touched.items()],
+                )
+                self._conn.executemany("DELETE FROM drafts WHERE chat_id = ?", [(chat_id,) for chat_id in deleted])
+                for (name, key), state in conversations.items():
+                    if state is None:
+                        self._conn.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, key))
+                    else:
+                        self._conn.execute(
+                            "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                            (name, key, state),
+                        )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def expire(self, cutoff):
+        """Удаляет черновики, к которым не обращались с момента cutoff, вместе с состояниями их диалогов."""
+        with self._lock:
+            # IMMEDIATE: база может быть общей для нескольких процессов, а транзакция начинается с чтения
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                chat_ids = [row["chat_id"] for row in self._conn.execute(
+                    "SELECT chat_id FROM drafts WHERE updated_at < ?" + self._shard_sql, (cutoff, *self._shard_args)
+                )]
+                self._conn.executemany("DELETE FROM drafts WHERE chat_id = ?", [(chat_id,) for chat_id in chat_ids])
+                self._conn.executemany(
+                    "DELETE FROM conversations WHERE key LIKE ?", [(f"[{chat_id},%",) for chat_id in chat_ids]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return len(chat_ids)
+
+    def close(self):
+        with self._reader_lock:
+            self._reader.close()
+        with self._lock:
+            self._conn.close()
+
+class DraftStore(MutableMapping):
+    """
+    Черновики заявок (Draft) по chat_id. Черновик загружается из хранилища при первом обращении
+    к нему, а изменения накапливаются в памяти и периодически записываются одной транзакцией.
+    Так как обработчики меняют черновики на месте, любое обращение к черновику помечает его
+    как измененный. Перебор и len() охватывают только загруженные черновики.
+
+    Память ограничена: в ней держится не больше max_live черновиков (давно не использованные
+    выгружаются в хранилище, а без постоянного хранилища - теряются), а черновики, к которым
+    не обращались дольше ttl секунд, удаляются совсем.
+
+    Хранилище читается в потоке: warm() загружает черновик чата до обработчиков обновления
+    (см. warm_draft), а чаты, для которых черновика в хранилище нет, запоминаются (не больше
+    max_missing). Поэтому обработчики работают только с памятью и не ждут базу в цикле событий.
+    """
+
+    def __init__(self, backend, flush_interval=5, ttl=None, max_live=None, max_missing=10000):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.max_live = max_live
+        self.max_missing = max_missing
+        self._drafts = OrderedDict()
+        self._last_used = {}
+        # Время обращения к черновикам с прошлой записи: сохраняется в хранилище как updated_at
+        self._touched = {}
+        self._dirty = set()
+        self._deleted = set()
+        # Выгруженные из памяти, но еще не записанные черновики (уже в JSON, см. Draft.to_json)
+        self._spilled = {}
+        # Чаты без черновика в хранилище: повторно их в хранилище не ищем
+        self._missing = OrderedDict()
+        self._conversations = {}
+        self._task = None
+        self.evicted = 0
+        self.expired = 0
+
+    def _load(self, chat_id):
+        draft = self._drafts.get(chat_id)
+        if draft is not None:
+            self._drafts.move_to_end(chat_id)
+            self._last_used[chat_id] = self._touched[chat_id] = time.time()
+            return draft
+        if chat_id in self._deleted:
+            return None
+        if chat_id in self._spilled:
+            draft = Draft.from_json(self._spilled.pop(chat_id))
+            self._dirty.add(chat_id)
+        elif chat_id in self._missing:
+            self._missing.move_to_end(chat_id)
+            return None
+        else:
+            # Чат не прогрет через warm() (обращение не из обработчика обновления)
+            data = self.backend.load_draft(chat_id)
+            if data is None:
+                self._remember_missing(chat_id)
+                return None
+            draft = Draft.from_json(data)
+        self._remember(chat_id, draft)
+        return draft
+
+    def _known(self, chat_id):
+        return chat_id in self._drafts or chat_id in self._deleted or chat_id in self._spilled or chat_id in self._missing
+
+    async def warm(self, chat_id):
+        """Загружает черновик чата из хранилища в потоке, если о нем еще ничего не известно."""
+        if self._known(chat_id):
+            return
+        data = await asyncio.to_thread(self.backend.load_draft, chat_id)
+        # Пока шло чтение, черновик могли создать или удалить
+        if self._known(chat_id):
+            return
+        if data is None:
+            self._remember_missing(chat_id)
+        else:
+            self._remember(chat_id, Draft.from_json(data))
+
+    def _remember_missing(self, chat_id):
+        self._missing[chat_id] = True
+        self._missing.move_to_end(chat_id)
+        while len(self._missing) > self.max_missing:
+            self._missing.popitem(last=False)
+
+    def _remember(self, chat_id, draft):
+        self._drafts[chat_id] = draft
+        self._drafts.move_to_end(chat_id)
+        self._last_used[chat_id] = self._touched[chat_id] = time.time()
+        while self.max_live and len(self._drafts) > self.max_live:
+            self._evict(next(iter(self._drafts)))
+
+    def _evict(self, chat_id):
+        """Выгружает давно не использованный черновик из памяти."""
+        draft = self._drafts.pop(chat_id)
+        self._last_used.pop(chat_id, None)
+        if chat_id in self._dirty:
+            self._dirty.discard(chat_id)
+            if self.backend.persistent:
+                self._spilled[chat_id] = draft.to_json()
+        self.evicted += 1
+
+    def __getitem__(self, chat_id):
+        draft = self._load(chat_id)
+        if draft is None:
+            raise KeyError(chat_id)
+        self._dirty.add(chat_id)
+        return draft
+
+    def __contains__(self, chat_id):
+        return self._load(chat_id) is not None
+
+    def peek(self, chat_id):
+        """Черновик только для чтения: без отметки об изменении (None, если черновика нет)."""
+        return self._load(chat_id)
+
+    def __setitem__(self, chat_id, draft):
+        self._spilled.pop(chat_id, None)
+        self._missing.pop(chat_id, None)
+        self._dirty.add(chat_id)
+        self._deleted.discard(chat_id)
+        self._remember(chat_id, draft)
+
+    def __delitem__(self, chat_id):
+        if self._load(chat_id) is None:
+            raise KeyError(chat_id)
+        del self._drafts[chat_id]
+        self._last_used.pop(chat_id, None)
+        self._touched.pop(chat_id, None)
+        self._dirty.discard(chat_id)
+        self._deleted.add(chat_id)
+        self._remember_missing(chat_id)
+
+    def __iter__(self):
+        return iter(list(self._drafts))
+
+    def __len__(self):
+        return len(self._drafts)
+
+    def stats(self):
+        """Счетчики для мониторинга: черновики в памяти, выгруженные и удаленные по сроку."""
+        return {"live": len(self._drafts), "evicted": self.evicted, "expired": self.expired}
+
+    def set_conversation(self, name, key, state):
+        self._conversations[(name, json.dumps(list(key)))] = state
+
+    def drop_expired(self, chat_id):
+        """Удаляет черновик, срок которого истек, и учитывает его в счетчике."""
+        if chat_id in self:
+            del self[chat_id]
+            self.expired += 1
+
+    async def expire_idle(self):
+        """Удаляет черновики, к которым не обращались дольше ttl секунд."""
+        if not self.ttl:
+            return
+        cutoff = time.time() - self.ttl
+        for chat_id in [chat_id for chat_id, used in self._last_used.items() if used < cutoff]:
+            self.drop_expired(chat_id)
+        try:
+            self.expired += await asyncio.to_thread(self.backend.expire, cutoff)
+        except Exception as e:
+            logger.error(f"Не удалось удалить устаревшие черновики: {e}")
+
+    async def flush(self):
+        """Записывает накопленные изменения черновиков и состояний диалогов."""
+        if not (self._dirty or self._deleted or self._spilled or self._conversations or self._touched):
+            return
+        drafts = {
+            chat_id: self._drafts[chat_id].to_json()
+            for chat_id in self._dirty if chat_id in self._drafts
+        }
+        drafts.update(self._spilled)
+        deleted, conversations = self._deleted, self._conversations
+        touched = {chat_id: used for chat_id, used in self._touched.items() if chat_id not in drafts}
+        self._dirty, self._deleted, self._spilled, self._conversations = set(), set(), {}, {}
+        self._touched = {}
+        try:
+            await asyncio.to_thread(self.backend.save, drafts, deleted, conversations, touched)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить черновики: {e}")
+            # Вернем изменения, чтобы записать их при следующей попытке
+            for chat_id, data in drafts.items():
+                if chat_id in self._drafts:
+                    self._dirty.add(chat_id)
+                elif chat_id not in self._deleted and chat_id not in self._spilled:
+                    self._spilled[chat_id] = data
+            self._deleted.update(deleted - self._drafts.keys())
+            self._conversations = {**conversations, **self._conversations}
+            self._touched = {**touched, **self._touched}
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        last_stats = None
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            # Сначала запись: иначе хранилище удалило бы черновики, прочитанные с прошлой записи
+            await self.flush()
+            await self.expire_idle()
+            stats = self.stats()
+            if stats != last_stats:
+                logger.info(f"Drafts: {stats}")
+                last_stats = stats
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self.flush()
+        self.backend.close()
+
+class DraftPersistence(BasePersistence):
+    """
+    Хранит состояния ConversationHandler в том же хранилище, что и черновики.
+    Данные пользователей, чатов и бота не используются.
+    """
+
+    def __init__(self, store):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=False, callback_data=False),
+            update_interval=store.flush_interval,
+        )
+        self.store = store
+
+    async def get_conversations(self, name):
+        return await asyncio.to_thread(self.store.backend.load_conversations, name)
+
+    async def update_conversation(self, name, key, new_state):
+        self.store.set_conversation(name, key, new_state)
+
+    async def flush(self):
+        await self.store.flush()
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_user_data(self, user_id, data):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def drop_user_data(self, user_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+user_state = None # создается в open_storage()
+
+# --- ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА ОБНОВЛЕНИЙ ---
+
+class ChatLocks:
+    """Блокировки по chat_id; блокировка удаляется, когда ее никто не ждет."""
+
+    def __init__(self):
+        self._locks = {}
+
+    @asynccontextmanager
+    async def hold(self, chat_id):
+        entry = self._locks.get(chat_id)
+        if entry is None:
+            entry = self._locks[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[chat_id]
+
+    def __len__(self):
+        return len(self._locks)
+
+chat_locks = ChatLocks()
+
+def update_chat_key(update):
+    """Чат, к которому относится обновление (или пользователь, если чата нет, как у inline-запросов)."""
+    chat = getattr(update, "effective_chat", None)
+    user = getattr(update, "effective_user", None)
+    return chat.id if chat else user.id if user else None
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обрабатывает обновления разных чатов параллельно (не больше max_concurrent_updates
+    одновременно), а обновления одного чата - строго по очереди, в порядке поступления.
+    Поэтому обработчики могут менять черновик своего чата в user_state без гонок.
+
+    Место в общем лимите обновление занимает, только дождавшись очереди своего чата:
+    обновления, ждущие предыдущих из того же чата, не задерживают другие чаты.
+    """
+
+    def __init__(self, max_concurrent_updates, locks):
+        super().__init__(max_concurrent_updates)
+        self.locks = locks
+
+    async def process_update(self, update, coroutine):
+        # Вместо BaseUpdateProcessor.process_update, который берет общий семафор раньше блокировки чата
+        key = update_chat_key(update)
+        if key is None:
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+            return
+        async with self.locks.hold(key):
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
 
-        ws.cell(row=row, column=1).value = i + 1
-        ws.cell(row=row, column=2).value = pos["name"]
-        ws.cell(row=row, column=3).value = pos["unit"]
-        ws.cell(row=row, column=4).value = pos["quantity"]
-        ws.cell(row=row, column=5).value = pos.get("delivery_date", "Не указано")
-        ws.cell(row=row, column=6).value = pos["module"]
-        ws.cell(row=row, column=7).value = pos.get("link", "")
-        logger.info(f"Writing position {i+1} to Excel: {pos}")
+    async def initialize(self):
+        pass
 
+    async def shutdown(self):
+        pass
 
-    wb.save(new_path)
-    logger.info(f"Excel file saved to: {new_path}")
-    return new_path
+# --- ОГРАНИЧЕНИЕ ЗАПРОСОВ К TELEGRAM ---
 
-async def send_email(chat_id, project, object_name, positions, user_full_name, telegram_id_or_username, context=None):
+class TokenBucket:
     """
-    Отправляет сгенерированный Excel-файл по электронной почте,
-    с возможностью прикрепления дополнительных файлов и ссылок, привязанных к позициям,
-    а также информацией о пользователе.
+    Ведро токенов с резервированием: каждый запрос сразу забирает токен (баланс может
+    уйти в минус) и получает время ожидания, поэтому запросы выходят в порядке вызова.
     """
-    msg = EmailMessage()
-    msg["Subject"] = f"Заявка на снабжение: {project} - {object_name}"
-    msg["From"] = EMAIL_LOGIN
-    msg["To"] = EMAIL_RECEIVER
-
-    email_body = "Во вложении заявка на снабжение.\n\n"
-    email_body += f"Проект: {project}\n"
-    email_body += f"Объект: {object_name}\n"
-    email_body += f"От кого: {user_full_name}\n"
-    email_body += f"Telegram ID: {telegram_id_or_username}\n\n"
-    email_body += "Позиции:\n"
 
-    files_to_attach = []
-    links_in_email = []
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        """Резервирует токен и возвращает, сколько секунд подождать перед запросом."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def idle(self):
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.burst
+
+class PendingEdit:
+    """Отложенное изменение сообщения; более позднее изменение того же вида заменяет запрос."""
+
+    def __init__(self, callback, args, kwargs, endpoint, data):
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.endpoint = endpoint
+        self.data = data
+        self.coalesced = 0
+
+class OutboundScheduler(BaseRateLimiter):
+    """
+    Планировщик исходящих запросов бота. Запросы в чаты проходят через общее ведро токенов
+    и ведро своего чата (для групп и каналов лимит ниже). Ответ 429 приостанавливает все
+    запросы на retry_after секунд, после чего запрос повторяется.
+
+    Изменения сообщений (editMessageText и т.п.), которым пришлось бы ждать лимита чата,
+    не задерживают обработчик: они отправляются в фоне, а следующие изменения того же вида
+    (того же метода) того же сообщения до отправки заменяют ожидающий запрос - уходит только
+    последнее состояние. Изменения разных видов отправляются по очереди, в порядке вызова.
+    Изменения, не отличающиеся от последнего отправленного текста и клавиатуры, пропускаются.
+
+    Ведра токенов у каждого процесса свои, поэтому при shard_count шардах общий лимит и лимит
+    чатов shared_chats, куда пишут все шарды (чат отдела снабжения), делятся между шардами.
+    Остальные чаты обрабатывает только их шард, и их лимит не делится.
+    """
 
-    for i, p in enumerate(positions):
-        pos_info = (
-            f"{i+1}. Модуль: {p.get('module', 'N/A')} | Наименование: {p.get('name', 'N/A')} | "
-            f"Ед.изм.: {p.get('unit', 'N/A')} | Количество: {p.get('quantity', 'N/A')} | "
-            f"Дата поставки: {p.get('delivery_date', 'N/A')}"
+    EDIT_ENDPOINTS = frozenset({"editMessageText", "editMessageReplyMarkup", "editMessageCaption"})
+    # Поля запроса, которые не влияют на содержимое сообщения
+    _VOLATILE_FIELDS = frozenset({"chat_id", "message_id", "inline_message_id"})
+
+    def __init__(self, global_rate, chat_rate, group_rate, chat_burst, max_retries, max_tracked_chats=10000,
+                 shard_count=1, shared_chats=()):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_tracked_chats = max_tracked_chats
+        self.shard_count = max(1, shard_count)
+        self.shared_chats = {str(chat_id) for chat_id in shared_chats}
+        global_rate /= self.shard_count
+        self._global = TokenBucket(global_rate, max(1, int(global_rate)))
+        self._chats = OrderedDict()
+        self._paused_until = 0.0
+        self._pending_edits = {}
+        self._last_edits = OrderedDict() # (chat_id, message_id) -> (endpoint, содержимое, ответ)
+        self._deferred = set()
+        self.stats = {"sent": 0, "coalesced": 0, "unchanged": 0, "retry_after": 0}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        # Отложенные изменения отправляются до остановки бота
+        await asyncio.gather(*self._deferred, return_exceptions=True)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            rate = self.group_rate if str(chat_id).startswith(("-", "@")) else self.chat_rate
+            burst = self.chat_burst
+            if str(chat_id) in self.shared_chats:
+                rate, burst = rate / self.shard_count, max(1, burst // self.shard_count)
+            bucket = self._chats[chat_id] = TokenBucket(rate, burst)
+            while len(self._chats) > self.max_tracked_chats and next(iter(self._chats.values())).idle():
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    @classmethod
+    def _content(cls, data):
+        return json.dumps(
+            {key: value for key, value in data.items() if key not in cls._VOLATILE_FIELDS},
+            sort_keys=True,
+            default=lambda value: value.to_dict() if hasattr(value, "to_dict") else str(value),
         )
-        if p.get('link'):
-            pos_info += f" | Ссылка: {p['link']}"
-            links_in_email.append(f"Позиция {i+1} ({p.get('name', 'N/A')}): {p['link']}")
-
-        if p.get('file_data') and isinstance(p['file_data'], list):
-            file_names = []
-            for file_item in p['file_data']:
-                file_names.append(file_item.get('file_name', 'N/A'))
-                files_to_attach.append((i+1, file_item))
-            if file_names:
-                pos_info += f" | Файлы: {', '.join(file_names)}"
-        email_body += pos_info + "\n"
-
-    if links_in_email:
-        email_body += "\nОтдельные ссылки для позиций:\n" + "\n".join(links_in_email) + "\n"
 
-    msg.set_content(email_body)
-    logger.info(f"Email body generated for chat_id {chat_id}: \n{email_body}")
-
-    try:
-        file_path = fill_excel(project, object_name, positions, user_full_name, telegram_id_or_username)
-        with open(file_path, "rb") as f:
-            msg.add_attachment(
-                f.read(),
-                maintype="application",
-                subtype="vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                filename=os.path.basename(file_path),
-            )
-        logger.info(f"Excel file '{file_path}' прикреплен к письму")
-    except Exception as e:
-        logger.error(f"Ошибка при создании или прикреплении Excel файла: {e}")
-
-    if context:
-        for pos_index, file_data in files_to_attach:
+    def _remember_edit(self, key, endpoint, content, result):
+        self._last_edits[key] = (endpoint, content, result)
+        self._last_edits.move_to_end(key)
+        if len(self._last_edits) > self.max_tracked_chats:
+            self._last_edits.popitem(last=False)
+
+    async def _send(self, callback, args, kwargs):
+        """Отправляет запрос через общее ведро, повторяя его после 429."""
+        for attempt in range(self.max_retries + 1):
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            delay = self._global.reserve()
+            if delay:
+                await asyncio.sleep(delay)
             try:
-                file_id = file_data['file_id']
-                file_name = file_data['file_name']
-                mime_type = file_data['mime_type']
-
-                telegram_file = await context.bot.get_file(file_id)
-                file_bytes = await telegram_file.download_as_bytearray()
-
-                msg.add_attachment(
-                    file_bytes,
-                    maintype=mime_type.split('/')[0],
-                    subtype=mime_type.split('/')[1],
-                    filename=f"Позиция_{pos_index}_{file_name}",
-                )
-                logger.info(f"Дополнительный файл '{file_name}' для позиции {pos_index} прикреплен к письму")
-            except Exception as e:
-                logger.error(f"Ошибка при скачивании или прикреплении файла '{file_name}' для позиции {pos_index}: {e}")
-                msg.set_content(msg.get_content() + f"\n\nВнимание: Не удалось прикрепить файл '{file_name}' для позиции {pos_index} из-за ошибки: {e}")
+                result = await callback(*args, **kwargs)
+                self.stats["sent"] += 1
+                return result
+            except RetryAfter as e:
+                self.stats["retry_after"] += 1
+                if attempt == self.max_retries:
+                    raise
+                retry_after = float(e.retry_after) + 0.1
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                logger.warning(f"Telegram flood control: pausing requests for {retry_after:.1f} s")
+
+    async def _send_edit(self, key, edit):
+        content = self._content(edit.data)
+        last = self._last_edits.get(key)
+        if last and last[0] == edit.endpoint and last[1] == content:
+            self.stats["unchanged"] += 1
+            return last[2]
+        try:
+            result = await self._send(edit.callback, edit.args, edit.kwargs)
+        except BadRequest as e:
+            if "message is not modified" not in str(e).lower():
+                raise
+            result = last[2] if last else True
+        self._remember_edit(key, edit.endpoint, content, result)
+        return result
+
+    async def _deferred_edit(self, key, edit, delay):
+        await asyncio.sleep(delay)
+        # С этого момента новые изменения сообщения ставятся в очередь заново. Если изменение
+        # уже отцеплено более поздним изменением другого вида, в словаре лежит не оно
+        if self._pending_edits.get(key) is edit:
+            del self._pending_edits[key]
+        try:
+            await self._send_edit(key, edit)
+        except Exception as e:
+            logger.warning(f"Deferred {edit.endpoint} for message {key} failed: {e}")
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return await self._send(callback, args, kwargs)
+
+        if endpoint in self.EDIT_ENDPOINTS and data.get("message_id") is not None:
+            key = (chat_id, data["message_id"])
+            pending = self._pending_edits.get(key)
+            if pending is not None:
+                if pending.endpoint == endpoint:
+                    pending.args, pending.kwargs, pending.data = args, kwargs, data
+                    pending.coalesced += 1
+                    self.stats["coalesced"] += 1
+                    return True
+                # Изменение другого вида (например, клавиатуры после текста) не должно заменять
+                # ожидающее: оно отцепляется и уходит в свою очередь, новое отправляется после него
+                del self._pending_edits[key]
+            edit = PendingEdit(callback, args, kwargs, endpoint, data)
+            delay = self._chat_bucket(chat_id).reserve()
+            if not delay:
+                return await self._send_edit(key, edit)
+            self._pending_edits[key] = edit
+            task = asyncio.create_task(self._deferred_edit(key, edit, delay))
+            self._deferred.add(task)
+            task.add_done_callback(self._deferred.discard)
+            return True
+
+        delay = self._chat_bucket(chat_id).reserve()
+        if delay:
+            await asyncio.sleep(delay)
+        return await self._send(callback, args, kwargs)
 
+# === Telegram Handlers ===
 
-    try:
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()
-            server.login(EMAIL_LOGIN, EMAIL_PASSWORD)
-            server.send_message(msg)
-        logger.info(f"Письмо успешно отправлено на {EMAIL_RECEIVER}")
-        return True
-    except Exception as e:
-        logger.error(f"Ошибка при отправке письма: {e}")
-        raise
+# --- CALLBACK-ДАННЫЕ ---
+# callback_data кнопки: версия формата, код действия и аргументы через ":", например "1sp:3".
+# Значения из списков передаются индексами, поэтому длина не зависит от названий.
+# Кнопки из сообщений, отправленных до смены формата, распознаются по версии как устаревшие.
+
+CALLBACK_VERSION = "1"
+
+CB_CANCEL = "x"
+CB_IGNORE = "i"
+CB_PROJECT = "pr"          # индекс в projects
+CB_OBJECT = "ob"           # индекс в objects
+CB_UNIT = "un"             # индекс в units
+CB_MODULE = "mo"           # индекс в modules
+CB_ATTACHMENT = "at"       # f - файл, l - ссылка, n - без вложений
+CB_ADD_MORE = "am"         # 1 - да, 0 - нет
+CB_POSITION_ACTION = "pa"  # e - редактировать, d - удалить
+CB_SELECT_POSITION = "sp"  # индекс позиции
+CB_CONTINUE = "cf"
+CB_BACK_TO_MENU = "bm"
+CB_EDIT_FIELD = "ef"       # имя поля
+CB_EDIT_UNIT = "eu"        # индекс в units
+CB_EDIT_MODULE = "em"      # индекс в modules
+CB_CALENDAR_NAV = "dn"     # режим, год, месяц
+CB_CALENDAR_DATE = "dd"    # режим, дата ГГГГММДД
+CB_CALENDAR_CANCEL = "dx"  # режим
+CB_FINAL_CONFIRM = "fc"    # 1 - отправить, 0 - нет
+CB_PAGE = "pg"             # номер страницы сводки позиций
+CB_IMPORT = "im"
+CB_REPEAT = "rp"             # номер заявки; без номера - последняя по проекту и объекту
+CB_HISTORY = "hs"
+
+# Режимы календаря: дата новой позиции или новая дата при редактировании
+CALENDAR_POSITION = "p"
+CALENDAR_EDIT = "e"
+
+def pack_callback(action, *args):
+    """Собирает callback_data, проверяя ограничение Telegram в 64 байта."""
+    data = CALLBACK_VERSION + ":".join((action, *map(str, args)))
+    if len(data.encode()) > InlineKeyboardButtonLimit.MAX_CALLBACK_DATA:
+        raise ValueError(f"callback_data is too long: {data!r}")
+    return data
+
+def parse_callback(data):
+    """Разбирает callback_data на код действия и аргументы; (None, ()) для чужой версии формата."""
+    if not data or data[0] != CALLBACK_VERSION:
+        return None, ()
+    action, *args = data[1:].split(":")
+    return action, args
+
+class CallbackRouter(BaseHandler):
+    """
+    Обработчик нажатий на кнопки для состояния диалога: код действия из callback_data
+    ищется в словаре routes {код: обработчик}, аргументы передаются в context.args.
+    Заменяет цепочку CallbackQueryHandler с регулярными выражениями.
+    """
 
-# === Telegram Handlers ===
+    def __init__(self, routes):
+        super().__init__(self._dispatch)
+        self.routes = routes
+
+    def check_update(self, update):
+        if not isinstance(update, Update) or not update.callback_query:
+            return None
+        action, args = parse_callback(update.callback_query.data)
+        handler = self.routes.get(action)
+        if handler is None:
+            return None
+        return handler, args
+
+    def collect_additional_context(self, context, update, application, check_result):
+        context.args = check_result[1]
+
+    async def handle_update(self, update, application, check_result, context):
+        self.collect_additional_context(context, update, application, check_result)
+        return await check_result[0](update, context)
+
+    async def _dispatch(self, update, context):
+        """
+        Обработчик-функция (self.callback) для вызова в обход handle_update: сам разбирает
+        callback_data. Нажатие без маршрута только подтверждается и записывается в журнал.
+        """
+        action, args = parse_callback(update.callback_query.data)
+        handler = self.routes.get(action)
+        if handler is None:
+            logger.warning(f"No route for callback data {update.callback_query.data!r}")
+            await update.callback_query.answer()
+            return None
+        context.args = args
+        return await handler(update, context)
+
+def picked(values, context):
+    """Значение из списка по индексу из callback_data (None, если индекс неверный)."""
+    try:
+        return values[int(context.args[0])]
+    except (IndexError, ValueError, TypeError):
+        return None
+
+# --- КЛАВИАТУРЫ ---
+# Клавиатуры неизменяемы, поэтому статические создаются один раз и общие для всех чатов
+
+def choice_keyboard(values, action, per_row=1):
+    """Клавиатура выбора значения из списка (в callback_data - индекс значения) с кнопкой отмены."""
+    buttons = [InlineKeyboardButton(value, callback_data=pack_callback(action, i)) for i, value in enumerate(values)]
+    rows = [buttons[i:i + per_row] for i in range(0, len(buttons), per_row)]
+    return InlineKeyboardMarkup(rows + [[CANCEL_BUTTON]])
+
+CANCEL_BUTTON = InlineKeyboardButton("Отмена заявки", callback_data=pack_callback(CB_CANCEL))
+CANCEL_KEYBOARD = InlineKeyboardMarkup([[CANCEL_BUTTON]])
+CREATE_REQUEST_KEYBOARD = ReplyKeyboardMarkup([[KeyboardButton("Создать заявку")]], one_time_keyboard=False, resize_keyboard=True)
+PROJECTS_KEYBOARD = choice_keyboard(projects, CB_PROJECT)
+OBJECTS_KEYBOARD = choice_keyboard(objects, CB_OBJECT)
+UNITS_KEYBOARD = choice_keyboard(units, CB_UNIT)
+MODULES_KEYBOARD = choice_keyboard(modules, CB_MODULE, per_row=5)
+EDIT_UNITS_KEYBOARD = choice_keyboard(units, CB_EDIT_UNIT)
+EDIT_MODULES_KEYBOARD = choice_keyboard(modules, CB_EDIT_MODULE, per_row=5)
+ATTACHMENT_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Прикрепить файл", callback_data=pack_callback(CB_ATTACHMENT, "f"))],
+    [InlineKeyboardButton("Прикрепить ссылку", callback_data=pack_callback(CB_ATTACHMENT, "l"))],
+    [InlineKeyboardButton("Продолжить", callback_data=pack_callback(CB_ATTACHMENT, "n"))],
+    [CANCEL_BUTTON],
+])
+ADD_MORE_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Да", callback_data=pack_callback(CB_ADD_MORE, 1)),
+     InlineKeyboardButton("Нет", callback_data=pack_callback(CB_ADD_MORE, 0))]
+])
+CONTINUE_BUTTON = InlineKeyboardButton("Продолжить", callback_data=pack_callback(CB_CONTINUE))
+BACK_TO_MENU_BUTTON = InlineKeyboardButton("Назад в меню", callback_data=pack_callback(CB_BACK_TO_MENU))
+IMPORT_BUTTON = InlineKeyboardButton("Загрузить позиции из файла", callback_data=pack_callback(CB_IMPORT))
+CONTINUE_KEYBOARD = InlineKeyboardMarkup([[CONTINUE_BUTTON], [CANCEL_BUTTON]])
+EDIT_MENU_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Редактировать позицию", callback_data=pack_callback(CB_POSITION_ACTION, "e"))],
+    [InlineKeyboardButton("Удалить позицию", callback_data=pack_callback(CB_POSITION_ACTION, "d"))],
+    [IMPORT_BUTTON],
+    [CONTINUE_BUTTON],
+    [CANCEL_BUTTON],
+])
+BACK_TO_MENU_KEYBOARD = InlineKeyboardMarkup([[BACK_TO_MENU_BUTTON], [CANCEL_BUTTON]])
+NAME_PROMPT_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Найти в прошлых заявках", switch_inline_query_current_chat="")],
+    [InlineKeyboardButton("Повторить прошлую заявку", callback_data=pack_callback(CB_REPEAT))],
+    [InlineKeyboardButton("Начать с другой заявки", callback_data=pack_callback(CB_HISTORY))],
+    [IMPORT_BUTTON],
+    [CANCEL_BUTTON],
+])
+NAME_PROMPT = (
+    "Введите наименование позиции.\n\n"
+    "Несколько позиций можно добавить одним сообщением, по строке на позицию:\n"
+    f"{QUICK_ENTRY_EXAMPLE}\n"
+    "(наименование; ед.изм.; количество; модуль; дата поставки; ссылка - по желанию)\n"
+    "или загрузить из файла.\n\n"
+    "Чтобы начать с позиций прошлой заявки, отправьте ее номер, например №123."
+)
+NAME_PROMPT_BACK_BUTTON = InlineKeyboardButton("Назад", callback_data=pack_callback(CB_ADD_MORE, 1))
+EDIT_FIELDS_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton(label, callback_data=pack_callback(CB_EDIT_FIELD, field))]
+    for label, field in [
+        ("Наименование", "name"),
+        ("Ед.изм.", "unit"),
+        ("Количество", "quantity"),
+        ("Модуль", "module"),
+        ("Дата поставки", "delivery_date"),
+        ("Прикрепить/Изменить файл", "attach_file"),
+        ("Прикрепить/Изменить ссылку", "attach_link"),
+    ]
+] + [[BACK_TO_MENU_BUTTON], [CANCEL_BUTTON]])
+FINAL_CONFIRM_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Да", callback_data=pack_callback(CB_FINAL_CONFIRM, 1)),
+     InlineKeyboardButton("Нет", callback_data=pack_callback(CB_FINAL_CONFIRM, 0))],
+    [CANCEL_BUTTON],
+])
+
+CALENDAR = calendar.Calendar()
+IGNORE_CALLBACK = pack_callback(CB_IGNORE)
+WEEKDAYS_ROW = [InlineKeyboardButton(day, callback_data=IGNORE_CALLBACK) for day in ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]]
+EMPTY_DAY_BUTTON = InlineKeyboardButton(" ", callback_data=IGNORE_CALLBACK)
+
+def draft_required(handler):
+    """
+    Завершает диалог, если черновик заявки уже удален (например, по сроку хранения),
+    вместо того чтобы падать с KeyError в обработчике.
+    """
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, **kwargs):
+        chat_id = update.effective_chat.id
+        if chat_id in user_state:
+            return await handler(update, context, **kwargs)
+
+        logger.info(f"Chat {chat_id}: draft is missing in {handler.__name__}, ending conversation.")
+        if update.callback_query:
+            await update.callback_query.answer()
+        reply_markup = CREATE_REQUEST_KEYBOARD
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text="Черновик заявки не найден: он был удален после долгого бездействия. Начните заново.",
+            reply_markup=reply_markup
+        )
+        return ConversationHandler.END
+    return wrapper
 
 async def initial_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Обрабатывает первое сообщение от пользователя (или когда диалог неактивен)
     и предлагает кнопку "Создать заявку".
     """
-    keyboard = [[KeyboardButton("Создать заявку")]]
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=False, resize_keyboard=True)
+    reply_markup = CREATE_REQUEST_KEYBOARD
     await update.message.reply_text(
         "Привет! Я бот для создания заявок. Нажмите кнопку, чтобы начать.",
         reply_markup=reply_markup
@@ -214,93 +3276,83 @@ async def start_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_full_name = f"{first_name} {last_name}".strip()
     telegram_id_or_username = user.username if user.username else str(user.id)
 
-    user_state[chat_id] = {
-        "user_full_name": user_full_name,
-        "telegram_id_or_username": telegram_id_or_username,
-        "project": None,
-        "object": None,
-        "positions": [],
-    }
+    user_state[chat_id] = Draft(user_full_name, telegram_id_or_username)
     logger.info(f"User {user_full_name} ({telegram_id_or_username}) started conversation.")
 
     await update.message.reply_text("Начинаем создание заявки...", reply_markup=ReplyKeyboardRemove())
 
-    keyboard = [[InlineKeyboardButton(p, callback_data=p)] for p in projects]
-    keyboard.append([InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Выберите проект:", reply_markup=reply_markup)
+    await update.message.reply_text("Выберите проект:", reply_markup=PROJECTS_KEYBOARD)
     return PROJECT
 
+@draft_required
 async def project_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обрабатывает выбор проекта и предлагает выбрать объект."""
     query = update.callback_query
     await query.answer()
 
-    user_state[query.message.chat.id]["project"] = query.data
-    logger.info(f"Chat {query.message.chat.id}: Project selected - {query.data}")
+    project = picked(projects, context)
+    user_state[query.message.chat.id].project = project
+    logger.info(f"Chat {query.message.chat.id}: Project selected - {project}")
 
-    keyboard = [[InlineKeyboardButton(o, callback_data=o)] for o in objects]
-    keyboard.append([InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text("Выберите объект:", reply_markup=reply_markup)
+    await query.edit_message_text("Выберите объект:", reply_markup=OBJECTS_KEYBOARD)
     return OBJECT
 
+@draft_required
 async def object_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обрабатывает выбор объекта и запрашивает наименование позиции."""
     query = update.callback_query
     await query.answer()
 
-    user_state[query.message.chat.id]["object"] = query.data
-    logger.info(f"Chat {query.message.chat.id}: Object selected - {query.data}")
-    await query.edit_message_text("Введите наименование позиции:")
+    object_name = picked(objects, context)
+    user_state[query.message.chat.id].object_name = object_name
+    logger.info(f"Chat {query.message.chat.id}: Object selected - {object_name}")
+    await query.edit_message_text(NAME_PROMPT, reply_markup=NAME_PROMPT_KEYBOARD)
     return NAME
 
+@draft_required
 async def name_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обрабатывает наименование позиции и предлагает выбрать единицу измерения."""
-    user_state[update.effective_chat.id]["current"] = {"name": update.message.text, "file_data": []}
+    try:
+        user_state[update.effective_chat.id].current = Position(update.message.text)
+    except ValueError:
+        await update.message.reply_text("Наименование не может быть пустым. Введите наименование позиции:")
+        return NAME
     logger.info(f"Chat {update.effective_chat.id}: Position name entered - {update.message.text}")
 
-    keyboard = [[InlineKeyboardButton(u, callback_data=u)] for u in units]
-    keyboard.append([InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Выберите единицу измерения:", reply_markup=reply_markup)
+    usual_unit = name_index.usual_unit(update.message.text)
+    prompt = f"Выберите единицу измерения (обычно - {usual_unit}):" if usual_unit in units else "Выберите единицу измерения:"
+    await update.message.reply_text(prompt, reply_markup=UNITS_KEYBOARD)
     return UNIT
 
+@draft_required
 async def unit_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обрабатывает выбор единицы измерения и запрашивает количество."""
     query = update.callback_query
     await query.answer()
 
-    user_state[query.message.chat.id]["current"]["unit"] = query.data
-    logger.info(f"Chat {query.message.chat.id}: Unit selected - {query.data}")
+    unit = picked(units, context)
+    user_state[query.message.chat.id].current.unit = unit
+    logger.info(f"Chat {query.message.chat.id}: Unit selected - {unit}")
     await query.edit_message_text("Введите количество:")
     return QUANTITY
 
+@draft_required
 async def quantity_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обрабатывает количество и предлагает выбрать модуль. Добавлена базовая валидация."""
     chat_id = update.effective_chat.id
     try:
-        quantity = float(update.message.text)
-        user_state[chat_id]["current"]["quantity"] = quantity
-        logger.info(f"Chat {chat_id}: Quantity entered - {quantity}")
+        current = user_state[chat_id].current
+        current.quantity = update.message.text
+        logger.info(f"Chat {chat_id}: Quantity entered - {current.quantity}")
     except ValueError:
         logger.warning(f"Chat {chat_id}: Invalid quantity format - '{update.message.text}'")
-        await update.message.reply_text("Неверный формат количества. Пожалуйста, введите число (например, 5 или 3.5):")
+        await update.message.reply_text("Неверный формат количества. Пожалуйста, введите положительное число (например, 5 или 3.5):")
         return QUANTITY
 
-    buttons_per_row = 5
-    keyboard = []
-    current_row = []
-    for i, m in enumerate(modules):
-        current_row.append(InlineKeyboardButton(m, callback_data=m))
-        if (i + 1) % buttons_per_row == 0 or (i + 1) == len(modules):
-            keyboard.append(current_row)
-            current_row = []
-    keyboard.append([InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("К какому модулю относится позиция?", reply_markup=reply_markup)
+    await update.message.reply_text("К какому модулю относится позиция?", reply_markup=MODULES_KEYBOARD)
     return MODULE
 
+@draft_required
 async def module_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Обрабатывает выбор модуля и переходит к выбору даты поставки для текущей позиции.
@@ -309,65 +3361,65 @@ async def module_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
 
     chat_id = query.message.chat.id
-    user_state[chat_id]["current"]["module"] = query.data
-    logger.info(f"Chat {chat_id}: Module selected - {query.data}. Requesting delivery date for this position.")
+    module = picked(modules, context)
+    user_state[chat_id].current.module = module
+    logger.info(f"Chat {chat_id}: Module selected - {module}. Requesting delivery date for this position.")
 
     current_date = date.today()
-    reply_markup = create_calendar_keyboard(current_date.year, current_date.month, prefix="POS_CAL_")
+    reply_markup = create_calendar_keyboard(current_date.year, current_date.month, CALENDAR_POSITION)
     await query.edit_message_text("Выберите желаемую дату поставки для этой позиции:", reply_markup=reply_markup)
     return POSITION_DELIVERY_DATE
 
-async def process_position_calendar_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+def callback_date(arg):
+    """Дата из callback_data (ГГГГММДД)."""
+    return datetime.strptime(arg, "%Y%m%d").date()
+
+@draft_required
+async def calendar_navigation_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Обрабатывает нажатия на кнопки календаря для выбора даты поставки отдельной позиции.
+    Листает календарь выбора даты поставки (для новой позиции или при редактировании).
     """
     query = update.callback_query
     await query.answer()
 
-    data = query.data
-    chat_id = query.message.chat.id
-
-    if data.startswith("POS_CAL_NAV_"):
-        parts = data.split('_')
-        year = int(parts[3])
-        month = int(parts[4])
-
-        if month > 12:
-            month = 1
-            year += 1
-        elif month < 1:
-            month = 12
-            year -= 1
-
-        reply_markup = create_calendar_keyboard(year, month, prefix="POS_CAL_")
+    mode, year, month = context.args[0], int(context.args[1]), int(context.args[2])
+    reply_markup = create_calendar_keyboard(year, month, mode)
+    if mode == CALENDAR_POSITION:
         await query.edit_message_text("Выберите желаемую дату поставки для этой позиции:", reply_markup=reply_markup)
         return POSITION_DELIVERY_DATE
+    await query.edit_message_text("Выберите дату:", reply_markup=reply_markup)
+    return GLOBAL_DELIVERY_DATE_SELECTION
 
-    elif data.startswith("POS_CAL_DATE_"):
-        selected_date_str = data.replace("POS_CAL_DATE_", "")
+@draft_required
+async def process_position_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Сохраняет дату поставки новой позиции и предлагает прикрепить к ней файл или ссылку.
+    """
+    query = update.callback_query
+    await query.answer()
+    chat_id = query.message.chat.id
 
-        user_state[chat_id]["current"]["delivery_date"] = selected_date_str
-        logger.info(f"Chat {chat_id}: Position delivery date selected - {selected_date_str}. Now asking about attachments.")
+    selected_date = callback_date(context.args[1])
+    user_state[chat_id].current.delivery_date = selected_date
+    logger.info(f"Chat {chat_id}: Position delivery date selected - {selected_date}. Now asking about attachments.")
 
-        keyboard = [
-            [InlineKeyboardButton("Прикрепить файл", callback_data="attach_file")],
-            [InlineKeyboardButton("Прикрепить ссылку", callback_data="attach_link")],
-            [InlineKeyboardButton("Продолжить", callback_data="no_attachment")]
-        ]
-        keyboard.append([InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("Теперь вы можете прикрепить файл или ссылку к этой позиции:", reply_markup=reply_markup)
-        return ATTACHMENT_CHOICE
+    reply_markup = ATTACHMENT_KEYBOARD
+    await query.edit_message_text("Теперь вы можете прикрепить файл или ссылку к этой позиции:", reply_markup=reply_markup)
+    return ATTACHMENT_CHOICE
 
-    elif data == "POS_CAL_CANCEL":
-        logger.info(f"Chat {chat_id}: Position calendar date selection cancelled.")
-        if "current" in user_state[chat_id]:
-            del user_state[chat_id]["current"]
-        await query.edit_message_text("Выбор даты для позиции отменен. Вы можете добавить позицию снова или продолжить.")
-        return await edit_menu_handler(update, context)
+@draft_required
+async def cancel_position_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отменяет выбор даты для новой позиции; позиция не добавляется."""
+    query = update.callback_query
+    await query.answer()
+    chat_id = query.message.chat.id
 
-    return POSITION_DELIVERY_DATE
+    logger.info(f"Chat {chat_id}: Position calendar date selection cancelled.")
+    user_state[chat_id].current = None
+    await query.edit_message_text("Выбор даты для позиции отменен. Вы можете добавить позицию снова или продолжить.")
+    return await edit_menu_handler(update, context)
 
+@draft_required
 async def attachment_choice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Обрабатывает выбор пользователя по прикреплению файла, ссылки или продолжению без вложений.
@@ -375,31 +3427,30 @@ async def attachment_choice_handler(update: Update, context: ContextTypes.DEFAUL
     query = update.callback_query
     await query.answer()
     chat_id = query.message.chat.id
-    data = query.data
+    choice = context.args[0]
 
-    if data == "attach_file":
+    if choice == "f":
         await query.edit_message_text("Пожалуйста, **отправьте мне файл** (как документ) для этой позиции.",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")]]))
+                                      reply_markup=CANCEL_KEYBOARD)
         return FILE_INPUT
-    elif data == "attach_link":
+    elif choice == "l":
         await query.edit_message_text("Пожалуйста, **введите ссылку** для этой позиции.",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")]]))
+                                      reply_markup=CANCEL_KEYBOARD)
         return LINK_INPUT
-    elif data == "no_attachment":
-        user_state[chat_id]["positions"].append(user_state[chat_id]["current"])
-        logger.info(f"Chat {chat_id}: Position added without attachments: {user_state[chat_id]['current']}")
-        del user_state[chat_id]["current"]
+    elif choice == "n":
+        draft = user_state[chat_id]
+        draft.positions.append(draft.current)
+        logger.info(f"Chat {chat_id}: Position added without attachments: {draft.current}")
+        draft.current = None
 
-        keyboard = [
-            [InlineKeyboardButton("Да", callback_data="yes"), InlineKeyboardButton("Нет", callback_data="no")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = ADD_MORE_KEYBOARD
         await query.edit_message_text("Позиция добавлена. Добавить ещё позицию?", reply_markup=reply_markup)
         return CONFIRM_ADD_MORE
     else:
         await query.edit_message_text("Неизвестный выбор.")
         return ATTACHMENT_CHOICE
 
+@draft_required
 async def handle_file_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Обрабатывает получение файла и сохраняет его данные в текущую позицию.
@@ -408,13 +3459,9 @@ async def handle_file_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if update.message.document:
         document = update.message.document
-        if "file_data" not in user_state[chat_id]["current"]:
-            user_state[chat_id]["current"]["file_data"] = []
-        user_state[chat_id]["current"]["file_data"].append({
-            'file_id': document.file_id,
-            'file_name': document.file_name,
-            'mime_type': document.mime_type
-        })
+        file_data = Attachment.from_document(document)
+        user_state[chat_id].current.add_file(file_data)
+        attachment_cache.prefetch(context.bot, file_data)
         logger.info(f"Chat {chat_id}: File '{document.file_name}' attached to current position.")
         await update.message.reply_text(f"Файл '{document.file_name}' успешно прикреплен.")
     else:
@@ -422,17 +3469,12 @@ async def handle_file_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Это не похоже на файл-документ. Пожалуйста, отправьте файл (документ).")
         return FILE_INPUT
 
-    keyboard = [
-        [InlineKeyboardButton("Прикрепить файл", callback_data="attach_file")],
-        [InlineKeyboardButton("Прикрепить ссылку", callback_data="attach_link")],
-        [InlineKeyboardButton("Продолжить", callback_data="no_attachment")]
-    ]
-    keyboard.append([InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = ATTACHMENT_KEYBOARD
 
     await update.message.reply_text("Что дальше?", reply_markup=reply_markup)
     return ATTACHMENT_CHOICE
 
+@draft_required
 async def handle_link_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Обрабатывает получение ссылки и сохраняет ее в текущую позицию.
@@ -440,22 +3482,17 @@ async def handle_link_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     link = update.message.text.strip()
 
-    if link.startswith("http://") or link.startswith("https://"):
-        user_state[chat_id]["current"]["link"] = link
-        logger.info(f"Chat {chat_id}: Link '{link}' attached to current position.")
-        await update.message.reply_text(f"Ссылка '{link}' успешно прикреплена.")
-    else:
+    try:
+        user_state[chat_id].current.link = link
+    except ValueError:
         logger.warning(f"Chat {chat_id}: Invalid link format for link input - '{link}'")
         await update.message.reply_text("Пожалуйста, введите корректную ссылку, начинающуюся с http:// или https://.")
         return LINK_INPUT
+    else:
+        logger.info(f"Chat {chat_id}: Link '{link}' attached to current position.")
+        await update.message.reply_text(f"Ссылка '{link}' успешно прикреплена.")
 
-    keyboard = [
-        [InlineKeyboardButton("Прикрепить файл", callback_data="attach_file")],
-        [InlineKeyboardButton("Прикрепить ссылку", callback_data="attach_link")],
-        [InlineKeyboardButton("Продолжить", callback_data="no_attachment")]
-    ]
-    keyboard.append([InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = ATTACHMENT_KEYBOARD
 
     await update.message.reply_text("Что дальше?", reply_markup=reply_markup)
     return ATTACHMENT_CHOICE
@@ -463,92 +3500,149 @@ async def handle_link_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # --- ОБРАБОТЧИКИ ДЛЯ РЕДАКТИРОВАНИЯ ---
 
-def get_positions_summary(positions):
-    """Формирует читаемую сводку позиций, включая прикрепленные ссылки и файлы."""
-    if not positions:
-        return "Позиции отсутствуют."
-    summary_lines = []
+def numbered_line(i, p, limit):
+    """Строка сводки с номером позиции, обрезанная до limit символов."""
+    line = f"{i+1}. {p.summary_line()}"
+    return line if len(line) <= limit else line[:limit - 1] + "…"
+
+def summary_pages(positions, limit):
+    """
+    Разбивает сводку позиций на страницы - диапазоны range(начало, конец), текст каждой
+    из которых не длиннее limit символов и содержит не больше SUMMARY_PAGE_POSITIONS позиций.
+    """
+    pages = []
+    start = size = 0
     for i, p in enumerate(positions):
-        line = (
-            f"{i+1}. Модуль: {p.get('module', 'N/A')} | Наименование: {p.get('name', 'N/A')} | "
-            f"Ед.изм.: {p.get('unit', 'N/A')} | Количество: {p.get('quantity', 'N/A')} | "
-            f"Дата поставки: {p.get('delivery_date', 'N/A')}"
-        )
-        if p.get('link'):
-            line += f" | Ссылка: {p['link']}"
-        if p.get('file_data') and isinstance(p['file_data'], list):
-            if p['file_data']:
-                file_names = [f_data.get('file_name', 'N/A') for f_data in p['file_data']]
-                line += f" | Файлы: {', '.join(file_names)}"
-        summary_lines.append(line)
-    return "\n".join(summary_lines)
+        length = len(numbered_line(i, p, limit)) + 1  # с переводом строки
+        if i > start and (size + length > limit + 1 or i - start >= SUMMARY_PAGE_POSITIONS):
+            pages.append(range(start, i))
+            start, size = i, 0
+        size += length
+    pages.append(range(start, len(positions)))
+    return pages
+
+def page_containing(pages, index):
+    """Номер страницы, на которой находится позиция с индексом index."""
+    for page, positions_range in enumerate(pages):
+        if index in positions_range:
+            return page
+    return len(pages) - 1
+
+def positions_page(positions, page, limit):
+    """
+    Страница сводки позиций для сообщения, где на сводку остается limit символов.
+    Возвращает текст страницы, номер страницы (приведенный к допустимому) и список страниц.
+    """
+    if not positions:
+        return "Позиции отсутствуют.", 0, [range(0)]
+    pages = summary_pages(positions, limit)
+    page = max(0, min(page, len(pages) - 1))
+    text = "\n".join(numbered_line(i, positions[i], limit) for i in pages[page])
+    return text, page, pages
+
+def with_page_navigation(markup, page, page_count):
+    """Добавляет над клавиатурой кнопки перехода между страницами сводки, если страниц несколько."""
+    if page_count <= 1:
+        return markup
+    navigation = [
+        InlineKeyboardButton("◀", callback_data=pack_callback(CB_PAGE, page - 1)) if page > 0 else EMPTY_DAY_BUTTON,
+        InlineKeyboardButton(f"{page + 1}/{page_count}", callback_data=IGNORE_CALLBACK),
+        InlineKeyboardButton("▶", callback_data=pack_callback(CB_PAGE, page + 1)) if page + 1 < page_count else EMPTY_DAY_BUTTON,
+    ]
+    return InlineKeyboardMarkup([navigation, *markup.inline_keyboard])
 
-async def edit_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+def requested_page(context):
+    """Номер страницы из callback_data кнопки перехода."""
+    try:
+        return int(context.args[0])
+    except (IndexError, ValueError, TypeError):
+        return 0
+
+@draft_required
+async def edit_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, page=0, position=None, notice=None):
     """
     Отображает сводку текущих позиций и предлагает опции редактирования/удаления/продолжения.
+    Длинная сводка показывается по страницам; position - индекс позиции, страницу
+    с которой нужно показать, notice - сообщение над сводкой.
     """
     chat_id = update.effective_chat.id
-    state = user_state.get(chat_id, {})
-    positions = state.get("positions", [])
-
-    summary_text = f"Текущие позиции в заявке:\n{get_positions_summary(positions)}\n\n"
-
-    keyboard = []
-    if positions:
-        keyboard.append([InlineKeyboardButton("Редактировать позицию", callback_data="edit_pos")])
-        keyboard.append([InlineKeyboardButton("Удалить позицию", callback_data="delete_pos")])
+    positions = user_state[chat_id].positions
 
-    keyboard.append([InlineKeyboardButton("Продолжить", callback_data="continue_final_confirm")])
-    keyboard.append([InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")])
+    header = "Текущие позиции в заявке:\n"
+    if notice:
+        header = f"{notice}\n\n{header}"
+    footer = "\n\nВыберите действие:"
+    limit = MessageLimit.MAX_TEXT_LENGTH - len(header) - len(footer)
+    if position is not None and positions:
+        page = page_containing(summary_pages(positions, limit), position)
+    summary_text, page, pages = positions_page(positions, page, limit)
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = with_page_navigation(EDIT_MENU_KEYBOARD if positions else CONTINUE_KEYBOARD, page, len(pages))
 
     if update.callback_query:
         await update.callback_query.answer()
-        await update.callback_query.edit_message_text(summary_text + "Выберите действие:", reply_markup=reply_markup)
+        await update.callback_query.edit_message_text(header + summary_text + footer, reply_markup=reply_markup)
     else:
-        await context.bot.send_message(chat_id=chat_id, text=summary_text + "Выберите действие:", reply_markup=reply_markup)
+        await context.bot.send_message(chat_id=chat_id, text=header + summary_text + footer, reply_markup=reply_markup)
 
     return EDIT_MENU
 
+async def edit_menu_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Переход на другую страницу сводки в меню редактирования."""
+    return await edit_menu_handler(update, context, page=requested_page(context))
+
+@draft_required
 async def select_position_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Предлагает пользователю выбрать позицию по номеру для редактирования или удаления.
     """
+    chat_id = update.effective_chat.id
+    action = "edit_pos" if context.args[0] == "e" else "delete_pos"
+    user_state[chat_id].action_type = action
+    return await show_position_picker(update, context)
+
+@draft_required
+async def select_position_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Переход на другую страницу выбора позиции."""
+    return await show_position_picker(update, context, page=requested_page(context))
+
+async def show_position_picker(update: Update, context: ContextTypes.DEFAULT_TYPE, page=0):
+    """
+    Страница выбора позиции: сводка позиций страницы и кнопки с их номерами.
+    """
     query = update.callback_query
     await query.answer()
 
     chat_id = query.message.chat.id
-    action = query.data
-    user_state[chat_id]['action_type'] = action
-
-    positions = user_state[chat_id].get("positions", [])
+    action = user_state[chat_id].action_type
+    positions = user_state[chat_id].positions
     if not positions:
         await query.edit_message_text("В заявке нет позиций для редактирования или удаления. "
                                       "Нажмите 'Продолжить' или 'Отмена заявки'.",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Продолжить", callback_data="continue_final_confirm")],
-                                                                         [InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")]]))
+                                      reply_markup=CONTINUE_KEYBOARD)
         return EDIT_MENU
 
+    header = f"Выберите номер позиции для { 'редактирования' if action == 'edit_pos' else 'удаления' }:\n"
+    summary_text, page, pages = positions_page(positions, page, MessageLimit.MAX_TEXT_LENGTH - len(header))
+
     keyboard = []
     buttons_per_row = 5
-    current_row = []
-    for i in range(len(positions)):
-        button_text = f"{i+1}"
-        current_row.append(InlineKeyboardButton(button_text, callback_data=f"select_pos_{i}"))
-        if (i + 1) % buttons_per_row == 0 or (i + 1) == len(positions):
-            keyboard.append(current_row)
-            current_row = []
+    buttons = [
+        InlineKeyboardButton(f"{i+1}", callback_data=pack_callback(CB_SELECT_POSITION, i))
+        for i in pages[page]
+    ]
+    for i in range(0, len(buttons), buttons_per_row):
+        keyboard.append(buttons[i:i + buttons_per_row])
 
-    keyboard.append([InlineKeyboardButton("Назад в меню", callback_data="back_to_edit_menu")])
-    keyboard.append([InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    keyboard.append([BACK_TO_MENU_BUTTON])
+    keyboard.append([CANCEL_BUTTON])
+    reply_markup = with_page_navigation(InlineKeyboardMarkup(keyboard), page, len(pages))
 
-    await query.edit_message_text(f"Выберите номер позиции для { 'редактирования' if action == 'edit_pos' else 'удаления' }:\n"
-                                  f"{get_positions_summary(positions)}", reply_markup=reply_markup)
+    await query.edit_message_text(header + summary_text, reply_markup=reply_markup)
 
     return SELECT_POSITION
 
+@draft_required
 async def process_selected_position(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Обрабатывает выбранную позицию (для редактирования или удаления).
@@ -558,43 +3652,37 @@ async def process_selected_position(update: Update, context: ContextTypes.DEFAUL
 
     chat_id = query.message.chat.id
 
-    if query.data == "back_to_edit_menu":
-        return await edit_menu_handler(update, context)
-
     try:
-        selected_index = int(query.data.split('_')[2])
+        selected_index = int(context.args[0])
     except (IndexError, ValueError):
         await query.edit_message_text("Неверный выбор позиции. Пожалуйста, попробуйте снова.",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Назад в меню", callback_data="back_to_edit_menu")],
-                                                                         [InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")]]))
+                                      reply_markup=BACK_TO_MENU_KEYBOARD)
         return SELECT_POSITION
 
-    positions = user_state[chat_id].get("positions", [])
+    positions = user_state[chat_id].positions
     if selected_index < 0 or selected_index >= len(positions):
         await query.edit_message_text("Выбрана несуществующая позиция. Пожалуйста, выберите номер из списка.",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Назад в меню", callback_data="back_to_edit_menu")],
-                                                                         [InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")]]))
+                                      reply_markup=BACK_TO_MENU_KEYBOARD)
         return SELECT_POSITION
 
-    action_type = user_state[chat_id].get('action_type')
+    action_type = user_state[chat_id].action_type
 
     if action_type == 'delete_pos':
         deleted_pos = positions.pop(selected_index)
-        logger.info(f"Chat {chat_id}: Position deleted - {deleted_pos.get('name', '')}")
-        await query.edit_message_text(f"Позиция '{deleted_pos.get('name', '')}' удалена.\n\n"
-                                      f"Текущие позиции:\n{get_positions_summary(positions)}")
-        return await edit_menu_handler(update, context)
+        logger.info(f"Chat {chat_id}: Position deleted - {deleted_pos.name}")
+        await query.edit_message_text(f"Позиция '{deleted_pos.name}' удалена.")
+        return await edit_menu_handler(update, context, position=min(selected_index, len(positions) - 1))
     elif action_type == 'edit_pos':
-        user_state[chat_id]['editing_position_index'] = selected_index
+        user_state[chat_id].editing_position_index = selected_index
         logger.info(f"Chat {chat_id}: Editing position index - {selected_index}")
         return await edit_field_selection_handler(update, context)
     else:
         logger.warning(f"Chat {chat_id}: Unknown action type in process_selected_position - {action_type}")
         await query.edit_message_text("Неизвестное действие. Пожалуйста, попробуйте снова.",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Назад в меню", callback_data="back_to_edit_menu")],
-                                                                         [InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")]]))
+                                      reply_markup=BACK_TO_MENU_KEYBOARD)
         return await edit_menu_handler(update, context)
 
+@draft_required
 async def edit_field_selection_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Предлагает пользователю выбрать поле для редактирования в выбранной позиции.
@@ -604,38 +3692,15 @@ async def edit_field_selection_handler(update: Update, context: ContextTypes.DEF
     if query: await query.answer()
 
     chat_id = update.effective_chat.id
-    selected_index = user_state[chat_id]['editing_position_index']
-    current_pos = user_state[chat_id]['positions'][selected_index]
-
-    summary_pos = (
-        f"Редактирование позиции №{selected_index+1}:\n"
-        f"Модуль: {current_pos.get('module', 'N/A')}\n"
-        f"Наименование: {current_pos.get('name', 'N/A')}\n"
-        f"Ед.изм.: {current_pos.get('unit', 'N/A')}\n"
-        f"Количество: {current_pos.get('quantity', 'N/A')}\n"
-        f"Дата поставки: {current_pos.get('delivery_date', 'N/A')}\n"
-    )
-    if current_pos.get('link'):
-        summary_pos += f"Ссылка: {current_pos['link']}\n"
-    if current_pos.get('file_data') and isinstance(current_pos['file_data'], list):
-        if current_pos['file_data']:
-            file_names = [f_data.get('file_name', 'N/A') for f_data in current_pos['file_data']]
-            summary_pos += f"Файлы: {', '.join(file_names)}\n"
+    selected_index = user_state[chat_id].editing_position_index
+    current_pos = user_state[chat_id].positions[selected_index]
+
+    summary_pos = f"Редактирование позиции №{selected_index+1}:\n"
+    summary_pos += "".join(f"{label}: {value}\n" for label, value in current_pos.details())
     summary_pos += "\n"
 
 
-    keyboard = [
-        [InlineKeyboardButton("Наименование", callback_data="edit_field_name")],
-        [InlineKeyboardButton("Ед.изм.", callback_data="edit_field_unit")],
-        [InlineKeyboardButton("Количество", callback_data="edit_field_quantity")],
-        [InlineKeyboardButton("Модуль", callback_data="edit_field_module")],
-        [InlineKeyboardButton("Дата поставки", callback_data="edit_field_delivery_date")],
-        [InlineKeyboardButton("Прикрепить/Изменить файл", callback_data="edit_field_attach_file")],
-        [InlineKeyboardButton("Прикрепить/Изменить ссылку", callback_data="edit_field_attach_link")],
-        [InlineKeyboardButton("Назад в меню", callback_data="back_to_edit_menu")],
-        [InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = EDIT_FIELDS_KEYBOARD
 
     if query:
         await query.edit_message_text(summary_pos + "Выберите поле для редактирования:", reply_markup=reply_markup)
@@ -644,6 +3709,7 @@ async def edit_field_selection_handler(update: Update, context: ContextTypes.DEF
 
     return EDIT_FIELD_SELECTION
 
+@draft_required
 async def edit_field_input_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Принимает новое значение для выбранного поля и обновляет позицию.
@@ -654,39 +3720,26 @@ async def edit_field_input_handler(update: Update, context: ContextTypes.DEFAULT
     if update.callback_query:
         query = update.callback_query
         await query.answer()
-        editing_field = query.data.replace("edit_field_", "")
-        current_state_data['editing_field'] = editing_field
+        editing_field = context.args[0]
+        current_state_data.editing_field = editing_field
         logger.info(f"Chat {chat_id}: Editing field set to {editing_field}")
 
         if editing_field == 'delivery_date':
             current_date = date.today()
-            reply_markup = create_calendar_keyboard(current_date.year, current_date.month, prefix="EDIT_CAL_")
+            reply_markup = create_calendar_keyboard(current_date.year, current_date.month, CALENDAR_EDIT)
             await query.edit_message_text("Выберите новую дату поставки:", reply_markup=reply_markup)
             return GLOBAL_DELIVERY_DATE_SELECTION
         elif editing_field == 'unit':
-            keyboard = [[InlineKeyboardButton(u, callback_data=f"edit_unit_{u}")] for u in units]
-            keyboard.append([InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("Выберите новую единицу измерения:", reply_markup=reply_markup)
+            await query.edit_message_text("Выберите новую единицу измерения:", reply_markup=EDIT_UNITS_KEYBOARD)
             return EDITING_UNIT
         elif editing_field == 'module':
-            buttons_per_row = 5
-            keyboard = []
-            current_row = []
-            for i, m in enumerate(modules):
-                current_row.append(InlineKeyboardButton(m, callback_data=f"edit_module_{m}"))
-                if (i + 1) % buttons_per_row == 0 or (i + 1) == len(modules):
-                    keyboard.append(current_row)
-                    current_row = []
-            keyboard.append([InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("Выберите новый модуль:", reply_markup=reply_markup)
+            await query.edit_message_text("Выберите новый модуль:", reply_markup=EDIT_MODULES_KEYBOARD)
             return EDITING_MODULE
         elif editing_field == 'attach_file':
-            await query.edit_message_text("Пожалуйста, **отправьте мне файл** (как документ) для этой позиции.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")]]))
+            await query.edit_message_text("Пожалуйста, **отправьте мне файл** (как документ) для этой позиции.", reply_markup=CANCEL_KEYBOARD)
             return EDIT_FIELD_INPUT
         elif editing_field == 'attach_link':
-            await query.edit_message_text("Пожалуйста, **введите ссылку** для этой позиции.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")]]))
+            await query.edit_message_text("Пожалуйста, **введите ссылку** для этой позиции.", reply_markup=CANCEL_KEYBOARD)
             return EDIT_FIELD_INPUT
         else:
             field_name_ru = {
@@ -696,37 +3749,36 @@ async def edit_field_input_handler(update: Update, context: ContextTypes.DEFAULT
             await query.edit_message_text(f"Введите новое {field_name_ru}:")
             return EDIT_FIELD_INPUT
 
-    editing_position_index = current_state_data['editing_position_index']
-    editing_field = current_state_data['editing_field']
-    current_position = current_state_data['positions'][editing_position_index]
+    editing_position_index = current_state_data.editing_position_index
+    editing_field = current_state_data.editing_field
+    current_position = current_state_data.positions[editing_position_index]
 
     if editing_field == 'quantity':
         try:
-            new_value = float(update.message.text)
-            current_position[editing_field] = new_value
+            current_position.quantity = update.message.text
+            new_value = current_position.quantity
             logger.info(f"Chat {chat_id}: Position field '{editing_field}' updated to '{new_value}' for index {editing_position_index}")
             await update.message.reply_text(f"Поле '{editing_field}' обновлено.")
             return await edit_menu_handler(update, context)
         except ValueError:
             logger.warning(f"Chat {chat_id}: Invalid quantity format for edit - '{update.message.text}'")
-            await update.message.reply_text("Неверный формат количества. Пожалуйста, введите число (например, 5 или 3.5):")
+            await update.message.reply_text("Неверный формат количества. Пожалуйста, введите положительное число (например, 5 или 3.5):")
             return EDIT_FIELD_INPUT
     elif editing_field == 'name':
         new_value = update.message.text.strip()
-        current_position[editing_field] = new_value
+        if not new_value:
+            await update.message.reply_text("Наименование не может быть пустым. Введите новое наименование:")
+            return EDIT_FIELD_INPUT
+        current_position.name = new_value
         logger.info(f"Chat {chat_id}: Position field '{editing_field}' updated to '{new_value}' for index {editing_position_index}")
         await update.message.reply_text(f"Поле '{editing_field}' обновлено.")
         return await edit_menu_handler(update, context)
     elif editing_field == 'attach_file':
         if update.message.document:
             document = update.message.document
-            if "file_data" not in current_position:
-                current_position["file_data"] = []
-            current_position["file_data"].append({
-                'file_id': document.file_id,
-                'file_name': document.file_name,
-                'mime_type': document.mime_type
-            })
+            file_data = Attachment.from_document(document)
+            current_position.add_file(file_data)
+            attachment_cache.prefetch(context.bot, file_data)
             logger.info(f"Chat {chat_id}: File '{document.file_name}' attached to position {editing_position_index}.")
             await update.message.reply_text(f"Файл '{document.file_name}' успешно прикреплен к позиции.")
             return await edit_menu_handler(update, context)
@@ -736,20 +3788,21 @@ async def edit_field_input_handler(update: Update, context: ContextTypes.DEFAULT
             return EDIT_FIELD_INPUT
     elif editing_field == 'attach_link':
         link = update.message.text.strip()
-        if link.startswith("http://") or link.startswith("https://"):
-            current_position['link'] = link
-            logger.info(f"Chat {chat_id}: Link '{link}' attached to position {editing_position_index}.")
-            await update.message.reply_text(f"Ссылка '{link}' успешно прикреплена к позиции.")
-            return await edit_menu_handler(update, context)
-        else:
+        try:
+            current_position.link = link
+        except ValueError:
             logger.warning(f"Chat {chat_id}: Invalid link format for attach_link - '{link}'")
             await update.message.reply_text("Пожалуйста, введите корректную ссылку, начинающуюся с http:// или https://.")
             return EDIT_FIELD_INPUT
+        logger.info(f"Chat {chat_id}: Link '{link}' attached to position {editing_position_index}.")
+        await update.message.reply_text(f"Ссылка '{link}' успешно прикреплена к позиции.")
+        return await edit_menu_handler(update, context)
     else:
         logger.warning(f"Chat {chat_id}: Unexpected field or input type in edit_field_input_handler: field={editing_field}, update.message={update.message}")
         await update.message.reply_text("Произошла неизвестная ошибка при редактировании. Пожалуйста, попробуйте снова.")
         return await edit_menu_handler(update, context)
 
+@draft_required
 async def process_edited_unit_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Обрабатывает выбор единицы измерения при редактировании.
@@ -758,15 +3811,16 @@ async def process_edited_unit_selection(update: Update, context: ContextTypes.DE
     await query.answer()
 
     chat_id = query.message.chat.id
-    selected_unit = query.data.replace("edit_unit_", "")
+    selected_unit = picked(units, context)
 
-    editing_position_index = user_state[chat_id]['editing_position_index']
-    user_state[chat_id]['positions'][editing_position_index]['unit'] = selected_unit
+    editing_position_index = user_state[chat_id].editing_position_index
+    user_state[chat_id].positions[editing_position_index].unit = selected_unit
     logger.info(f"Chat {chat_id}: Position unit updated to '{selected_unit}' for index {editing_position_index}")
 
     await query.edit_message_text(f"Единица измерения обновлена на '{selected_unit}'.")
     return await edit_menu_handler(update, context)
 
+@draft_required
 async def process_edited_module_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Обрабатывает выбор модуля при редактировании.
@@ -775,16 +3829,17 @@ async def process_edited_module_selection(update: Update, context: ContextTypes.
     await query.answer()
 
     chat_id = query.message.chat.id
-    selected_module = query.data.replace("edit_module_", "")
+    selected_module = picked(modules, context)
 
-    editing_position_index = user_state[chat_id]['editing_position_index']
-    user_state[chat_id]['positions'][editing_position_index]['module'] = selected_module
+    editing_position_index = user_state[chat_id].editing_position_index
+    user_state[chat_id].positions[editing_position_index].module = selected_module
     logger.info(f"Chat {chat_id}: Position module updated to '{selected_module}'.")
 
     await query.edit_message_text(f"Модуль обновлен на '{selected_module}'.")
     return await edit_menu_handler(update, context)
 
 
+@draft_required
 async def confirm_add_more_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Обрабатывает подтверждение добавления новой позиции или переход в меню редактирования.
@@ -794,123 +3849,312 @@ async def confirm_add_more_handler(update: Update, context: ContextTypes.DEFAULT
 
     chat_id = query.message.chat.id
 
-    if query.data == "yes":
+    if context.args[0] == "1":
         logger.info(f"Chat {chat_id}: User wants to add more positions.")
-        await query.edit_message_text("Введите наименование позиции:")
+        await query.edit_message_text(NAME_PROMPT, reply_markup=NAME_PROMPT_KEYBOARD)
         return NAME
     else:
         logger.info(f"Chat {chat_id}: User finished adding positions, proceeding to edit menu.")
         return await edit_menu_handler(update, context)
 
+# --- ИМПОРТ ПОЗИЦИЙ ИЗ ФАЙЛА ---
+
+@draft_required
+async def import_prompt_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Просит отправить файл с позициями."""
+    query = update.callback_query
+    await query.answer()
+    await query.edit_message_text(
+        "Отправьте файл .xlsx или .csv (как документ) со строкой заголовков и столбцами: "
+        f"{', '.join(IMPORT_COLUMN_LABELS[field] for field in IMPORT_REQUIRED_COLUMNS)} (ДД.ММ.ГГГГ) "
+        "и, по желанию, Ссылка. "
+        "Подойдет и заполненный бланк заявки.\n\n"
+        f"Ед. изм.: {', '.join(units)}. Модуль: 1-{len(modules)}.",
+        reply_markup=BACK_TO_MENU_KEYBOARD,
+    )
+    return IMPORT_FILE
+
+@draft_required
+async def import_file_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Добавляет в заявку позиции из присланного файла и показывает меню редактирования.
+    О строках, которые не удалось импортировать, сообщается отдельным списком.
+    """
+    chat_id = update.effective_chat.id
+    document = update.message.document
+    file_name = document.file_name or ""
+
+    if not file_name.lower().endswith(IMPORT_EXTENSIONS):
+        await update.message.reply_text("Поддерживаются файлы .xlsx и .csv. Отправьте файл с позициями:",
+                                        reply_markup=BACK_TO_MENU_KEYBOARD)
+        return IMPORT_FILE
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await update.message.reply_text(f"Файл больше {IMPORT_MAX_BYTES // (1024 * 1024)} МБ. Отправьте файл поменьше:",
+                                        reply_markup=BACK_TO_MENU_KEYBOARD)
+        return IMPORT_FILE
+
+    try:
+        telegram_file = await context.bot.get_file(document.file_id)
+        data = bytes(await telegram_file.download_as_bytearray())
+        positions, errors = await asyncio.to_thread(parse_positions_file, data, file_name)
+    except Exception as e:
+        logger.warning(f"Chat {chat_id}: import of '{file_name}' failed: {e!r}")
+        await update.message.reply_text(f"Не удалось прочитать файл: {describe_error(e)}\n"
+                                        f"Исправьте файл и отправьте его снова:", reply_markup=BACK_TO_MENU_KEYBOARD)
+        return IMPORT_FILE
+
+    logger.info(f"Chat {chat_id}: imported {len(positions)} positions from '{file_name}', {len(errors)} rows rejected")
+    report = f"Из файла «{file_name}» добавлено позиций: {len(positions)}."
+    if errors:
+        report += f"\n\nНе импортированы строки ({len(errors)}):\n" + "\n".join(errors)
+    for chunk in split_message(report):
+        await update.message.reply_text(chunk)
+
+    if not positions:
+        await update.message.reply_text("Исправьте файл и отправьте его снова:", reply_markup=BACK_TO_MENU_KEYBOARD)
+        return IMPORT_FILE
+
+    draft = user_state[chat_id]
+    first_imported = len(draft.positions)
+    draft.positions.extend(positions)
+    return await edit_menu_handler(update, context, position=first_imported)
+
+@draft_required
+async def quick_entry_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Быстрый ввод: добавляет позиции из строк сообщения и показывает меню редактирования.
+    Если ни одна строка не распознана, диалог остается в текущем состоянии.
+    """
+    chat_id = update.effective_chat.id
+    positions, errors = parse_quick_entry(update.message.text)
+    logger.info(f"Chat {chat_id}: quick entry added {len(positions)} positions, {len(errors)} lines rejected")
+
+    report = f"Добавлено позиций: {len(positions)}."
+    if errors:
+        report += f"\n\nНе распознаны строки ({len(errors)}):\n" + "\n".join(errors)
+    for chunk in split_message(report):
+        await update.message.reply_text(chunk)
+    if not positions:
+        return None
+
+    draft = user_state[chat_id]
+    first_added = len(draft.positions)
+    draft.positions.extend(positions)
+    return await edit_menu_handler(update, context, position=first_added)
+
+# --- ПОВТОР ЗАЯВКИ ---
+
+REQUEST_NUMBER_FILTER = filters.Regex(r"^\s*[№#]\s*\d+\s*$")
+
+async def add_request_positions(update: Update, context: ContextTypes.DEFAULT_TYPE, entry_id=None):
+    """
+    Добавляет в черновик позиции прошлой заявки (entry_id=None - последней по проекту
+    и объекту) и показывает меню редактирования. Начать можно со своей заявки или с заявки
+    по тем же проекту и объекту. Прошедшие даты поставки сбрасываются.
+    """
+    chat_id = update.effective_chat.id
+    draft = user_state[chat_id]
+    if entry_id is None:
+        row = await asyncio.to_thread(request_history.last_for_scope, draft.project, draft.object_name)
+        missing = "По этому проекту и объекту еще не было заявок."
+    else:
+        row = await asyncio.to_thread(request_history.get, entry_id)
+        if row is not None and row["chat_id"] != chat_id and (row["project"], row["object"]) != (draft.project, draft.object_name):
+            row = None
+        missing = f"Заявка №{entry_id} не найдена среди ваших заявок и заявок по этому проекту и объекту."
+
+    if row is None:
+        if update.callback_query:
+            await update.callback_query.answer()
+            await update.callback_query.edit_message_text(f"{missing}\n\n{NAME_PROMPT}", reply_markup=NAME_PROMPT_KEYBOARD)
+        else:
+            await update.message.reply_text(f"{missing}\n\n{NAME_PROMPT}", reply_markup=NAME_PROMPT_KEYBOARD)
+        return NAME
+
+    positions = [Position.from_data(data) for data in json.loads(row["positions"])]
+    today = date.today()
+    expired = 0
+    for position in positions:
+        if position.delivery_date is not None and position.delivery_date < today:
+            position.delivery_date = None
+            expired += 1
+    logger.info(f"Chat {chat_id}: {len(positions)} positions copied from request #{row['id']}")
+
+    notice = f"Добавлены позиции из заявки №{row['id']} ({row['project']}, {row['object']}): {len(positions)}."
+    if expired:
+        notice += f"\nДата поставки прошла у {expired} из них - укажите новую через «Редактировать позицию»."
+    first_added = len(draft.positions)
+    draft.positions.extend(positions)
+    return await edit_menu_handler(update, context, position=first_added, notice=notice)
+
+@draft_required
+async def repeat_request_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопки "Повторить прошлую заявку" и выбора заявки из списка."""
+    return await add_request_positions(update, context, int(context.args[0]) if context.args else None)
+
+@draft_required
+async def request_number_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сообщение с номером заявки (например, "№123"), с которой начать."""
+    return await add_request_positions(update, context, int(re.search(r"\d+", update.message.text).group()))
+
+@draft_required
+async def request_history_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показывает последние заявки пользователя, с любой из которых можно начать."""
+    query = update.callback_query
+    await query.answer()
+
+    rows = await asyncio.to_thread(request_history.recent_for_chat, query.message.chat.id, HISTORY_RECENT_REQUESTS)
+    keyboard = [
+        [InlineKeyboardButton(
+            f"№{row['id']} от {datetime.fromtimestamp(row['created_at']):%d.%m.%Y}: {row['object']}, "
+            f"позиций: {row['position_count']}",
+            callback_data=pack_callback(CB_REPEAT, row["id"]),
+        )]
+        for row in rows
+    ]
+    keyboard += [[NAME_PROMPT_BACK_BUTTON], [CANCEL_BUTTON]]
+    text = ("Выберите заявку, с позиций которой начать, или отправьте ее номер (например, №123):" if rows
+            else "Вы еще не отправляли заявок. Можно отправить номер заявки коллеги по этому проекту и объекту (например, №123).")
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    return NAME
+
+# --- ПОДСКАЗКИ НАИМЕНОВАНИЙ ---
+
+async def inline_name_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Подсказывает наименования из прошлых заявок: пользователь набирает в поле ввода
+    @имя_бота и часть наименования, а выбранная подсказка отправляется обычным сообщением
+    и попадает в name_handler. Выше - наименования из заявок выбранных проекта и объекта.
+    """
+    query = update.inline_query
+    if name_index.stale(NAME_INDEX_REFRESH_INTERVAL) and not name_index.refreshing:
+        context.application.create_task(name_index.refresh(outbox))
+
+    draft = user_state.peek(query.from_user.id)
+    scope = (draft.project, draft.object_name) if draft else None
+    results = [
+        InlineQueryResultArticle(
+            id=str(n),
+            title=name,
+            description=f"{unit or 'ед.изм. не указана'} · в заявках: {count}",
+            input_message_content=InputTextMessageContent(name),
+        )
+        for n, (name, unit, count) in enumerate(name_index.search(query.query, scope, INLINE_RESULTS_LIMIT))
+    ]
+    await query.answer(results, cache_time=30, is_personal=True)
+
 # --- ОБРАБОТЧИКИ ДЛЯ КАЛЕНДАРЯ ---
 
-def create_calendar_keyboard(year, month, prefix="CAL_"):
+_calendar_day = None
+
+def create_calendar_keyboard(year, month, mode=CALENDAR_EDIT):
     """
-    Генерирует Inline-клавиатуру для выбора даты.
+    Возвращает Inline-клавиатуру для выбора даты. Клавиатуры кэшируются по (year, month, mode);
+    кэш сбрасывается при смене суток, чтобы в нем оставались только месяцы вокруг текущей даты.
     """
+    global _calendar_day
+    today = date.today()
+    if today != _calendar_day:
+        _calendar_keyboard.cache_clear()
+        _calendar_day = today
+    return _calendar_keyboard(year, month, mode)
+
+@functools.lru_cache(maxsize=CALENDAR_CACHE_SIZE)
+def _calendar_keyboard(year, month, mode):
+    prev_year, prev_month = (year, month - 1) if month > 1 else (year - 1, 12)
+    next_year, next_month = (year, month + 1) if month < 12 else (year + 1, 1)
     keyboard = []
     keyboard.append([
-        InlineKeyboardButton("<<", callback_data=f"{prefix}NAV_{year-1}_{month}"),
-        InlineKeyboardButton("<", callback_data=f"{prefix}NAV_{year}_{month-1 if month > 1 else 12}"),
-        InlineKeyboardButton(f"{calendar.month_name[month]} {year}", callback_data="ignore"),
-        InlineKeyboardButton(">", callback_data=f"{prefix}NAV_{year}_{month+1 if month < 12 else 1}"),
-        InlineKeyboardButton(">>", callback_data=f"{prefix}NAV_{year+1}_{month}")
+        InlineKeyboardButton("<<", callback_data=pack_callback(CB_CALENDAR_NAV, mode, year - 1, month)),
+        InlineKeyboardButton("<", callback_data=pack_callback(CB_CALENDAR_NAV, mode, prev_year, prev_month)),
+        InlineKeyboardButton(f"{calendar.month_name[month]} {year}", callback_data=IGNORE_CALLBACK),
+        InlineKeyboardButton(">", callback_data=pack_callback(CB_CALENDAR_NAV, mode, next_year, next_month)),
+        InlineKeyboardButton(">>", callback_data=pack_callback(CB_CALENDAR_NAV, mode, year + 1, month))
     ])
 
-    weekdays = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
-    keyboard.append([InlineKeyboardButton(day, callback_data="ignore") for day in weekdays])
+    keyboard.append(WEEKDAYS_ROW)
 
-    cal = calendar.Calendar()
-    for week in cal.monthdayscalendar(year, month):
+    for week in CALENDAR.monthdayscalendar(year, month):
         row = []
         for day in week:
             if day == 0:
-                row.append(InlineKeyboardButton(" ", callback_data="ignore"))
+                row.append(EMPTY_DAY_BUTTON)
             else:
-                current_day = date(year, month, day)
-                row.append(InlineKeyboardButton(str(day), callback_data=f"{prefix}DATE_{current_day.isoformat()}"))
+                row.append(InlineKeyboardButton(
+                    str(day), callback_data=pack_callback(CB_CALENDAR_DATE, mode, f"{year:04d}{month:02d}{day:02d}")
+                ))
         keyboard.append(row)
 
-    keyboard.append([InlineKeyboardButton("Отмена выбора даты", callback_data=f"{prefix}CANCEL")])
-    keyboard.append([InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")])
+    keyboard.append([InlineKeyboardButton("Отмена выбора даты", callback_data=pack_callback(CB_CALENDAR_CANCEL, mode))])
+    keyboard.append([CANCEL_BUTTON])
 
     return InlineKeyboardMarkup(keyboard)
 
-async def process_global_calendar_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@draft_required
+async def process_edited_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Обрабатывает нажатия на кнопки календаря (навигация или выбор даты) для глобальной даты.
-    Используется также для редактирования даты поставки отдельной позиции.
+    Сохраняет новую дату поставки редактируемой позиции.
     """
     query = update.callback_query
     await query.answer()
-
-    data = query.data
     chat_id = query.message.chat.id
 
-    if data.startswith("CAL_NAV_") or data.startswith("EDIT_CAL_NAV_"):
-        parts = data.split('_')
-        year = int(parts[2]) if data.startswith("CAL_NAV_") else int(parts[3])
-        month = int(parts[3]) if data.startswith("CAL_NAV_") else int(parts[4])
-        prefix = "CAL_" if data.startswith("CAL_NAV_") else "EDIT_CAL_"
-
-        if month > 12:
-            month = 1
-            year += 1
-        elif month < 1:
-            month = 12
-            year -= 1
-
-        reply_markup = create_calendar_keyboard(year, month, prefix=prefix)
-        await query.edit_message_text("Выберите дату:", reply_markup=reply_markup)
-        return GLOBAL_DELIVERY_DATE_SELECTION
-
-    elif data.startswith("CAL_DATE_") or data.startswith("EDIT_CAL_DATE_"):
-        selected_date_str = data.replace("CAL_DATE_", "").replace("EDIT_CAL_DATE_", "")
-
-        if user_state[chat_id].get('editing_field') == 'delivery_date':
-            editing_position_index = user_state[chat_id]['editing_position_index']
-            user_state[chat_id]['positions'][editing_position_index]['delivery_date'] = selected_date_str
-            logger.info(f"Chat {chat_id}: Position {editing_position_index} delivery date updated to {selected_date_str}")
-            await query.edit_message_text(f"Дата поставки обновлена на {selected_date_str}.")
-            return await edit_menu_handler(update, context)
-        else:
-            pass
+    selected_date = callback_date(context.args[1])
+    if user_state[chat_id].editing_field == 'delivery_date':
+        editing_position_index = user_state[chat_id].editing_position_index
+        user_state[chat_id].positions[editing_position_index].delivery_date = selected_date
+        logger.info(f"Chat {chat_id}: Position {editing_position_index} delivery date updated to {selected_date}")
+        await query.edit_message_text(f"Дата поставки обновлена на {selected_date.isoformat()}.")
 
-        return await edit_menu_handler(update, context)
+    return await edit_menu_handler(update, context)
 
-    elif data == "CAL_CANCEL" or data == "EDIT_CAL_CANCEL":
-        logger.info(f"Chat {chat_id}: Calendar date selection cancelled.")
-        await query.edit_message_text("Выбор даты отменен")
-        return await edit_menu_handler(update, context)
+@draft_required
+async def cancel_edited_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отменяет выбор новой даты поставки и возвращает в меню редактирования."""
+    query = update.callback_query
+    await query.answer()
 
-    return GLOBAL_DELIVERY_DATE_SELECTION
+    logger.info(f"Chat {query.message.chat.id}: Calendar date selection cancelled.")
+    await query.edit_message_text("Выбор даты отменен")
+    return await edit_menu_handler(update, context)
+
+async def ignore_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопки-подписи календаря (месяц, дни недели) ничего не делают."""
+    await update.callback_query.answer()
+
+async def stale_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Нажатие на кнопку старого формата или из сообщения, которое уже не относится к диалогу."""
+    await update.callback_query.answer("Эта кнопка устарела. Продолжите в последнем сообщении или начните заново: /start")
 
 # --- ФИНАЛЬНОЕ ПОДТВЕРЖДЕНИЕ И ОТПРАВКА ---
 
-async def show_final_summary_and_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@draft_required
+async def show_final_summary_and_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, page=0):
     """
     Формирует финальное резюме заявки и запрашивает подтверждение отправки.
+    Позиции длинной заявки показываются по страницам.
     """
     chat_id = update.effective_chat.id
     state = user_state[chat_id]
 
-    positions_summary = get_positions_summary(state["positions"])
-
-    full_summary = (
-        f"Проект: {state['project']}\n"
-        f"Объект: {state['object']}\n"
-        f"От кого: {state.get('user_full_name', 'Неизвестно')}\n"
-        f"Telegram ID: {state.get('telegram_id_or_username', 'Неизвестно')}\n\n"
-        f"Позиции:\n{positions_summary}\n\n"
+    header = (
+        f"Проект: {state.project}\n"
+        f"Объект: {state.object_name}\n"
+        f"От кого: {state.user_full_name}\n"
+        f"Telegram ID: {state.telegram_id_or_username}\n\n"
+        f"Позиции:\n"
     )
+    if delivery_backend(state.project) == "telegram":
+        footer = "\n\nОтправить заявку в чат отдела снабжения? (Да/Нет)"
+    else:
+        footer = "\n\nОтправить заявку на почту? (Да/Нет)"
 
-    full_summary += "Отправить заявку на почту? (Да/Нет)"
+    positions_summary, page, pages = positions_page(
+        state.positions, page, MessageLimit.MAX_TEXT_LENGTH - len(header) - len(footer)
+    )
+    full_summary = header + positions_summary + footer
 
-    keyboard = [
-        [InlineKeyboardButton("Да", callback_data="final_yes"), InlineKeyboardButton("Нет", callback_data="final_no")],
-        [InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = with_page_navigation(FINAL_CONFIRM_KEYBOARD, page, len(pages))
 
     if update.callback_query:
         await update.callback_query.edit_message_text(full_summary, reply_markup=reply_markup)
@@ -919,48 +4163,58 @@ async def show_final_summary_and_confirm(update: Update, context: ContextTypes.D
 
     return FINAL_CONFIRMATION
 
+async def final_summary_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Переход на другую страницу финального резюме."""
+    await update.callback_query.answer()
+    return await show_final_summary_and_confirm(update, context, page=requested_page(context))
+
+@draft_required
 async def final_confirm_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обрабатывает финальное подтверждение и отправляет заявку или отменяет ее."""
+    """
+    Обрабатывает финальное подтверждение. Заявка сохраняется в очередь отправки,
+    а письмо отправляется фоновым обработчиком с повторами при ошибках.
+    """
     query = update.callback_query
     await query.answer()
 
     chat_id = query.message.chat.id
     state = user_state[chat_id]
 
-    if query.data == "final_yes":
+    if context.args[0] == "1":
+        request = {
+            "project": state.project,
+            "object": state.object_name,
+            "positions": [p.to_data() for p in state.positions],
+            "user_full_name": state.user_full_name,
+            "telegram_id_or_username": state.telegram_id_or_username,
+        }
         try:
-            email_sent = await send_email(
-                chat_id,
-                state["project"],
-                state["object"],
-                state["positions"],
-                state.get("user_full_name", "Неизвестно"),
-                state.get("telegram_id_or_username", "Неизвестно"),
-                context=context
-            )
-            if email_sent:
-                await query.edit_message_text("Заявка успешно отправлена на почту в отдел снабжения!")
-            else:
-                await query.edit_message_text("Заявка отправлена, но возникли проблемы при отправке письма. Пожалуйста, проверьте логи.")
+            entry_id = await asyncio.to_thread(outbox.enqueue, chat_id, query.message.message_id, request)
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении заявки в очередь отправки: {e}")
+            await query.edit_message_text(f"Произошла ошибка при сохранении заявки: {e}\nПопробовать отправить еще раз?",
+                                          reply_markup=query.message.reply_markup)
+            return FINAL_CONFIRMATION
+        try:
+            await asyncio.to_thread(request_history.record, entry_id, chat_id, request)
+        except Exception as e:
+            # Заявка уже в очереди; в историю ее перенесет RequestHistory.catch_up при следующем запуске
+            logger.warning(f"Failed to record request #{entry_id} in history: {e}")
 
-            keyboard = [[KeyboardButton("Создать заявку")]]
-            reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=False, resize_keyboard=True)
-            await context.bot.send_message(chat_id=chat_id, text="Для создания новой заявки:", reply_markup=reply_markup)
+        outbox_worker.wake()
+        context.application.create_task(name_index.refresh(outbox))
+        logger.info(f"Chat {chat_id}: request queued for delivery as #{entry_id}")
+        await query.edit_message_text(f"Заявка №{entry_id} принята и поставлена в очередь на отправку в отдел снабжения.")
 
-            if chat_id in user_state:
-                del user_state[chat_id]
-        except Exception as e:
-            logger.error(f"Ошибка в final_confirm_handler: {e}")
-            await query.edit_message_text(f"Произошла ошибка при отправке заявки: {e}\nПожалуйста, попробуйте еще раз позднее.")
-            keyboard = [[KeyboardButton("Создать заявку")]]
-            reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=False, resize_keyboard=True)
-            await context.bot.send_message(chat_id=chat_id, text="Для создания новой заявки:", reply_markup=reply_markup)
+        reply_markup = CREATE_REQUEST_KEYBOARD
+        await context.bot.send_message(chat_id=chat_id, text="Для создания новой заявки:", reply_markup=reply_markup)
 
+        if chat_id in user_state:
+            del user_state[chat_id]
         return ConversationHandler.END
     else:
         await query.edit_message_text("Отправка заявки отменена")
-        keyboard = [[KeyboardButton("Создать заявку")]]
-        reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=False, resize_keyboard=True)
+        reply_markup = CREATE_REQUEST_KEYBOARD
         await context.bot.send_message(chat_id=chat_id, text="Для создания новой заявки:", reply_markup=reply_markup)
         if chat_id in user_state:
             del user_state[chat_id]
@@ -981,8 +4235,7 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception as e:
             logger.warning(f"Failed to edit message to remove inline keyboard after cancel: {e}")
 
-    keyboard = [[KeyboardButton("Создать заявку")]]
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=False, resize_keyboard=True)
+    reply_markup = CREATE_REQUEST_KEYBOARD
     await context.bot.send_message(chat_id=chat_id, text="Для создания новой заявки:", reply_markup=reply_markup)
 
     if chat_id in user_state:
@@ -991,11 +4244,32 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     return ConversationHandler.END
 
+async def warm_draft(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Загружает черновик чата до остальных обработчиков, чтобы они не читали базу в цикле событий."""
+    chat_id = update_chat_key(update)
+    if chat_id is not None:
+        await user_state.warm(chat_id)
+
+async def draft_timeout_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сообщает пользователю, что черновик заявки удален из-за долгого бездействия."""
+    chat_id = update.effective_chat.id
+    # Срабатывает из очереди задач, а не из обработчика обновлений, поэтому блокируем чат явно
+    async with chat_locks.hold(chat_id):
+        await user_state.warm(chat_id)
+        user_state.drop_expired(chat_id)
+    logger.info(f"Chat {chat_id}: conversation timed out, draft removed.")
+
+    reply_markup = CREATE_REQUEST_KEYBOARD
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text="Черновик заявки удален из-за долгого бездействия. Для создания новой заявки:",
+        reply_markup=reply_markup
+    )
+
 async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Ответ на неизвестные команды или сообщения, не относящиеся к текущему диалогу."""
     chat_id = update.effective_chat.id
-    keyboard = [[KeyboardButton("Создать заявку")]]
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=False, resize_keyboard=True)
+    reply_markup = CREATE_REQUEST_KEYBOARD
 
     if update.message:
         await update.message.reply_text("Извините, я не понял вашу команду или сообщение. Пожалуйста, используйте кнопку 'Создать заявку' или начните заново командой /start.", reply_markup=reply_markup)
@@ -1003,109 +4277,463 @@ async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.callback_query.answer("Неизвестное действие.")
         await context.bot.send_message(chat_id=chat_id, text=".", reply_markup=reply_markup)
 
+def open_storage():
+    """
+    Открывает базу бота и создает работающие с ней хранилища: очередь отправки, черновики,
+    историю и архив заявок. Вызывается при запуске бота, поэтому импорт модуля (например,
+    из bench.py) базу не создает и не меняет.
+    """
+    global outbox, outbox_worker, request_history, request_archive, user_state
+    outbox = Outbox(DB_PATH, SHARD_INDEX, SHARD_COUNT)
+    outbox_worker = OutboxWorker(outbox)
+    request_history = RequestHistory(DB_PATH)
+    if ARCHIVE_DIR:
+        request_archive = RequestArchive(DB_PATH, ARCHIVE_DIR, ARCHIVE_RETENTION_DAYS, ARCHIVE_MAX_BYTES,
+                                         ARCHIVE_CLEANUP_INTERVAL)
+    user_state = DraftStore(
+        SqliteStateBackend(DB_PATH, SHARD_INDEX, SHARD_COUNT) if STATE_BACKEND == "sqlite" else MemoryStateBackend(),
+        flush_interval=STATE_FLUSH_INTERVAL,
+        ttl=DRAFT_TTL,
+        max_live=DRAFT_MAX_LIVE,
+    )
+
+async def on_startup(app):
+    """Запускает фоновые задачи бота."""
+    start_excel_pool()
+    await asyncio.to_thread(attachment_cache.load)
+    user_state.start()
+    outbox_worker.start(app.bot)
+    if request_archive is not None and SHARD_INDEX == 0:
+        # Очисткой общего архива занимается один процесс
+        request_archive.start()
+    caught_up = await asyncio.to_thread(request_history.catch_up)
+    if caught_up:
+        logger.info(f"History: {caught_up} request(s) copied from the outbox")
+    await name_index.refresh(outbox)
+
+async def on_shutdown(app):
+    """Освобождает ресурсы при остановке бота."""
+    await outbox_worker.stop()
+    await attachment_cache.stop()
+    await user_state.stop()
+    stop_excel_pool()
+    smtp_pool.close()
+    outbox.close()
+    request_history.close()
+    if request_archive is not None:
+        await request_archive.stop()
+
+# --- WEBHOOK ---
+
+class WebhookUnavailable(Exception):
+    """Webhook-сервер не удалось запустить; бот переключается на опрос."""
+
+def webhook_authorized(request):
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    return not WEBHOOK_SECRET or hmac.compare_digest(secret, WEBHOOK_SECRET)
+
+def webhook_app(app):
+    """
+    HTTP-приложение aiohttp: POST WEBHOOK_PATH принимает обновления от Telegram
+    (с проверкой заголовка X-Telegram-Bot-Api-Secret-Token), GET /healthz - проверка состояния.
+    Для локальной проверки WEBHOOK_URL можно не задавать и отправлять сохраненные обновления:
+    curl -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" -H "Content-Type: application/json" \
+         -d @update.json http://localhost:8080/telegram
+    """
+    from aiohttp import web
+
+    async def receive_update(request):
+        if not webhook_authorized(request):
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), app.bot)
+        except Exception as e:
+            logger.warning(f"Webhook: некорректное обновление: {e}")
+            return web.Response(status=400)
+        await app.update_queue.put(update)
+        return web.Response()
+
+    async def health(request):
+        return web.json_response(
+            {
+                "status": "ok" if app.running else "starting",
+                "mode": "webhook",
+                "update_queue": app.update_queue.qsize(),
+                "drafts": user_state.stats(),
+            },
+            status=200 if app.running else 503,
+        )
+
+    web_app = web.Application()
+    web_app.router.add_post(WEBHOOK_PATH, receive_update)
+    web_app.router.add_get("/healthz", health)
+    return web_app
+
+async def run_webhook(app):
+    """
+    Запускает бота в режиме webhook. Если aiohttp не установлен, порт занят или Telegram
+    не принял адрес webhook, выбрасывает WebhookUnavailable до запуска приложения.
+    """
+    try:
+        from aiohttp import web
+    except ImportError as e:
+        raise WebhookUnavailable(f"aiohttp не установлен: {e}")
+
+    runner = web.AppRunner(webhook_app(app))
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+    except OSError as e:
+        await runner.cleanup()
+        raise WebhookUnavailable(f"не удалось открыть порт {WEBHOOK_PORT}: {e}")
+
+    try:
+        await app.initialize()
+        if WEBHOOK_URL:
+            await app.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=Update.ALL_TYPES,
+            )
+    except Exception as e:
+        await runner.cleanup()
+        raise WebhookUnavailable(f"не удалось зарегистрировать webhook: {e}")
+    logger.info(f"Webhook server listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        # Тот же порядок запуска и остановки, что и в Application.run_polling
+        await app.post_init(app)
+        await app.start()
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        if app.running:
+            await app.stop()
+        await app.shutdown()
+        await app.post_shutdown(app)
+
+# --- ШАРДИРОВАНИЕ ---
+
+def shard_env(index):
+    """Окружение процесса-шарда: локальный webhook без регистрации в Telegram и свой каталог кэша."""
+    return dict(
+        os.environ,
+        RUN_MODE="webhook",
+        WEBHOOK_URL="",
+        WEBHOOK_LISTEN="127.0.0.1",
+        WEBHOOK_PORT=str(SHARD_BASE_PORT + index),
+        SHARD_INDEX=str(index),
+        SHARD_COUNT=str(SHARDS),
+        ATTACHMENT_CACHE_DIR=os.path.join(ATTACHMENT_CACHE_DIR, f"shard{index}"),
+        ATTACHMENT_CACHE_MAX_BYTES=str(ATTACHMENT_CACHE_MAX_BYTES // SHARDS),
+    )
+
+async def keep_shard_running(index, processes, stop):
+    """Запускает процесс-шард и перезапускает его после падения с растущей задержкой."""
+    delay = 1
+    while not stop.is_set():
+        process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=shard_env(index))
+        processes[index] = process
+        started = time.monotonic()
+        logger.info(f"Shard {index} started, pid {process.pid}")
+        stopping = asyncio.create_task(stop.wait())
+        await asyncio.wait([stopping, asyncio.create_task(process.wait())], return_when=asyncio.FIRST_COMPLETED)
+        if stop.is_set():
+            if process.returncode is None:
+                process.terminate()
+                await process.wait()
+            return
+        stopping.cancel()
+        if time.monotonic() - started > 60:
+            delay = 1
+        logger.error(f"Shard {index} exited with code {process.returncode}, restarting in {delay} s")
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+        delay = min(delay * 2, 60)
+
+async def run_supervisor():
+    """
+    Режим RUN_MODE=supervisor: запускает SHARDS процессов бота и сам принимает webhook
+    от Telegram, пересылая каждое обновление шарду, который отвечает за его чат
+    (abs(chat_id) % SHARDS). Черновики, состояния диалогов и очередь заявок хранятся
+    в общей базе SQLite, поэтому шард можно перезапустить, а число шардов - изменить
+    без потери незавершенных заявок.
+    """
+    from aiohttp import web, ClientSession, ClientTimeout, ClientError
+
+    if STATE_BACKEND != "sqlite":
+        raise RuntimeError("для нескольких процессов нужно общее хранилище черновиков: STATE_BACKEND=sqlite")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    processes = [None] * SHARDS
+    shard_urls = [f"http://127.0.0.1:{SHARD_BASE_PORT + index}{WEBHOOK_PATH}" for index in range(SHARDS)]
+    session = ClientSession(timeout=ClientTimeout(total=30))
+
+    async def forward_update(request):
+        if not webhook_authorized(request):
+            return web.Response(status=403)
+        body = await request.read()
+        try:
+            key = update_chat_key(Update.de_json(json.loads(body), None))
+        except Exception as e:
+            logger.warning(f"Webhook: некорректное обновление: {e}")
+            return web.Response(status=400)
+        index = abs(key) % SHARDS if key is not None else 0
+        try:
+            async with session.post(
+                shard_urls[index],
+                data=body,
+                headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET},
+            ) as response:
+                return web.Response(status=response.status)
+        except (ClientError, asyncio.TimeoutError) as e:
+            # Telegram повторит доставку, когда шард перезапустится
+            logger.warning(f"Shard {index} is unavailable: {e!r}")
+            return web.Response(status=503)
+
+    async def shard_health(index):
+        process = processes[index]
+        shard = {"index": index, "pid": process.pid if process else None, "ready": False}
+        if process is None or process.returncode is not None:
+            return shard
+        try:
+            async with session.get(
+                f"http://127.0.0.1:{SHARD_BASE_PORT + index}/healthz", timeout=ClientTimeout(total=2)
+            ) as response:
+                shard["ready"] = response.status == 200
+                shard.update(await response.json())
+        except (ClientError, asyncio.TimeoutError, ValueError):
+            pass
+        return shard
+
+    async def health(request):
+        shards = await asyncio.gather(*(shard_health(index) for index in range(SHARDS)))
+        healthy = all(shard["ready"] for shard in shards)
+        return web.json_response(
+            {"status": "ok" if healthy else "degraded", "mode": "supervisor", "shards": shards},
+            status=200 if healthy else 503,
+        )
+
+    web_app = web.Application()
+    web_app.router.add_post(WEBHOOK_PATH, forward_update)
+    web_app.router.add_get("/healthz", health)
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+
+    keepers = [asyncio.create_task(keep_shard_running(index, processes, stop)) for index in range(SHARDS)]
+    try:
+        if WEBHOOK_URL:
+            async with Bot(BOT_TOKEN) as bot:
+                await bot.set_webhook(
+                    url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                    secret_token=WEBHOOK_SECRET or None,
+                    allowed_updates=Update.ALL_TYPES,
+                )
+        logger.info(f"Supervisor listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}, {SHARDS} shards")
+        await stop.wait()
+    finally:
+        stop.set()
+        await asyncio.gather(*keepers, return_exceptions=True)
+        await runner.cleanup()
+        await session.close()
+
+def enable_incremental_vacuum(path):
+    """
+    Переводит базу в режим auto_vacuum=INCREMENTAL, в котором очистка архива возвращает
+    место системе. База перестраивается командой VACUUM под исключительной блокировкой,
+    поэтому это отдельный шаг (RUN_MODE=vacuum) при остановленном боте.
+    """
+    conn = open_db(path)
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            logger.info(f"Database {path} already uses incremental auto_vacuum")
+            return
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+        logger.info(f"Database {path} switched to incremental auto_vacuum")
+    finally:
+        conn.close()
+
 async def main():
     """Основная функция для запуска бота."""
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-    await app.bot.delete_webhook()
+    if RUN_MODE == "supervisor":
+        await run_supervisor()
+        return
+    if RUN_MODE == "vacuum":
+        enable_incremental_vacuum(DB_PATH)
+        return
+
+    open_storage()
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .persistence(DraftPersistence(user_state))
+        .concurrent_updates(PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES, chat_locks))
+        .rate_limiter(OutboundScheduler(
+            TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_GROUP_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_MAX_RETRIES,
+            shard_count=SHARD_COUNT, shared_chats=[PROCUREMENT_CHAT_ID] if PROCUREMENT_CHAT_ID else [],
+        ))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     conv_handler = ConversationHandler(
+        name="request",
+        persistent=True,
         entry_points=[MessageHandler(filters.TEXT & filters.Regex("^Создать заявку$"), start_conversation)],
         states={
             PROJECT: [
-                CallbackQueryHandler(cancel, pattern="^cancel_dialog$"),
-                CallbackQueryHandler(project_handler)
+                CallbackRouter({CB_PROJECT: project_handler, CB_CANCEL: cancel})
             ],
             OBJECT: [
-                CallbackQueryHandler(cancel, pattern="^cancel_dialog$"),
-                CallbackQueryHandler(object_handler)
+                CallbackRouter({CB_OBJECT: object_handler, CB_CANCEL: cancel})
             ],
             NAME: [
+                MessageHandler(QUICK_ENTRY_FILTER, quick_entry_handler),
+                MessageHandler(REQUEST_NUMBER_FILTER, request_number_handler),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, name_handler),
-                CallbackQueryHandler(cancel, pattern="^cancel_dialog$")
+                MessageHandler(filters.Document.ALL, import_file_handler),
+                CallbackRouter({CB_IMPORT: import_prompt_handler, CB_REPEAT: repeat_request_handler,
+                                CB_HISTORY: request_history_handler, CB_ADD_MORE: confirm_add_more_handler,
+                                CB_CANCEL: cancel})
             ],
             UNIT: [
-                CallbackQueryHandler(cancel, pattern="^cancel_dialog$"),
-                CallbackQueryHandler(unit_handler)
+                CallbackRouter({CB_UNIT: unit_handler, CB_CANCEL: cancel})
             ],
             QUANTITY: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, quantity_handler),
-                CallbackQueryHandler(cancel, pattern="^cancel_dialog$")
+                CallbackRouter({CB_CANCEL: cancel})
             ],
             MODULE: [
-                CallbackQueryHandler(module_handler, pattern="^(?:[1-9]|1[0-8])$"),
-                CallbackQueryHandler(cancel, pattern="^cancel_dialog$")
+                CallbackRouter({CB_MODULE: module_handler, CB_CANCEL: cancel})
             ],
             POSITION_DELIVERY_DATE: [
-                CallbackQueryHandler(process_position_calendar_callback, pattern="^POS_CAL_"),
-                CallbackQueryHandler(cancel, pattern="^cancel_dialog$")
+                CallbackRouter({
+                    CB_CALENDAR_NAV: calendar_navigation_handler,
+                    CB_CALENDAR_DATE: process_position_date,
+                    CB_CALENDAR_CANCEL: cancel_position_date,
+                    CB_IGNORE: ignore_button,
+                    CB_CANCEL: cancel,
+                })
             ],
             ATTACHMENT_CHOICE: [
-                CallbackQueryHandler(attachment_choice_handler, pattern="^(attach_file|attach_link|no_attachment)$"),
-                CallbackQueryHandler(cancel, pattern="^cancel_dialog$")
+                CallbackRouter({CB_ATTACHMENT: attachment_choice_handler, CB_CANCEL: cancel})
             ],
             FILE_INPUT: [
                 MessageHandler(filters.Document.ALL & ~filters.COMMAND, handle_file_input),
-                CallbackQueryHandler(cancel, pattern="^cancel_dialog$")
+                CallbackRouter({CB_CANCEL: cancel})
             ],
             LINK_INPUT: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_link_input),
-                CallbackQueryHandler(cancel, pattern="^cancel_dialog$")
+                CallbackRouter({CB_CANCEL: cancel})
             ],
             CONFIRM_ADD_MORE: [
-                CallbackQueryHandler(cancel, pattern="^cancel_dialog$"),
-                CallbackQueryHandler(confirm_add_more_handler)
+                CallbackRouter({CB_ADD_MORE: confirm_add_more_handler, CB_CANCEL: cancel})
             ],
 
             EDIT_MENU: [
-                CallbackQueryHandler(select_position_handler, pattern="^(edit_pos|delete_pos)$"),
-                CallbackQueryHandler(show_final_summary_and_confirm, pattern="^continue_final_confirm$"),
-                CallbackQueryHandler(cancel, pattern="^cancel_dialog$")
+                MessageHandler(QUICK_ENTRY_FILTER, quick_entry_handler),
+                CallbackRouter({
+                    CB_POSITION_ACTION: select_position_handler,
+                    CB_CONTINUE: show_final_summary_and_confirm,
+                    CB_IMPORT: import_prompt_handler,
+                    CB_PAGE: edit_menu_page,
+                    CB_IGNORE: ignore_button,
+                    CB_CANCEL: cancel,
+                })
             ],
             SELECT_POSITION: [
-                CallbackQueryHandler(process_selected_position, pattern="^select_pos_\\d+$"),
-                CallbackQueryHandler(edit_menu_handler, pattern="^back_to_edit_menu$"),
-                CallbackQueryHandler(cancel, pattern="^cancel_dialog$")
+                CallbackRouter({
+                    CB_SELECT_POSITION: process_selected_position,
+                    CB_BACK_TO_MENU: edit_menu_handler,
+                    CB_PAGE: select_position_page,
+                    CB_IGNORE: ignore_button,
+                    CB_CANCEL: cancel,
+                })
             ],
             EDIT_FIELD_SELECTION: [
-                CallbackQueryHandler(edit_field_input_handler, pattern="^edit_field_"),
-                CallbackQueryHandler(edit_menu_handler, pattern="^back_to_edit_menu$"),
-                CallbackQueryHandler(cancel, pattern="^cancel_dialog$")
+                CallbackRouter({
+                    CB_EDIT_FIELD: edit_field_input_handler,
+                    CB_BACK_TO_MENU: edit_menu_handler,
+                    CB_CANCEL: cancel,
+                })
             ],
             EDIT_FIELD_INPUT: [
                 MessageHandler(filters.TEXT | filters.Document.ALL & ~filters.COMMAND, edit_field_input_handler),
-                CallbackQueryHandler(cancel, pattern="^cancel_dialog$")
+                CallbackRouter({CB_CANCEL: cancel})
             ],
 
             EDITING_UNIT: [
-                CallbackQueryHandler(process_edited_unit_selection, pattern="^edit_unit_"),
-                CallbackQueryHandler(cancel, pattern="^cancel_dialog$")
+                CallbackRouter({CB_EDIT_UNIT: process_edited_unit_selection, CB_CANCEL: cancel})
             ],
             EDITING_MODULE: [
-                CallbackQueryHandler(process_edited_module_selection, pattern="^edit_module_"),
-                CallbackQueryHandler(cancel, pattern="^cancel_dialog$")
+                CallbackRouter({CB_EDIT_MODULE: process_edited_module_selection, CB_CANCEL: cancel})
             ],
 
             GLOBAL_DELIVERY_DATE_SELECTION: [
-                CallbackQueryHandler(process_global_calendar_callback, pattern="^(CAL_|EDIT_CAL_)\d+_\\d+"),
-                CallbackQueryHandler(process_global_calendar_callback, pattern="^(CAL_|EDIT_CAL_)"),
-                CallbackQueryHandler(cancel, pattern="^cancel_dialog$")
+                CallbackRouter({
+                    CB_CALENDAR_NAV: calendar_navigation_handler,
+                    CB_CALENDAR_DATE: process_edited_date,
+                    CB_CALENDAR_CANCEL: cancel_edited_date,
+                    CB_IGNORE: ignore_button,
+                    CB_CANCEL: cancel,
+                })
+            ],
+            IMPORT_FILE: [
+                MessageHandler(filters.Document.ALL, import_file_handler),
+                CallbackRouter({CB_BACK_TO_MENU: edit_menu_handler, CB_CANCEL: cancel})
             ],
             FINAL_CONFIRMATION: [
-                CallbackQueryHandler(cancel, pattern="^cancel_dialog$"),
-                CallbackQueryHandler(final_confirm_handler)
+                CallbackRouter({
+                    CB_FINAL_CONFIRM: final_confirm_handler,
+                    CB_PAGE: final_summary_page,
+                    CB_IGNORE: ignore_button,
+                    CB_CANCEL: cancel,
+                })
+            ],
+            ConversationHandler.TIMEOUT: [
+                TypeHandler(Update, draft_timeout_handler)
             ],
         },
         fallbacks=[
             CommandHandler("cancel", cancel),
-            CallbackQueryHandler(cancel, pattern="^cancel_dialog$"),
-            MessageHandler(filters.COMMAND | filters.TEXT, unknown)
+            CallbackRouter({CB_CANCEL: cancel}),
+            MessageHandler(filters.COMMAND | filters.TEXT, unknown),
+            CallbackQueryHandler(stale_button)
         ],
+        conversation_timeout=DRAFT_TTL,
     )
 
+    app.add_handler(TypeHandler(Update, warm_draft), group=-1)
     app.add_handler(conv_handler)
+    app.add_handler(InlineQueryHandler(inline_name_query))
     app.add_handler(CommandHandler("start", initial_message_handler))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, initial_message_handler))
+    app.add_handler(CallbackQueryHandler(stale_button))
+
+    if RUN_MODE == "webhook":
+        try:
+            await run_webhook(app)
+            return
+        except WebhookUnavailable as e:
+            if SHARD_COUNT > 1:
+                # Шард не может перейти на опрос: getUpdates отключил бы webhook всех шардов
+                raise
+            logger.warning(f"Webhook mode unavailable, falling back to polling: {e}")
 
+    await app.bot.delete_webhook()
     await app.run_polling()
 
 import nest_asyncio
@@ -0,0 +1,12 @@
+import os
+import sys
+
+# main.py читает настройки при импорте; для тестов достаточно заглушек
+os.environ.setdefault("BOT_TOKEN", "123:test")
+os.environ.setdefault("EMAIL_LOGIN", "bot@example.com")
+os.environ.setdefault("EMAIL_PASSWORD", "test")
+os.environ.setdefault("SMTP_SERVER", "127.0.0.1")
+os.environ.setdefault("SMTP_PORT", "25")
+os.environ.setdefault("EMAIL_RECEIVER", "supply@example.com")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,38 @@
+import email
+import email.policy
+
+import main
+
+
+def parse(mail):
+    return email.message_from_bytes(b"".join(mail.chunks()), policy=email.policy.default)
+
+
+def test_streamed_mail_is_well_formed(tmp_path):
+    pdf = tmp_path / "spec.pdf"
+    pdf.write_bytes(bytes(range(256)) * 1000)
+    mail = main.OutgoingMail("Заявка на снабжение: Мотели - Аральск", "bot@example.com", "supply@example.com",
+                             "Во вложении заявка на снабжение.\n")
+    mail.attach(b"xlsx data", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "Заявка.xlsx")
+    mail.attach(str(pdf), "application/pdf", "Позиция_1_spec.pdf")
+
+    msg = parse(mail)
+
+    assert msg.defects == []
+    assert all(part.defects == [] for part in msg.walk())
+    assert msg["Subject"] == "Заявка на снабжение: Мотели - Аральск"
+    assert msg.get_body().get_content().rstrip() == "Во вложении заявка на снабжение."
+    attachments = list(msg.iter_attachments())
+    assert [a.get_filename() for a in attachments] == ["Заявка.xlsx", "Позиция_1_spec.pdf"]
+    assert attachments[0].get_content() == b"xlsx data"
+    assert attachments[1].get_content() == pdf.read_bytes()
+
+
+def test_mail_without_attachments():
+    mail = main.OutgoingMail("Тема", "bot@example.com", "supply@example.com", "Текст\n")
+
+    msg = parse(mail)
+
+    assert msg.defects == []
+    assert list(msg.iter_attachments()) == []
+    assert msg.get_body().get_content().rstrip() == "Текст"
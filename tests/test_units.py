@@ -0,0 +1,60 @@
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("text, unit", [
+    ("м", "м"),
+    ("кв.м", "м2"),
+    ("шт.", "шт"),
+    ("килогр", "кг"),
+    # Формы слов
+    ("метры", "м"),
+    ("Метров", "м"),
+    ("метрами", "м"),
+    ("штуку", "шт"),
+    ("литры", "л"),
+    ("килограммы", "кг"),
+    ("комплекты", "компл"),
+    ("тонну", "тн"),
+    ("кубы", "м3"),
+    # Опечатки
+    ("метор", "м"),
+    ("килограм", "кг"),
+    ("киллограмм", "кг"),
+    ("комлпект", "компл"),
+])
+def test_match_unit(text, unit):
+    assert main.match_unit(text) == unit
+
+
+@pytest.mark.parametrize("text", ["банка", "мешок", "мм", "км", "xyz", ""])
+def test_match_unit_rejects_unknown(text):
+    assert main.match_unit(text) is None
+
+
+def test_edit_distance():
+    assert main.edit_distance("метр", "метр", 1) == 0
+    assert main.edit_distance("мерт", "метр", 1) == 1
+    assert main.edit_distance("литр", "метр", 1) == 2
+    assert main.edit_distance("килограм", "килограмм", 2) == 1
+
+
+@pytest.mark.parametrize("text", [
+    "Кабель ВВГ 3x2.5; м; 150; 7; 25.08",
+    "Кабель ВВГ 3x2.5\tм\t150\t7\t25.08",
+    "Кабель; метры",
+    "Труба; 12\nБолт М8; 5",
+])
+def test_quick_entry_detected(text):
+    assert main.looks_like_quick_entry(text)
+
+
+@pytest.mark.parametrize("text", [
+    "Кабель ВВГ 3x2.5",
+    "Болт М8; оцинкованный",
+    "Кран шаровой; 1/2 дюйма",
+    "Светильник LED\nдля улицы",
+])
+def test_position_name_is_not_quick_entry(text):
+    assert not main.looks_like_quick_entry(text)